@@ -0,0 +1,284 @@
+# accounts.py
+"""
+Suppression de comptes : un utilisateur (DELETE /me), un lot (POST
+/moderation/accounts/purge) ou une purge de masse hors app :
+
+    python accounts.py purge 12 13 14
+    python accounts.py purge --file spam_ids.txt
+    python accounts.py purge --email-domain spam.example --dry-run
+
+Ensembliste, jamais par la cascade ORM (qui chargerait chaque avis, jeton et
+session puis les supprimerait un par un, sans toucher aux agrégats) :
+1. révocation : sessions, magic links et clés d'idempotence des comptes
+   visés, par lots de PURGE_USER_BATCH -> plus aucune écriture au nom de ces
+   comptes pendant la purge ;
+2. avis : au plus PURGE_REVIEW_BATCH par transaction. La transaction commence
+   par DELETE ... RETURNING (verrou d'écriture pris d'emblée : pas de lecture
+   puis promotion du verrou) ; signatures et jobs du pipeline suivent par
+   ON DELETE CASCADE, l'index FTS par ses triggers. Dans la même transaction :
+   rollups retirés, une version + des tombstones par établissement touché,
+   agrégats et classements recalculés en lot (une requête GROUP BY) ;
+3. comptes : DELETE des users du lot sans avis restant (un avis écrit
+   entre-temps -> le compte est repris au tour suivant).
+
+Pause (PURGE_PAUSE_SECONDS) entre deux transactions : les écritures d'avis
+passent entre deux. Budget de temps optionnel : arrêt entre deux
+transactions, les comptes restants sont renvoyés (le handler admin est
+rappelé avec eux ; le CLI n'a pas de budget).
+
+Après chaque commit : un événement live "reviews_purged" par établissement.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, exists, insert, select, update
+from sqlalchemy.orm import Session
+
+import establishment_index
+import leaderboards
+import live
+import rollups
+from idempotency import session_owner
+from models import Establishment, IdempotencyKey, LoginToken, Review, ReviewTombstone, User
+from models import Session as DbSession
+
+PURGE_USER_BATCH = int(os.getenv("THENA_PURGE_USER_BATCH", "200"))
+PURGE_REVIEW_BATCH = int(os.getenv("THENA_PURGE_REVIEW_BATCH", "200"))
+# >= pas d'attente maximal du busy handler SQLite (100 ms) : un écrivain en attente
+# se réveille forcément pendant la pause au lieu de rater la fenêtre
+PURGE_PAUSE_SECONDS = float(os.getenv("THENA_PURGE_PAUSE_SECONDS", "0.1"))
+
+_reviews = Review.__table__
+_users = User.__table__
+_sessions = DbSession.__table__
+_login_tokens = LoginToken.__table__
+
+# colonnes rendues par le DELETE : de quoi retirer l'avis des rollups (rollups.add_review)
+_RETURNED = (
+    _reviews.c.id, _reviews.c.establishment_id, _reviews.c.created_at, _reviews.c.score,
+    _reviews.c.role, _reviews.c.contract, _reviews.c.housing,
+    *[_reviews.c[f] for f in rollups.FLAGS],
+)
+
+# est_id -> (ids des avis supprimés, nouvelle version, agrégats écrits)
+Purged = Dict[int, Tuple[List[int], int, dict]]
+
+
+# ---------------- une transaction ----------------
+def revoke(db: Session, user_ids: List[int]) -> int:
+    """Sessions, magic links et clés d'idempotence des comptes (avant commit). Renvoie le nb de sessions."""
+    hashes = db.execute(
+        delete(_sessions).where(_sessions.c.user_id.in_(user_ids)).returning(_sessions.c.session_hash)
+    ).scalars().all()
+    db.execute(delete(_login_tokens).where(_login_tokens.c.user_id.in_(user_ids)))
+    if hashes:
+        db.execute(
+            delete(IdempotencyKey.__table__)
+            .where(IdempotencyKey.__table__.c.owner.in_([session_owner(h) for h in hashes]))
+        )
+    return len(hashes)
+
+
+def purge_reviews(db: Session, user_ids: List[int], limit: int) -> Purged:
+    """
+    Supprime au plus `limit` avis de `user_ids` et répercute sur les
+    établissements touchés, dans la transaction en cours (avant commit).
+    """
+    victims = select(_reviews.c.id).where(_reviews.c.user_id.in_(user_ids)).order_by(_reviews.c.id).limit(limit)
+    rows = db.execute(delete(_reviews).where(_reviews.c.id.in_(victims)).returning(*_RETURNED)).all()
+    if not rows:
+        return {}
+
+    by_est: Dict[int, list] = {}
+    for r in rows:
+        by_est.setdefault(r.establishment_id, []).append(r)
+
+    types = dict(db.query(Establishment.id, Establishment.types_json).filter(Establishment.id.in_(by_est)))
+    deltas: Dict[rollups.Key, List[float]] = {}
+    for r in rows:
+        rollups.add_review(deltas, r, types.get(r.establishment_id), -1)
+    rollups.apply(db, deltas)
+
+    versions = dict(db.execute(
+        update(Establishment)
+        .where(Establishment.id.in_(by_est))
+        .values(version=Establishment.version + 1)
+        .returning(Establishment.id, Establishment.version)
+        .execution_options(synchronize_session=False)
+    ).all())
+    db.execute(insert(ReviewTombstone.__table__), [
+        {"establishment_id": est_id, "review_id": r.id, "version": versions[est_id]}
+        for est_id, est_rows in by_est.items() for r in est_rows
+    ])
+
+    aggregates = establishment_index.refresh_aggregates_many(db, by_est)
+    leaderboards.update_establishments(db, by_est)
+    return {
+        est_id: ([r.id for r in est_rows], versions[est_id], aggregates[est_id])
+        for est_id, est_rows in by_est.items()
+    }
+
+
+def delete_users(db: Session, user_ids: List[int]) -> Tuple[List[int], List[int]]:
+    """
+    DELETE des comptes sans avis (avant commit) ; sessions et magic links
+    éventuels partent par ON DELETE CASCADE. Renvoie (supprimés, encore présents).
+    """
+    has_reviews = exists().where(_reviews.c.user_id == _users.c.id)
+    deleted = db.execute(
+        delete(_users).where(_users.c.id.in_(user_ids), ~has_reviews).returning(_users.c.id)
+    ).scalars().all()
+    kept = db.execute(select(_users.c.id).where(_users.c.id.in_(user_ids))).scalars().all()
+    return deleted, kept
+
+
+def publish(purged: Purged):
+    """Après commit."""
+    for est_id, (review_ids, version, values) in purged.items():
+        live.publish(est_id, {
+            "type": "reviews_purged",
+            "review_ids": review_ids,
+            "version": version,
+            "thena_avg": values["thena_avg"],
+            "thena_count_scored": values["thena_count_scored"],
+            "thena_count_total": values["thena_count_total"],
+        })
+
+
+# ---------------- purge par lots ----------------
+def _chunks(ids: List[int], size: int) -> Iterable[List[int]]:
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def purge_users(
+    session_factory,
+    user_ids: Iterable[int],
+    budget_seconds: Optional[float] = None,
+    user_batch: int = PURGE_USER_BATCH,
+    review_batch: int = PURGE_REVIEW_BATCH,
+    pause_seconds: float = PURGE_PAUSE_SECONDS,
+    on_commit: Optional[Callable[[Iterable[int]], None]] = None,
+) -> dict:
+    """
+    Supprime les comptes `user_ids` et tout ce qui en dépend, une courte
+    transaction à la fois. `on_commit(est_ids)` : établissements modifiés par
+    un lot (snapshots). Ids inconnus ignorés ; relancer sur les restants est sûr.
+    """
+    pending = sorted({int(u) for u in user_ids})
+    result = {
+        "requested": len(pending), "users_deleted": 0, "reviews_deleted": 0, "sessions_revoked": 0,
+        "establishments": 0, "transactions": 0, "max_transaction_ms": 0.0,
+    }
+    touched = set()
+    started = time.perf_counter()
+
+    def in_transaction(work):
+        if result["transactions"] and pause_seconds:
+            time.sleep(pause_seconds)
+        db = session_factory()
+        try:
+            t0 = time.perf_counter()
+            out = work(db)
+            db.commit()
+            ms = (time.perf_counter() - t0) * 1000
+        finally:
+            db.close()
+        result["transactions"] += 1
+        result["max_transaction_ms"] = max(result["max_transaction_ms"], round(ms, 2))
+        return out
+
+    def out_of_time() -> bool:
+        return budget_seconds is not None and time.perf_counter() - started >= budget_seconds
+
+    ready = []  # comptes révoqués, à purger
+    for chunk in _chunks(pending, user_batch):
+        if out_of_time():
+            break
+        result["sessions_revoked"] += in_transaction(lambda db: revoke(db, chunk))
+        ready.extend(chunk)
+    waiting = pending[len(ready):]
+
+    while ready and not out_of_time():
+        chunk = ready[:user_batch]
+
+        def work(db):
+            purged = purge_reviews(db, chunk, review_batch)
+            # lot incomplet : plus aucun avis pour ces comptes -> on les supprime dans la foulée
+            if sum(len(ids) for ids, _, _ in purged.values()) < review_batch:
+                return purged, delete_users(db, chunk)
+            return purged, None
+
+        purged, users = in_transaction(work)
+        if purged:
+            publish(purged)
+            touched.update(purged)
+            result["reviews_deleted"] += sum(len(ids) for ids, _, _ in purged.values())
+            if on_commit is not None:
+                on_commit(purged.keys())
+        if users is not None:
+            deleted, kept = users
+            result["users_deleted"] += len(deleted)
+            ready = kept + ready[len(chunk):]
+
+    result["establishments"] = len(touched)
+    result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    result["remaining_user_ids"] = ready + waiting
+    return result
+
+
+def select_user_ids(db: Session, email_domain: str) -> List[int]:
+    """Comptes dont l'email est sur `email_domain` (purge de spam)."""
+    return [
+        user_id for (user_id,) in
+        db.query(User.id).filter(User.email.ilike(f"%@{email_domain.lstrip('@')}")).order_by(User.id)
+    ]
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="THENA account deletion")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_purge = sub.add_parser("purge")
+    p_purge.add_argument("user_ids", nargs="*", type=int)
+    p_purge.add_argument("--file", help="un id par ligne ('-' = entrée standard)")
+    p_purge.add_argument("--email-domain", help="tous les comptes de ce domaine")
+    p_purge.add_argument("--user-batch", type=int, default=PURGE_USER_BATCH)
+    p_purge.add_argument("--review-batch", type=int, default=PURGE_REVIEW_BATCH)
+    p_purge.add_argument("--pause", type=float, default=PURGE_PAUSE_SECONDS, help="secondes entre deux transactions")
+    p_purge.add_argument("--dry-run", action="store_true", help="compte seulement")
+    args = parser.parse_args()
+
+    ids = list(args.user_ids)
+    if args.file:
+        with (sys.stdin if args.file == "-" else open(args.file)) as f:
+            ids.extend(int(line) for line in f if line.strip())
+    if args.email_domain:
+        db = SessionLocal()
+        try:
+            ids.extend(select_user_ids(db, args.email_domain))
+        finally:
+            db.close()
+    if not ids:
+        sys.exit("nothing to purge: give user ids, --file or --email-domain")
+
+    if args.dry_run:
+        db = SessionLocal()
+        try:
+            ids = sorted(set(ids))
+            users = reviews = 0
+            for chunk in _chunks(ids, PURGE_USER_BATCH):
+                users += db.query(User).filter(User.id.in_(chunk)).count()
+                reviews += db.query(Review).filter(Review.user_id.in_(chunk)).count()
+        finally:
+            db.close()
+        print(json.dumps({"users": users, "reviews": reviews}, indent=2))
+    else:
+        print(json.dumps(purge_users(
+            SessionLocal, ids, user_batch=args.user_batch, review_batch=args.review_batch, pause_seconds=args.pause,
+        ), indent=2))
@@ -1,6 +1,4 @@
 # asgi.py
-from main import app  # ton app FastAPI existante
-
-# On "branche" l'UI sans modifier main.py
-from ui import register_ui
-register_ui(app)
+# Point d'entrée ASGI pour un serveur externe (uvicorn asgi:app, gunicorn -k uvicorn.workers.UvicornWorker ...).
+# L'UI est servie par main.py (/ui/) ; en production préférer `python serve.py`.
+from main import app  # noqa: F401
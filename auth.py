@@ -1,4 +1,6 @@
 # auth.py
+import hmac
+import os
 from datetime import datetime
 from fastapi import Depends, HTTPException, Request
 from sqlalchemy.orm import Session
@@ -31,3 +33,15 @@ def get_current_user(request: Request, db: Session = Depends(get_db)) -> User:
         raise HTTPException(status_code=401, detail="User not found")
 
     return user
+
+
+ADMIN_TOKEN = os.getenv("THENA_ADMIN_TOKEN")
+
+
+def require_admin(request: Request):
+    # endpoints de modération : jeton partagé (header X-Admin-Token), désactivés sans THENA_ADMIN_TOKEN
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    token = request.headers.get("x-admin-token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
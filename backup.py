@@ -0,0 +1,325 @@
+# backup.py
+"""
+Sauvegardes à chaud de la base SQLite (API "online backup" de SQLite).
+
+- copie par petits lots de pages (BACKUP_STEP_PAGES) avec une courte pause
+  entre deux lots : l'écrivain n'est jamais bloqué longtemps. En WAL, la copie
+  se fait dans une transaction de lecture : instantané cohérent, les
+  écritures continuent pendant la copie et ne la font pas recommencer ;
+- vérification (PRAGMA integrity_check) de la copie avant compression ;
+- compression en flux vers le disque : zstd si `zstandard` est installé,
+  sinon gzip ; manifeste JSON (taille, sha256, pages) à côté ;
+- planification (BackupJob, un seul process à la fois grâce à un verrou
+  fichier) + rétention des BACKUP_KEEP plus récentes.
+
+Usage :
+    python backup.py                      # sauvegarde maintenant
+    python backup.py list
+    python backup.py verify <fichier>
+    python backup.py restore <fichier> --yes [--target chemin.db]
+"""
+import argparse
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+
+try:
+    import zstandard  # optionnel
+except ImportError:
+    zstandard = None
+
+BACKUP_DIR = os.getenv("THENA_BACKUP_DIR", "./backups")
+BACKUP_KEEP = int(os.getenv("THENA_BACKUP_KEEP", "14"))
+BACKUP_INTERVAL_HOURS = float(os.getenv("THENA_BACKUP_INTERVAL_HOURS", "24"))
+BACKUP_COMPRESS = os.getenv("THENA_BACKUP_COMPRESS", "zstd" if zstandard is not None else "gzip")
+BACKUP_STEP_PAGES = 256          # 1 Mo par lot avec des pages de 4 Ko
+BACKUP_STEP_PAUSE = 0.002
+_PREFIX = "thena-"
+_SUFFIXES = {"zstd": ".db.zst", "gzip": ".db.gz", "none": ".db"}
+
+
+def sqlite_path_from_url(url: str) -> Optional[str]:
+    if not url.startswith("sqlite:///"):
+        return None
+    return url[len("sqlite:///"):]
+
+
+# ---------------- compression ----------------
+def _open_compressed_write(path: str, method: str):
+    if method == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed")
+        return zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(open(path, "wb"), closefd=True)
+    if method == "gzip":
+        return gzip.open(path, "wb", compresslevel=6)
+    return open(path, "wb")
+
+
+def _open_decompressed_read(path: str):
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def integrity_check(db_path: str) -> str:
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+
+
+# ---------------- sauvegarde ----------------
+def copy_online(source_path: str, dest_path: str, pages: int = BACKUP_STEP_PAGES,
+                pause: float = BACKUP_STEP_PAUSE) -> dict:
+    """Copie page par page de la base vivante vers dest_path (non compressé)."""
+    src = sqlite3.connect(source_path, timeout=30, isolation_level=None)
+    dst = sqlite3.connect(dest_path, isolation_level=None)
+    steps = [0]
+    total = [0]
+
+    def progress(status, remaining, page_count):
+        steps[0] += 1
+        total[0] = page_count
+        if pause:
+            time.sleep(pause)  # laisse passer les écrivains entre deux lots
+
+    try:
+        wal = src.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+        if wal:
+            # instantané : la copie n'est pas relancée à chaque écriture concurrente
+            src.execute("BEGIN")
+            src.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        src.backup(dst, pages=pages, progress=progress)
+        if wal:
+            src.execute("COMMIT")
+        # la copie reste en journal "delete" : un seul fichier, restaurable tel quel
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
+    return {"pages": total[0], "steps": steps[0]}
+
+
+def backup_now(source_path: str, directory: str = BACKUP_DIR, method: str = BACKUP_COMPRESS,
+               keep: int = BACKUP_KEEP) -> dict:
+    os.makedirs(directory, exist_ok=True)
+    started = time.perf_counter()
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    final_path = os.path.join(directory, f"{_PREFIX}{stamp}{_SUFFIXES[method]}")
+
+    fd, tmp_db = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".db")
+    os.close(fd)
+    tmp_out = final_path + ".tmp"
+    try:
+        info = copy_online(source_path, tmp_db)
+        integrity = integrity_check(tmp_db)
+        if integrity != "ok":
+            raise RuntimeError(f"integrity_check failed on the copy: {integrity}")
+        raw_bytes = os.path.getsize(tmp_db)
+
+        with open(tmp_db, "rb") as f_in, _open_compressed_write(tmp_out, method) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
+        os.replace(tmp_out, final_path)
+    finally:
+        for path in (tmp_db, tmp_out):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    manifest = {
+        "file": os.path.basename(final_path),
+        "created_at": datetime.utcnow().isoformat(),
+        "source": os.path.abspath(source_path),
+        "compression": method,
+        "pages": info["pages"],
+        "steps": info["steps"],
+        "raw_bytes": raw_bytes,
+        "bytes": os.path.getsize(final_path),
+        "sha256": _sha256(final_path),
+        "integrity": integrity,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    with open(final_path + ".json", "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    prune(directory, keep)
+    return manifest
+
+
+def list_backups(directory: str = BACKUP_DIR) -> List[str]:
+    if not os.path.isdir(directory):
+        return []
+    names = [
+        n for n in os.listdir(directory)
+        if n.startswith(_PREFIX) and any(n.endswith(s) for s in _SUFFIXES.values())
+    ]
+    return [os.path.join(directory, n) for n in sorted(names)]  # horodatage -> tri chronologique
+
+
+def prune(directory: str, keep: int):
+    for path in list_backups(directory)[:-keep] if keep > 0 else []:
+        for p in (path, path + ".json"):
+            try:
+                os.unlink(p)
+            except FileNotFoundError:
+                pass
+
+
+# ---------------- vérification / restauration ----------------
+def _decompress_to_temp(path: str, directory: str) -> str:
+    fd, tmp_db = tempfile.mkstemp(dir=directory, prefix=".restore-", suffix=".db")
+    with os.fdopen(fd, "wb") as f_out, _open_decompressed_read(path) as f_in:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+    return tmp_db
+
+
+def verify(path: str) -> dict:
+    manifest_path = path + ".json"
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    result = {"file": path, "sha256_ok": None, "integrity": None}
+    if manifest.get("sha256"):
+        result["sha256_ok"] = _sha256(path) == manifest["sha256"]
+    tmp_db = _decompress_to_temp(path, os.path.dirname(os.path.abspath(path)))
+    try:
+        result["integrity"] = integrity_check(tmp_db)
+    finally:
+        os.unlink(tmp_db)
+    return result
+
+
+def restore(path: str, target_path: str) -> dict:
+    """
+    Remplace le contenu de target_path par la sauvegarde (API backup en un
+    seul lot : la base cible reste cohérente, même en WAL).
+    """
+    started = time.perf_counter()
+    target_dir = os.path.dirname(os.path.abspath(target_path))
+    tmp_db = _decompress_to_temp(path, target_dir)
+    try:
+        integrity = integrity_check(tmp_db)
+        if integrity != "ok":
+            raise RuntimeError(f"backup is corrupted: {integrity}")
+        src = sqlite3.connect(tmp_db)
+        dst = sqlite3.connect(target_path, timeout=30)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+    finally:
+        os.unlink(tmp_db)
+    return {"restored": path, "target": target_path, "seconds": round(time.perf_counter() - started, 3)}
+
+
+# ---------------- planification ----------------
+class BackupJob:
+    """
+    Sauvegarde périodique en thread de fond (même schéma que RebuildJob).
+    Multi-workers : verrou fichier + âge de la dernière sauvegarde -> une seule
+    sauvegarde par intervalle, quel que soit le nombre de process.
+    """
+
+    def __init__(self, source_path: str, directory: str = BACKUP_DIR,
+                 interval_hours: float = BACKUP_INTERVAL_HOURS, check_seconds: int = 300):
+        self.source_path = source_path
+        self.directory = directory
+        self.interval_seconds = interval_hours * 3600
+        self.check_seconds = check_seconds
+        self.last_result: Optional[dict] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None or self.interval_seconds <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="thena-backup", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def due(self) -> bool:
+        backups = list_backups(self.directory)
+        return not backups or time.time() - os.path.getmtime(backups[-1]) >= self.interval_seconds
+
+    def run_if_due(self) -> Optional[dict]:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None  # un autre worker sauvegarde
+            if not self.due():
+                return None
+            self.last_result = backup_now(self.source_path, self.directory)
+            return self.last_result
+
+    def _run(self):
+        while not self._stop.wait(self.check_seconds):
+            try:
+                self.run_if_due()
+            except Exception as e:
+                self.last_result = {"error": repr(e)}
+                print("BACKUP: failed:", repr(e))
+
+
+if __name__ == "__main__":
+    from database import DATABASE_URL
+
+    parser = argparse.ArgumentParser(description="THENA SQLite backups")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("list")
+    p_verify = sub.add_parser("verify")
+    p_verify.add_argument("file")
+    p_restore = sub.add_parser("restore")
+    p_restore.add_argument("file")
+    p_restore.add_argument("--target", default=sqlite_path_from_url(DATABASE_URL))
+    p_restore.add_argument("--yes", action="store_true", help="confirme l'écrasement de la base cible")
+    args = parser.parse_args()
+
+    db_path = sqlite_path_from_url(DATABASE_URL)
+    if db_path is None:
+        sys.exit("DATABASE_URL is not SQLite: use pg_dump / pg_basebackup")
+
+    if args.command == "list":
+        for path in list_backups():
+            print(path, os.path.getsize(path))
+    elif args.command == "verify":
+        print(verify(args.file))
+    elif args.command == "restore":
+        if not args.yes:
+            sys.exit(f"restore would overwrite {args.target}: re-run with --yes (stop the app first)")
+        print(restore(args.file, args.target))
+    else:
+        print(json.dumps(backup_now(db_path), indent=2))
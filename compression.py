@@ -0,0 +1,217 @@
+# compression.py
+"""
+Compression dynamique des réponses API (gzip, ou brotli si installé).
+
+- négociation via Accept-Encoding (brotli préféré) ;
+- seuil de taille : une réponse d'un seul bloc plus petite que `minimum_size`
+  part telle quelle ;
+- encodeur en flux : fonctionne avec StreamingResponse (flush à chaque bloc) ;
+- on ne touche pas aux réponses déjà compressées (Content-Encoding présent,
+  ex. fichiers UI pré-compressés) ni aux types déjà compressés / SSE.
+
+Les octets économisés et le temps CPU passé à compresser sont comptés par route
+et exposés dans /metrics.
+"""
+import os
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import metrics
+from static_assets import accepted_encodings
+
+try:
+    import brotli  # optionnel
+except ImportError:  # pragma: no cover
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.getenv("THENA_COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("THENA_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("THENA_BROTLI_QUALITY", "4"))
+
+SKIP_CONTENT_TYPES = (
+    "image/", "video/", "audio/", "font/woff",
+    "application/zip", "application/gzip", "application/x-gzip", "application/zstd",
+    "application/octet-stream",
+    "text/event-stream",  # SSE : chaque événement doit partir immédiatement
+)
+
+
+class _RouteStats:
+    __slots__ = ("responses", "bytes_in", "bytes_out", "cpu_seconds")
+
+    def __init__(self):
+        self.responses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+
+class CompressionStats:
+    def __init__(self):
+        self._routes: Dict[str, _RouteStats] = {}
+        self._lock = threading.Lock()
+
+    def record(self, route: str, bytes_in: int, bytes_out: int, cpu_seconds: float):
+        with self._lock:
+            st = self._routes.get(route)
+            if st is None:
+                st = self._routes[route] = _RouteStats()
+            st.responses += 1
+            st.bytes_in += bytes_in
+            st.bytes_out += bytes_out
+            st.cpu_seconds += cpu_seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                route: {
+                    "responses": st.responses,
+                    "bytes_in": st.bytes_in,
+                    "bytes_out": st.bytes_out,
+                    "bytes_saved": st.bytes_in - st.bytes_out,
+                    "cpu_ms": round(st.cpu_seconds * 1000, 3),
+                }
+                for route, st in self._routes.items()
+            }
+
+
+stats = CompressionStats()
+metrics.register("compression", stats.snapshot)
+
+
+class _GzipEncoder:
+    name = "gzip"
+
+    def __init__(self, level: int):
+        self._z = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 -> en-tête gzip
+
+    def compress(self, data: bytes) -> bytes:
+        return self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._z.flush(zlib.Z_FINISH)
+
+
+class _BrotliEncoder:
+    name = "br"
+
+    def __init__(self, quality: int):
+        self._c = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._c.process(data) + self._c.flush()
+
+    def finish(self) -> bytes:
+        return self._c.finish()
+
+
+def _route_name(scope: Scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or "<unmatched>"
+
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESS_MIN_SIZE,
+                 gzip_level: int = GZIP_LEVEL, brotli_quality: int = BROTLI_QUALITY):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def _encoder(self, scope: Scope):
+        headers = dict(scope.get("headers") or [])
+        accept = accepted_encodings(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if brotli is not None and "br" in accept:
+            return _BrotliEncoder(self.brotli_quality)
+        if "gzip" in accept:
+            return _GzipEncoder(self.gzip_level)
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoder = self._encoder(scope)
+        if encoder is None:
+            await self.app(scope, receive, send)
+            return
+
+        responder = _CompressingSend(self, scope, send, encoder)
+        await self.app(scope, receive, responder)
+
+
+class _CompressingSend:
+    def __init__(self, mw: CompressionMiddleware, scope: Scope, send: Send, encoder):
+        self.mw = mw
+        self.scope = scope
+        self.send = send
+        self.encoder = encoder
+        self.start: Optional[Message] = None
+        self.active: Optional[bool] = None  # None = pas encore décidé
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu = 0.0
+
+    def _compress(self, data: bytes, last: bool) -> bytes:
+        t0 = time.thread_time()
+        out = self.encoder.compress(data) if data else b""
+        if last:
+            out += self.encoder.finish()
+        self.cpu += time.thread_time() - t0
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        return out
+
+    async def __call__(self, message: Message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            headers = MutableHeaders(raw=message["headers"])
+            content_type = headers.get("content-type", "")
+            if (
+                "content-encoding" in headers
+                or message["status"] < 200 or message["status"] in (204, 304)
+                or content_type.startswith(SKIP_CONTENT_TYPES)
+            ):
+                self.active = False
+                await self.send(message)
+            return
+
+        if message["type"] != "http.response.body" or self.active is False:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.active is None:
+            # premier bloc : décide selon le seuil (uniquement si la réponse tient en un bloc)
+            if not more_body and len(body) < self.mw.minimum_size:
+                self.active = False
+                await self.send(self.start)
+                await self.send(message)
+                return
+
+            self.active = True
+            headers = MutableHeaders(raw=self.start["headers"])
+            headers["Content-Encoding"] = self.encoder.name
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                del headers["Content-Length"]
+                out = self._compress(body, last=False)
+            else:
+                out = self._compress(body, last=True)
+                headers["Content-Length"] = str(len(out))
+            await self.send(self.start)
+            await self.send({"type": "http.response.body", "body": out, "more_body": more_body})
+        else:
+            out = self._compress(body, last=not more_body)
+            await self.send({"type": "http.response.body", "body": out, "more_body": more_body})
+
+        if not more_body:
+            stats.record(_route_name(self.scope), self.bytes_in, self.bytes_out, self.cpu)
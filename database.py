@@ -1,6 +1,7 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import UniqueConstraint, create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.schema import CreateColumn
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,9 +10,83 @@ DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./thena.db")
 
 engine = create_engine(
     DATABASE_URL,
-    connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
+    # timeout : attente du verrou d'écriture SQLite sous concurrence (au lieu de "database is locked")
+    connect_args={"check_same_thread": False, "timeout": 30} if DATABASE_URL.startswith("sqlite") else {}
 )
 
+if DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _):
+        # WAL : les lectures ne bloquent plus l'écrivain (et inversement)
+        # foreign_keys : SQLite n'applique ON DELETE CASCADE / SET NULL que si activé (par connexion)
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA foreign_keys=ON")
+        cur.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+
+def sync_schema(bind=engine):
+    """
+    create_all ne touche pas aux tables existantes : on ajoute ici les colonnes,
+    index et contraintes d'unicité manquants, sans outil de migration.
+    Les nouvelles colonnes doivent être nullable ou avoir un server_default.
+    Renvoie les colonnes ajoutées ("table.colonne") et les contraintes d'unicité
+    créées ("table.nom", doublons supprimés au passage).
+    """
+    added = []
+    insp = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name not in existing:
+                    ddl = CreateColumn(col).compile(dialect=bind.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+                    added.append(f"{table.name}.{col.name}")
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+            for name in _sync_unique(conn, insp, table):
+                added.append(f"{table.name}.{name}")
+    return added
+
+
+def _sync_unique(conn, insp, table) -> list:
+    """
+    UniqueConstraint du modèle absente de la base (table créée avant elle) :
+    ON CONFLICT (...) en dépend. On supprime d'abord les doublons en gardant
+    la ligne la plus récente, puis CREATE UNIQUE INDEX. Vérifié à chaque
+    démarrage dans la base, jamais supposé.
+    """
+    present = {tuple(u["column_names"]) for u in insp.get_unique_constraints(table.name)}
+    present |= {tuple(i["column_names"]) for i in insp.get_indexes(table.name) if i.get("unique")}
+    created = []
+    for uc in table.constraints:
+        if not isinstance(uc, UniqueConstraint):
+            continue
+        cols = tuple(c.name for c in uc.columns)
+        if cols in present:
+            continue
+        newest = "created_at DESC, id DESC" if "created_at" in table.c else "id DESC"
+        conn.execute(text(
+            f"DELETE FROM {table.name} WHERE id IN ("
+            f" SELECT id FROM (SELECT id, ROW_NUMBER() OVER ("
+            f"  PARTITION BY {', '.join(cols)} ORDER BY {newest}) AS rn FROM {table.name}) ranked"
+            f" WHERE rn > 1)"
+        ))
+        conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS {uc.name} ON {table.name} ({', '.join(cols)})"))
+        created.append(uc.name)
+    return created
+
+
+def dialect_insert(bind):
+    """insert() du dialecte (SQLite / Postgres) : ON CONFLICT ... DO UPDATE + RETURNING natifs."""
+    if bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
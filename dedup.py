@@ -0,0 +1,267 @@
+# dedup.py
+"""
+Détection des avis quasi-dupliqués (copier-coller sur plusieurs
+établissements, comptes jetables).
+
+- signature MinHash (NUM_PERM valeurs de 16 bits) des 3-grammes de mots du
+  commentaire normalisé (minuscules, sans accents). Les NUM_PERM fonctions de
+  hachage = les NUM_PERM mots de 16 bits d'un blake2b de 64 octets : un seul
+  hash par 3-gramme, minimum colonne par colonne fait en C ;
+- index LSH : BANDS bandes de ROWS valeurs -> deux textes similaires à plus
+  de ~60 % partagent une bande avec une forte probabilité ;
+- structure en mémoire à base de tableaux `array` : signatures réduites à
+  8 bits par valeur ("b-bit minhash", similarité corrigée du biais 1/256),
+  table de hachage chaînée (têtes / contrôle 16 bits / id / suivant) pour les
+  bandes, ~130 octets par avis. Pas d'objet Python par avis ;
+- signatures complètes persistées en base (review_signatures), rechargées au
+  démarrage, calculées hors requête par le pipeline (pipeline.py) et, pour
+  les autres workers, reçues telles quelles par l'événement live
+  "review_signature" (jamais recalculées à l'écriture d'un avis).
+
+Un avis dont la similarité avec un avis existant dépasse DUP_THRESHOLD est
+marqué (reviews.duplicate_of_id / duplicate_similarity) pour modération.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+import zlib
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import LargeBinary, bindparam, text
+from sqlalchemy.orm import Session
+
+from models import Review, ReviewSignature
+
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+SHINGLE_WORDS = 3
+MIN_WORDS = 6             # en dessous : trop court pour conclure ("super", "top")
+DUP_THRESHOLD = float(os.getenv("THENA_DUP_THRESHOLD", "0.75"))
+MAX_CANDIDATES = 200
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_COMBINING_RE = re.compile("[\u0300-\u036f]")  # accents après décomposition NFKD
+_HASH_KEY = b"thena-dedup"  # fixe : les signatures sont persistées
+
+_SAVE_SIGNATURE = text(
+    "INSERT INTO review_signatures (review_id, signature) VALUES (:review_id, :signature)"
+    " ON CONFLICT (review_id) DO UPDATE SET signature = excluded.signature"
+).bindparams(bindparam("signature", type_=LargeBinary))
+
+
+def normalize_words(text: str) -> List[str]:
+    text = text.lower()
+    if not text.isascii():
+        text = _COMBINING_RE.sub("", unicodedata.normalize("NFKD", text))
+    return _WORD_RE.findall(text)
+
+
+def signature(text: Optional[str]) -> Optional[array]:
+    """MinHash du commentaire, None si trop court."""
+    words = normalize_words(text or "")
+    if len(words) < MIN_WORDS:
+        return None
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    rows = [
+        array("H", hashlib.blake2b(sh.encode("utf-8"), digest_size=2 * NUM_PERM, key=_HASH_KEY).digest())
+        for sh in shingles
+    ]
+    return array("H", map(min, zip(*rows)))
+
+
+def band_keys(sig: array) -> List[int]:
+    raw = sig.tobytes()
+    step = ROWS * sig.itemsize
+    return [zlib.crc32(raw[b * step:(b + 1) * step], b) for b in range(BANDS)]
+
+
+def reduce_bits(sig: array) -> array:
+    return array("B", (v & 0xFF for v in sig))
+
+
+def similarity(a: array, b: array) -> float:
+    """Jaccard estimé entre deux signatures 8 bits (égalités fortuites : 1/256)."""
+    equal = sum(1 for x, y in zip(a, b) if x == y) / NUM_PERM
+    return max(0.0, (equal - 1 / 256) / (1 - 1 / 256))
+
+
+class DedupIndex:
+    def __init__(self, capacity: int = 1 << 16):
+        # capacité >= 2^16 : slot (16 bits bas) + contrôle (16 bits hauts) = clé complète
+        capacity = max(capacity, 1 << 16)
+        self._sigs = array("B")          # NUM_PERM valeurs 8 bits par id d'avis
+        self._present = array("B")       # 1 si l'id a une signature à jour
+        self._heads = array("I", bytes(4 * capacity))  # slot -> n° d'entrée + 1
+        self._mask = capacity - 1
+        self._echeck = array("H")        # 16 bits hauts de la clé de bande
+        self._eid = array("I")
+        self._enext = array("I")         # n° d'entrée suivante + 1 (0 = fin)
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.flagged = 0
+
+    # ---------------- structure ----------------
+    def _ensure(self, review_id: int):
+        missing = review_id + 1 - len(self._present)
+        if missing > 0:
+            grow = max(missing, len(self._present) // 2, 1024)
+            self._present.extend(bytes(grow))
+            self._sigs.frombytes(bytes(NUM_PERM * grow))
+
+    def _stored(self, review_id: int) -> Optional[array]:
+        if review_id >= len(self._present) or not self._present[review_id]:
+            return None
+        return self._sigs[review_id * NUM_PERM:(review_id + 1) * NUM_PERM]
+
+    def _rehash(self):
+        # double le nombre de slots ; la clé se reconstruit depuis l'ancien slot et le contrôle
+        old_heads, old_capacity = self._heads, self._mask + 1
+        self._heads = array("I", bytes(8 * old_capacity))
+        self._mask = 2 * old_capacity - 1
+        for slot in range(old_capacity):
+            e = old_heads[slot]
+            while e:
+                nxt = self._enext[e - 1]
+                new_slot = ((self._echeck[e - 1] << 16) | (slot & 0xFFFF)) & self._mask
+                self._enext[e - 1] = self._heads[new_slot]
+                self._heads[new_slot] = e
+                e = nxt
+
+    def _add_entries(self, review_id: int, keys: Iterable[int]):
+        for key in keys:
+            slot = key & self._mask
+            self._echeck.append(key >> 16)
+            self._eid.append(review_id)
+            self._enext.append(self._heads[slot])
+            self._heads[slot] = len(self._eid)
+        if len(self._eid) > 2 * (self._mask + 1):  # chaînes de 2 en moyenne
+            self._rehash()
+
+    def _candidates(self, keys: Iterable[int]) -> set:
+        found = set()
+        for key in keys:
+            check = key >> 16
+            e = self._heads[key & self._mask]
+            while e and len(found) < MAX_CANDIDATES:
+                if self._echeck[e - 1] == check:
+                    found.add(self._eid[e - 1])
+                e = self._enext[e - 1]
+        return found
+
+    # ---------------- API ----------------
+    def add(self, review_id: int, sig: Optional[array]):
+        """(Ré)indexe un avis ; sig=None le retire. Les anciennes entrées de bandes
+        restent dans la table mais sont écartées (signature comparée à la lecture)."""
+        with self._lock:
+            if sig is None:
+                if review_id < len(self._present):
+                    self._present[review_id] = 0
+                return
+            small = reduce_bits(sig)
+            if self._stored(review_id) == small:
+                return  # déjà à jour (événement live de notre propre écriture)
+            self._ensure(review_id)
+            self._sigs[review_id * NUM_PERM:(review_id + 1) * NUM_PERM] = small
+            self._present[review_id] = 1
+            self._add_entries(review_id, band_keys(sig))
+
+    def remove(self, review_id: int):
+        self.add(review_id, None)
+
+    def best_match(self, sig: array, review_id: int) -> Optional[Tuple[int, float]]:
+        """
+        Avis ANTÉRIEUR (id plus petit) le plus similaire au-dessus du seuil, ou
+        None : l'original n'est jamais marqué comme doublon de sa copie.
+        """
+        small = reduce_bits(sig)
+        with self._lock:
+            self.checks += 1
+            best = None
+            for cand in self._candidates(band_keys(sig)):
+                if cand >= review_id:
+                    continue
+                stored = self._stored(cand)
+                if stored is None:
+                    continue
+                sim = similarity(small, stored)
+                if sim >= DUP_THRESHOLD and (best is None or sim > best[1]):
+                    best = (cand, sim)
+            return best
+
+    def load(self, db: Session, batch_size: int = 5000) -> int:
+        """Charge les signatures persistées ; calcule celles qui manquent (par lots)."""
+        loaded = 0
+        for review_id, blob in db.query(ReviewSignature.review_id, ReviewSignature.signature).yield_per(batch_size):
+            if blob:
+                sig = array("H")
+                sig.frombytes(blob)
+                self.add(review_id, sig)
+            loaded += 1
+
+        while True:
+            missing = (
+                db.query(Review.id, Review.comment)
+                .outerjoin(ReviewSignature, ReviewSignature.review_id == Review.id)
+                .filter(ReviewSignature.review_id.is_(None))
+                .limit(batch_size)
+                .all()
+            )
+            if not missing:
+                break
+            for review_id, comment in missing:
+                sig = signature(comment)
+                # signature vide = commentaire trop court, pour ne pas le recalculer
+                db.add(ReviewSignature(review_id=review_id, signature=sig.tobytes() if sig else b""))
+                self.add(review_id, sig)
+            db.commit()
+            loaded += len(missing)
+        return loaded
+
+    def stats(self) -> dict:
+        with self._lock:
+            nbytes = sum(
+                a.itemsize * len(a)
+                for a in (self._sigs, self._present, self._heads, self._echeck, self._eid, self._enext)
+            )
+            return {
+                "indexed": sum(self._present),
+                "band_entries": len(self._eid),
+                "memory_bytes": nbytes,
+                "checks": self.checks,
+                "flagged": self.flagged,
+                "threshold": DUP_THRESHOLD,
+            }
+
+    # ---------------- écriture / événements ----------------
+    def check_review(self, db: Session, review_id: int, sig: Optional[array]) -> Optional[Tuple[int, float]]:
+        """
+        sig = signature du commentaire, calculée par le pipeline : signature
+        persistée, avis indexé ; renvoie (avis d'origine, similarité) s'il
+        duplique un avis existant (colonnes écrites par le pipeline).
+        """
+        match = self.best_match(sig, review_id) if sig is not None else None
+        if match:
+            self.flagged += 1
+        db.execute(_SAVE_SIGNATURE, {"review_id": review_id, "signature": sig.tobytes() if sig else b""})
+        self.add(review_id, sig)
+        return match
+
+    def on_live_event(self, establishment_id: int, message: str):
+        # signatures du pipeline et suppressions (tous workers en backend live "sqlite")
+        try:
+            event = json.loads(message)
+        except ValueError:
+            return
+        if event.get("type") == "review_signature":
+            # calculée par le pipeline (worker élu) : jamais de MinHash dans le thread de la requête
+            self.add(event["review_id"], array("H", event["signature"]))
+        elif event.get("type") == "review_deleted":
+            self.remove(event["review_id"])
+        elif event.get("type") == "reviews_purged":  # suppression de comptes (accounts.py)
+            for review_id in event["review_ids"]:
+                self.remove(review_id)
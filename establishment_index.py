@@ -0,0 +1,210 @@
+# establishment_index.py
+"""
+Index secondaire des établissements :
+- types Google normalisés (table establishment_types) ;
+- agrégats dénormalisés (thena_avg / counts / sort_avg) sur establishments ;
+- listing paginé par curseur : GET /establishments?type=&sort=&after=
+
+Chaque tri correspond à un index composite, la page suivante est une simple
+lecture d'index à partir du curseur (pas d'OFFSET, pas de scan).
+
+Backfill des lignes existantes :
+    python establishment_index.py
+"""
+import base64
+import json
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import bindparam, case, func, tuple_, update
+from sqlalchemy.orm import Session, load_only
+
+from models import Establishment, EstablishmentType, Review
+
+BACKFILL_BATCH = 500
+LIST_SORTS = ("thena_avg", "recent")
+
+
+@lru_cache(maxsize=8192)
+def _parse_types(types_json: str) -> Tuple[str, ...]:
+    try:
+        types = json.loads(types_json)
+    except ValueError:
+        return ()
+    return tuple(t for t in types if isinstance(t, str)) if isinstance(types, list) else ()
+
+
+def parse_types(types_json: Optional[str]) -> List[str]:
+    """types_json -> liste ; le décodage est mis en cache par contenu (pas d'invalidation)."""
+    return list(_parse_types(types_json)) if types_json else []
+
+
+# ---------------- écriture ----------------
+def set_types(db: Session, est: Establishment):
+    """(Ré)écrit les lignes establishment_types de `est` (avant commit)."""
+    db.query(EstablishmentType).filter(EstablishmentType.establishment_id == est.id).delete(
+        synchronize_session=False
+    )
+    db.add_all(
+        EstablishmentType(establishment_id=est.id, type=t[:64], sort_avg=est.sort_avg if est.sort_avg is not None else -1)
+        for t in dict.fromkeys(parse_types(est.types_json))
+    )
+
+
+# avg, count_scored, count_total, score_sum, harassment_count, unpaid_overtime_count
+AGGREGATE_COLUMNS = (
+    func.avg(Review.score),
+    func.count(Review.score),
+    func.count(Review.id),
+    func.sum(Review.score),
+    func.sum(case((Review.harassment, 1), else_=0)),
+    func.sum(case((Review.unpaid_overtime, 1), else_=0)),
+)
+
+
+def _aggregate_values(avg, scored, total, score_sum, harassment, unpaid) -> dict:
+    thena_avg = round(avg, 1) if avg is not None else None
+    return {
+        "thena_avg": thena_avg,
+        "thena_count_scored": scored or 0,
+        "thena_count_total": total or 0,
+        "sort_avg": thena_avg if thena_avg is not None else -1,
+        "score_sum": score_sum or 0,
+        "harassment_count": harassment or 0,
+        "unpaid_overtime_count": unpaid or 0,
+    }
+
+
+def refresh_aggregates(db: Session, est_id: int):
+    """Recalcule les agrégats d'un établissement dans la transaction en cours."""
+    values = _aggregate_values(
+        *db.query(*AGGREGATE_COLUMNS).filter(Review.establishment_id == est_id).one()
+    )
+    db.query(Establishment).filter(Establishment.id == est_id).update(values, synchronize_session=False)
+    db.query(EstablishmentType).filter(EstablishmentType.establishment_id == est_id).update(
+        {EstablishmentType.sort_avg: values["sort_avg"]}, synchronize_session=False
+    )
+
+
+# executemany : une ligne de paramètres par établissement (les clés sans "b_" sont les colonnes SET)
+_UPDATE_AGGREGATES = update(Establishment.__table__).where(Establishment.__table__.c.id == bindparam("b_id"))
+_UPDATE_TYPES_SORT = update(EstablishmentType.__table__).where(
+    EstablishmentType.__table__.c.establishment_id == bindparam("b_id")
+)
+
+
+def refresh_aggregates_many(db: Session, est_ids: Iterable[int]) -> Dict[int, dict]:
+    """
+    Idem pour un lot d'établissements (purge de comptes) : une requête GROUP BY
+    puis deux UPDATE en executemany. Renvoie {id: valeurs écrites}.
+    """
+    est_ids = sorted(set(est_ids))
+    if not est_ids:
+        return {}
+    found = {
+        row[0]: row[1:]
+        for row in db.query(Review.establishment_id, *AGGREGATE_COLUMNS)
+        .filter(Review.establishment_id.in_(est_ids))
+        .group_by(Review.establishment_id)
+    }
+    # plus aucun avis : pas de ligne dans le GROUP BY
+    values = {est_id: _aggregate_values(*found.get(est_id, (None, 0, 0, None, 0, 0))) for est_id in est_ids}
+    db.execute(_UPDATE_AGGREGATES, [{"b_id": est_id, **v} for est_id, v in values.items()])
+    db.execute(_UPDATE_TYPES_SORT, [{"b_id": est_id, "sort_avg": v["sort_avg"]} for est_id, v in values.items()])
+    return values
+
+
+def backfill(session_factory, aggregates: bool = False, batch_size: int = BACKFILL_BATCH) -> int:
+    """
+    Remplit establishment_types pour les établissements qui n'en ont pas encore
+    (et recalcule les agrégats de tous si `aggregates`). Par lots, une
+    transaction par lot : jamais de long verrou d'écriture.
+    """
+    done = 0
+    last_id = 0
+    while True:
+        db = session_factory()
+        try:
+            q = db.query(Establishment).filter(Establishment.id > last_id)
+            if not aggregates:
+                has_types = db.query(EstablishmentType.establishment_id).filter(
+                    EstablishmentType.establishment_id == Establishment.id
+                ).exists()
+                q = q.filter(Establishment.types_json.isnot(None), ~has_types)
+            batch = q.order_by(Establishment.id).limit(batch_size).all()
+            if not batch:
+                return done
+            for est in batch:
+                if aggregates:
+                    refresh_aggregates(db, est.id)
+                    db.refresh(est)
+                set_types(db, est)
+            db.commit()
+            done += len(batch)
+            last_id = batch[-1].id
+        finally:
+            db.close()
+
+
+# ---------------- lecture ----------------
+def encode_cursor(sort_key: float, est_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{sort_key!r}:{est_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    sort_key, est_id = raw.split(":")
+    return float(sort_key), int(est_id)
+
+
+def list_establishments(
+    db: Session,
+    type_: Optional[str] = None,
+    sort: str = "thena_avg",
+    after: Optional[str] = None,
+    limit: int = 20,
+    columns: Optional[Sequence] = None,
+) -> Tuple[List[Establishment], Optional[str]]:
+    """
+    sort="thena_avg" : meilleure note d'abord (sans note en dernier), puis id desc
+    sort="recent"    : plus récents d'abord (id desc)
+    columns          : colonnes à charger (load_only, ?fields=) ; None = toutes
+    """
+    if type_:
+        q = (
+            db.query(Establishment)
+            .join(EstablishmentType, EstablishmentType.establishment_id == Establishment.id)
+            .filter(EstablishmentType.type == type_)
+        )
+        sort_col, id_col = EstablishmentType.sort_avg, EstablishmentType.establishment_id
+    else:
+        q = db.query(Establishment)
+        sort_col, id_col = Establishment.sort_avg, Establishment.id
+
+    if sort == "thena_avg":
+        if after:
+            key, last_id = decode_cursor(after)
+            q = q.filter(tuple_(sort_col, id_col) < tuple_(key, last_id))
+        q = q.order_by(sort_col.desc(), id_col.desc())
+    else:
+        if after:
+            _, last_id = decode_cursor(after)
+            q = q.filter(id_col < last_id)
+        q = q.order_by(id_col.desc())
+
+    if columns is not None:
+        q = q.options(load_only(*columns, Establishment.sort_avg))  # sort_avg : curseur
+    rows = q.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.sort_avg if sort == "thena_avg" else 0.0, last.id)
+    return rows, next_cursor
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    n = backfill(SessionLocal, aggregates=True)
+    print("establishments backfilled:", n)
@@ -0,0 +1,320 @@
+# eventlog.py
+"""
+Journal d'événements structuré (JSONL) : requêtes HTTP, appels Google,
+authentification, écritures d'avis.
+
+- emit() ajoute seulement un tuple à une file en mémoire bornée
+  (EVENTLOG_QUEUE) : ni E/S, ni verrou, ni sérialisation sur le chemin de la
+  requête. File pleine -> l'événement est jeté et compté (`dropped`), la
+  requête n'attend jamais le disque ;
+- un thread d'écriture vide la file toutes les EVENTLOG_FLUSH_SECONDS (plus
+  tôt si EVENTLOG_BATCH événements attendent) : sérialisation JSON puis un
+  seul write() par lot ;
+- un fichier par process (events-<horodatage>-<pid>.jsonl : pas de lignes
+  entrelacées entre workers), rotation par taille (EVENTLOG_MAX_MB) et par
+  âge (EVENTLOG_ROTATE_HOURS), fichiers plus vieux que EVENTLOG_KEEP_DAYS
+  supprimés.
+
+Chaque ligne : {"ts": "...Z", "event": "request" | "google" | "auth.*" | "review.*", ...}.
+
+Percentiles de latence par route, hors ligne :
+    python eventlog.py                         # tous les fichiers de EVENTLOG_DIR
+    python eventlog.py logs/events-2026*.jsonl --since 2026-10-01 --event google
+"""
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+EVENTLOG_ENABLED = os.getenv("THENA_EVENTLOG", "1") != "0"
+EVENTLOG_DIR = os.getenv("THENA_EVENTLOG_DIR", "./logs")
+EVENTLOG_QUEUE = int(os.getenv("THENA_EVENTLOG_QUEUE", "20000"))
+EVENTLOG_BATCH = int(os.getenv("THENA_EVENTLOG_BATCH", "1000"))
+EVENTLOG_FLUSH_SECONDS = float(os.getenv("THENA_EVENTLOG_FLUSH_SECONDS", "1"))
+EVENTLOG_MAX_MB = float(os.getenv("THENA_EVENTLOG_MAX_MB", "64"))
+EVENTLOG_ROTATE_HOURS = float(os.getenv("THENA_EVENTLOG_ROTATE_HOURS", "24"))
+EVENTLOG_KEEP_DAYS = float(os.getenv("THENA_EVENTLOG_KEEP_DAYS", "14"))
+_PREFIX = "events-"
+
+
+class EventLog:
+    def __init__(self, directory: str = EVENTLOG_DIR, queue_size: int = EVENTLOG_QUEUE,
+                 batch: int = EVENTLOG_BATCH, flush_seconds: float = EVENTLOG_FLUSH_SECONDS,
+                 max_bytes: int = int(EVENTLOG_MAX_MB * 1024 * 1024),
+                 rotate_seconds: float = EVENTLOG_ROTATE_HOURS * 3600,
+                 keep_seconds: float = EVENTLOG_KEEP_DAYS * 86400, enabled: bool = EVENTLOG_ENABLED):
+        self.directory = directory
+        self.queue_size = queue_size
+        self.batch = batch
+        self.flush_seconds = flush_seconds
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.keep_seconds = keep_seconds
+        self.enabled = enabled
+        # deque.append / popleft sont atomiques (GIL) : pas de verrou côté requêtes ;
+        # la borne est vérifiée sans verrou (dépassement possible de quelques éléments)
+        self._queue: deque = deque()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._write_lock = threading.Lock()
+        self._drop_lock = threading.Lock()  # chemin rare (file pleine)
+        self._file = None
+        self._path: Optional[str] = None
+        self._opened_at = 0.0
+        self._size = 0
+        self.counters = {"dropped": 0, "written": 0, "batches": 0,
+                         "bytes": 0, "rotations": 0, "write_errors": 0}
+
+    # ---------------- côté requêtes ----------------
+    def emit(self, event: str, **fields):
+        if not self.enabled:
+            return
+        queue = self._queue
+        if len(queue) >= self.queue_size:
+            with self._drop_lock:
+                self.counters["dropped"] += 1
+            return
+        queue.append((time.time(), event, fields))
+        if len(queue) >= self.batch and not self._wake.is_set():
+            self._wake.set()
+
+    # ---------------- écriture ----------------
+    def start(self):
+        if self._thread is not None or not self.enabled:
+            return
+        self._stop.clear()
+        self.prune()
+        self._thread = threading.Thread(target=self._run, name="thena-eventlog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+        with self._write_lock:
+            self._close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """Écrit tout ce qui attend (thread d'écriture, ou arrêt)."""
+        with self._write_lock:
+            queue = self._queue
+            n = len(queue)
+            if not n:
+                self._maybe_rotate()
+                return 0
+            data = _serialize(queue.popleft() for _ in range(n))
+            try:
+                self._maybe_rotate()
+                if self._file is None:
+                    self._open()
+                self._file.write(data)
+                self._file.flush()
+            except OSError as e:
+                self.counters["write_errors"] += 1
+                with self._drop_lock:
+                    self.counters["dropped"] += n
+                if self.counters["write_errors"] == 1:
+                    print("EVENTLOG: write failed:", repr(e))
+                self._close()
+                return 0
+            self._size += len(data)
+            self.counters["written"] += n
+            self.counters["batches"] += 1
+            self.counters["bytes"] += len(data)
+            return n
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        # n° de rotation : deux rotations dans la même seconde -> deux fichiers
+        name = f"{_PREFIX}{stamp}-{os.getpid()}-{self.counters['rotations']}.jsonl"
+        self._path = os.path.join(self.directory, name)
+        self._file = open(self._path, "ab")
+        self._size = self._file.tell()
+        self._opened_at = time.time()
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+        self._file = None
+
+    def _maybe_rotate(self):
+        if self._file is None:
+            return
+        if self._size < self.max_bytes and time.time() - self._opened_at < self.rotate_seconds:
+            return
+        self._close()
+        self.counters["rotations"] += 1
+        self.prune()
+
+    def prune(self):
+        # par âge : les fichiers ouverts des autres workers sont récents
+        limit = time.time() - self.keep_seconds
+        for path in list_files(self.directory):
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        with self._drop_lock:
+            out = dict(self.counters)
+        out.update({"queued": len(self._queue), "queue_size": self.queue_size, "file": self._path})
+        return out
+
+
+log = EventLog()
+emit = log.emit
+
+# un seul encodeur (json.dumps avec options en recrée un à chaque appel)
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=str).encode
+
+
+def _serialize(events: Iterable[tuple]) -> bytes:
+    lines = []
+    second, prefix = None, ""
+    for ts, event, fields in events:
+        if int(ts) != second:  # horodatage formaté une fois par seconde
+            second = int(ts)
+            prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+        lines.append(_encode({"ts": f"{prefix}.{int((ts - second) * 1000):03d}Z", "event": event, **fields}))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def list_files(directory: str = EVENTLOG_DIR) -> List[str]:
+    return sorted(glob.glob(os.path.join(directory, f"{_PREFIX}*.jsonl")))
+
+
+# ---------------- middleware (journal des requêtes) ----------------
+def route_of(scope: Scope) -> str:
+    """Gabarit de route ("/establishments/{est_id}") plutôt que le chemin : cardinalité bornée."""
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    if scope.get("endpoint") is not None:  # app montée (StaticFiles)
+        return scope.get("root_path", "") + "/{path}"
+    return "<unmatched>"
+
+
+class AccessLogMiddleware:
+    """Un événement "request" par requête HTTP : route, statut, durée, octets envoyés."""
+
+    def __init__(self, app: ASGIApp, eventlog: EventLog = log):
+        self.app = app
+        self.eventlog = eventlog
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self.eventlog.enabled:
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        state = {"status": 500, "bytes": 0}
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                state["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.eventlog.emit(
+                "request",
+                method=scope["method"],
+                route=route_of(scope),
+                path=scope["path"],
+                status=state["status"],
+                ms=round((time.perf_counter() - started) * 1000, 2),
+                bytes=state["bytes"],
+            )
+
+
+# ---------------- rapport hors ligne ----------------
+def percentile(sorted_values: List[float], p: float) -> float:
+    # rang le plus proche, comme places.LatencyTracker
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def read_events(paths: Iterable[str], event: str = "request", since: Optional[str] = None):
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # ligne tronquée (arrêt brutal)
+                if record.get("event") != event or (since and record.get("ts", "") < since):
+                    continue
+                yield record
+
+
+def latency_report(paths: Iterable[str], event: str = "request", since: Optional[str] = None) -> List[dict]:
+    """p50 / p95 / p99 / max par route ("request") ou par endpoint ("google")."""
+    samples: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    for record in read_events(paths, event, since):
+        if event == "request":
+            key = f"{record.get('method')} {record.get('route')}"
+            failed = record.get("status", 0) >= 500
+        else:
+            key = str(record.get("endpoint") or record.get("route"))
+            failed = record.get("outcome", "ok") != "ok"
+        if record.get("ms") is None:
+            continue
+        samples.setdefault(key, []).append(record["ms"])
+        errors[key] = errors.get(key, 0) + int(failed)
+    out = []
+    for key, values in samples.items():
+        values.sort()
+        out.append({
+            "route": key,
+            "count": len(values),
+            "errors": errors[key],
+            "p50": percentile(values, 0.50),
+            "p95": percentile(values, 0.95),
+            "p99": percentile(values, 0.99),
+            "max": values[-1],
+        })
+    out.sort(key=lambda r: r["count"], reverse=True)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="THENA event log: latency percentiles per route")
+    parser.add_argument("files", nargs="*", help=f"fichiers JSONL (défaut : {EVENTLOG_DIR}/{_PREFIX}*.jsonl)")
+    parser.add_argument("--event", default="request", help="request (par route) ou google (par endpoint)")
+    parser.add_argument("--since", help="horodatage ISO minimal, ex. 2026-10-01 ou 2026-10-01T12:00")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    rows = latency_report(args.files or list_files(), args.event, args.since)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print(f"{'route':<48} {'count':>8} {'err':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+        for r in rows:
+            print(f"{r['route'][:48]:<48} {r['count']:>8} {r['errors']:>6} "
+                  f"{r['p50']:>9.2f} {r['p95']:>9.2f} {r['p99']:>9.2f} {r['max']:>9.2f}")
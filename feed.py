@@ -0,0 +1,332 @@
+# feed.py
+"""
+Fil global "derniers avis" : GET /feed?after=<curseur>
+
+Les N avis les plus récents sont gardés en mémoire dans un ring buffer
+compact (tableaux `array` parallèles + extrait UTF-8 du commentaire ; noms
+d'établissement et pseudos dédoublonnés dans deux petits dicts) : 50k avis
+tiennent en quelques Mo. Le buffer est rempli au démarrage puis tenu à jour
+par les événements live (review_upserted / review_deleted / reviews_purged) : en backend
+"sqlite", les écritures des autres workers arrivent aussi.
+
+Au-delà du buffer : requête keyset sur l'index (created_at, id) de reviews.
+Curseur = (created_at en microsecondes, id).
+"""
+import base64
+import json
+import os
+import threading
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Session
+
+from models import Establishment, Review, User
+
+FEED_SIZE = int(os.getenv("THENA_FEED_SIZE", "50000"))
+FEED_EXCERPT_CHARS = 80
+FEED_PURGE_COMPACT = 1024  # suppressions en lot mises de côté avant un passage d'effacement
+
+_EPOCH = datetime(1970, 1, 1)
+FLAGS = ("coupure", "unpaid_overtime", "toxic_manager", "harassment", "recommend")
+
+
+def to_micros(dt: datetime) -> int:
+    return (dt - _EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(us: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=us)
+
+
+def excerpt(comment: Optional[str]) -> str:
+    comment = " ".join((comment or "").split())
+    if len(comment) <= FEED_EXCERPT_CHARS:
+        return comment
+    return comment[:FEED_EXCERPT_CHARS - 1].rstrip() + "…"
+
+
+def encode_cursor(created_us: int, review_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_us}:{review_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, int]:
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    created_us, review_id = raw.split(":")
+    return int(created_us), int(review_id)
+
+
+def _flags_mask(values: dict) -> int:
+    return sum(1 << i for i, name in enumerate(FLAGS) if values.get(name))
+
+
+class FeedBuffer:
+    """
+    Ring buffer des avis les plus récents, du plus ancien (tail) au plus
+    récent (head - 1). Un slot supprimé garde review_id = 0 et est sauté.
+    """
+
+    def __init__(self, capacity: int = FEED_SIZE):
+        self.capacity = capacity
+        self._ids = array("q", bytes(8 * capacity))
+        self._created = array("q", bytes(8 * capacity))
+        self._est_ids = array("i", bytes(4 * capacity))
+        self._user_ids = array("i", bytes(4 * capacity))
+        self._scores = array("h", bytes(2 * capacity))  # score * 10, -1 = pas de note
+        self._flags = array("B", bytes(capacity))
+        self._excerpts: List[bytes] = [b""] * capacity
+        self._est_names: Dict[int, str] = {}
+        self._pseudos: Dict[int, str] = {}
+
+        self._head = 0      # prochain slot écrit
+        self._count = 0     # slots occupés (supprimés compris)
+        self._max_id = 0    # ids auto-incrémentés : id > _max_id -> nouvel avis, pas de recherche
+        self._purged: Set[int] = set()  # supprimés en lot, pas encore effacés (voir remove_many)
+        # True tant que le buffer contient TOUS les avis (jamais rien évincé)
+        self.complete = True
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.fallbacks = 0
+
+    # ---------------- écriture ----------------
+    def _put(self, review_id, created_us, est_id, est_name, user_id, pseudo, score, flags, text):
+        i = self._head
+        if self._count == self.capacity:
+            self.complete = False
+        else:
+            self._count += 1
+        self._ids[i] = review_id
+        self._created[i] = created_us
+        self._est_ids[i] = est_id
+        self._user_ids[i] = user_id
+        self._scores[i] = -1 if score is None else int(round(score * 10))
+        self._flags[i] = flags
+        self._excerpts[i] = excerpt(text).encode("utf-8")
+        self._est_names[est_id] = est_name
+        self._pseudos[user_id] = pseudo
+        self._max_id = max(self._max_id, review_id)
+        self._head = (i + 1) % self.capacity
+
+    def _slot(self, review_id: int) -> int:
+        try:
+            return self._ids.index(review_id)  # parcours linéaire (~1 ms pour 50k) : éditions / suppressions
+        except ValueError:
+            return -1
+
+    def upsert(self, review_id, created_at, est_id, est_name, user_id, pseudo, score, flags, text):
+        with self._lock:
+            if review_id in self._purged:
+                self._compact()  # id réutilisé : l'ancien slot ne doit pas passer pour une édition
+            i = self._slot(review_id) if review_id <= self._max_id else -1
+            if i >= 0:
+                # édition : même position (created_at ne change pas)
+                self._scores[i] = -1 if score is None else int(round(score * 10))
+                self._flags[i] = flags
+                self._excerpts[i] = excerpt(text).encode("utf-8")
+                self._est_names[est_id] = est_name
+                self._pseudos[user_id] = pseudo
+                return
+            created_us = to_micros(created_at)
+            if not self.complete and self._count and created_us < self._created[self._tail()]:
+                return  # plus ancien que tout le buffer : servi par la requête keyset
+            self._put(review_id, created_us, est_id, est_name, user_id, pseudo, score, flags, text)
+            self._prune_names()
+
+    def remove(self, review_id: int):
+        with self._lock:
+            i = self._slot(review_id)
+            if i >= 0:
+                self._ids[i] = 0
+                self._excerpts[i] = b""
+
+    def remove_many(self, review_ids: Iterable[int]):
+        # purge de comptes : des milliers d'ids, pas un parcours linéaire chacun ; mis de
+        # côté (sautés par page()) puis effacés ensemble en un seul passage
+        with self._lock:
+            self._purged.update(review_ids)
+            if len(self._purged) >= FEED_PURGE_COMPACT:
+                self._compact()
+
+    def _compact(self):
+        purged, ids = self._purged, self._ids
+        if not purged:
+            return
+        for i, review_id in enumerate(ids):
+            if review_id in purged:
+                ids[i] = 0
+                self._excerpts[i] = b""
+        purged.clear()
+
+    def _tail(self) -> int:
+        return (self._head - self._count) % self.capacity
+
+    def _prune_names(self):
+        # les dicts de noms ne gardent que les ids encore présents dans le buffer
+        if len(self._est_names) + len(self._pseudos) <= 2 * self.capacity + 1024:
+            return
+        live = [i for i in range(self.capacity) if self._ids[i]]
+        est_ids = {self._est_ids[i] for i in live}
+        user_ids = {self._user_ids[i] for i in live}
+        self._est_names = {k: v for k, v in self._est_names.items() if k in est_ids}
+        self._pseudos = {k: v for k, v in self._pseudos.items() if k in user_ids}
+
+    def fill(self, db: Session):
+        """(Re)charge les N avis les plus récents (une seule requête, colonnes seules)."""
+        rows = (
+            _feed_query(db)
+            .order_by(Review.created_at.desc(), Review.id.desc())
+            .limit(self.capacity)
+            .all()
+        )
+        with self._lock:
+            self._head = 0
+            self._count = 0
+            self._max_id = 0
+            self._purged.clear()
+            self._est_names = {}
+            self._pseudos = {}
+            for row in reversed(rows):
+                self._put(
+                    row.id, to_micros(row.created_at), row.establishment_id, row.establishment_name,
+                    row.user_id, row.user_pseudo, row.score, _flags_mask(row._mapping), row.comment,
+                )
+            self.complete = len(rows) < self.capacity
+
+    # ---------------- lecture ----------------
+    def _item(self, i: int) -> dict:
+        score = self._scores[i]
+        flags = self._flags[i]
+        item = {
+            "review_id": self._ids[i],
+            "establishment_id": self._est_ids[i],
+            "establishment_name": self._est_names.get(self._est_ids[i], ""),
+            "user_pseudo": self._pseudos.get(self._user_ids[i], "Anon"),
+            "score": None if score < 0 else score / 10,
+            "excerpt": self._excerpts[i].decode("utf-8"),
+            "created_at": from_micros(self._created[i]),
+        }
+        for bit, name in enumerate(FLAGS):
+            item[name] = bool(flags & (1 << bit))
+        return item
+
+    def page(self, after: Optional[Tuple[int, int]], limit: int) -> Tuple[List[dict], bool]:
+        """
+        Jusqu'à limit + 1 éléments plus anciens que `after`, du plus récent au
+        plus ancien. Renvoie (items, exhaustive) : exhaustive = rien d'autre en
+        base au-delà de ces éléments.
+        """
+        items = []
+        with self._lock:
+            tail = self._tail()
+            start = self._count
+            if after is not None:
+                # slots dans l'ordre d'arrivée ~ ordre (created_at, id) : recherche binaire
+                lo, hi = 0, self._count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if self._created[(tail + mid) % self.capacity] <= after[0]:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                start = lo
+            for k in range(start - 1, -1, -1):
+                i = (tail + k) % self.capacity
+                if not self._ids[i] or self._ids[i] in self._purged:
+                    continue
+                if after is not None and (self._created[i], self._ids[i]) >= after:
+                    continue
+                items.append(self._item(i))
+                if len(items) > limit:
+                    break
+            return items, self.complete
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._compact()
+            live = sum(1 for i in range(self._count) if self._ids[(self._head - 1 - i) % self.capacity])
+            nbytes = sum(
+                a.itemsize * len(a)
+                for a in (self._ids, self._created, self._est_ids, self._user_ids, self._scores, self._flags)
+            ) + sum(len(e) for e in self._excerpts)
+            return {
+                "capacity": self.capacity,
+                "size": live,
+                "complete": self.complete,
+                "payload_bytes": nbytes,
+                "hits": self.hits,
+                "fallbacks": self.fallbacks,
+            }
+
+    # ---------------- événements live ----------------
+    def on_live_event(self, establishment_id: int, message: str):
+        # listener de live.hub : appelé pour chaque événement publié (tous workers en backend sqlite)
+        try:
+            event = json.loads(message)
+        except ValueError:
+            return
+        if event.get("type") == "review_upserted":
+            r = event["review"]
+            self.upsert(
+                r["id"], datetime.fromisoformat(r["created_at"]), r["establishment_id"],
+                event.get("establishment_name") or "", r["user_id"], r["user_pseudo"],
+                r.get("score"), _flags_mask(r), r.get("comment"),
+            )
+        elif event.get("type") == "review_deleted":
+            self.remove(event["review_id"])
+        elif event.get("type") == "reviews_purged":  # suppression de comptes (accounts.py)
+            self.remove_many(event["review_ids"])
+
+
+def _feed_query(db: Session):
+    return (
+        db.query(
+            Review.id, Review.created_at, Review.establishment_id, Review.user_id, Review.score,
+            Review.comment, Review.coupure, Review.unpaid_overtime, Review.toxic_manager,
+            Review.harassment, Review.recommend,
+            Establishment.name.label("establishment_name"), User.pseudo.label("user_pseudo"),
+        )
+        .join(Establishment, Establishment.id == Review.establishment_id)
+        .join(User, User.id == Review.user_id)
+    )
+
+
+def query_page(db: Session, after: Optional[Tuple[int, int]], limit: int) -> List[dict]:
+    """Hors buffer : keyset sur ix_reviews_created (created_at desc, id desc)."""
+    q = _feed_query(db)
+    if after is not None:
+        q = q.filter(tuple_(Review.created_at, Review.id) < tuple_(from_micros(after[0]), after[1]))
+    rows = q.order_by(Review.created_at.desc(), Review.id.desc()).limit(limit + 1).all()
+    return [
+        {
+            "review_id": row.id,
+            "establishment_id": row.establishment_id,
+            "establishment_name": row.establishment_name,
+            "user_pseudo": row.user_pseudo,
+            "score": row.score,
+            "excerpt": excerpt(row.comment),
+            "created_at": row.created_at,
+            **{name: bool(getattr(row, name)) for name in FLAGS},
+        }
+        for row in rows
+    ]
+
+
+def latest(db: Session, buffer: FeedBuffer, after: Optional[str] = None, limit: int = 20) -> Tuple[List[dict], Optional[str]]:
+    """Page du fil : buffer d'abord, requête keyset pour ce qui dépasse."""
+    cursor = decode_cursor(after) if after else None
+    items, exhaustive = buffer.page(cursor, limit)
+    if len(items) > limit or exhaustive:
+        buffer.hits += 1
+    else:
+        buffer.fallbacks += 1
+        last = (to_micros(items[-1]["created_at"]), items[-1]["review_id"]) if items else cursor
+        items += query_page(db, last, limit - len(items))
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(to_micros(items[-1]["created_at"]), items[-1]["review_id"])
+    return items, next_cursor
@@ -0,0 +1,284 @@
+# fieldsets.py
+"""
+Réponses partielles sur les fiches et listes d'établissements :
+
+    GET /establishments/12?view=summary               # en-tête + agrégats, sans avis
+    GET /establishments/12?fields=establishment.name,thena_avg,reviews.score,reviews.created_at
+    GET /establishments?view=summary                  # badges : id, nom, note, nb d'avis
+    GET /establishments/near?lat=..&lng=..&fields=id,name,distance_km
+    POST /establishments/batch?view=summary
+
+- fields= (liste séparée par des virgules) prime sur view= ; view=full ou
+  rien -> représentation complète habituelle (snapshots compris) ;
+- fiche : "establishment" / "reviews" = tous leurs champs, "establishment.x" /
+  "reviews.x" = un champ ; "id" toujours inclus ;
+- avis non demandés -> aucune requête sur reviews ; sinon seules les colonnes
+  demandées sont lues (jointure users seulement pour user_pseudo) ;
+- pour chaque jeu de champs, requêtes select() et sérialiseur (liste de
+  (clé, getter)) construits une fois puis mis en cache (lru_cache) ; la
+  réponse est encodée directement, sans modèle pydantic.
+
+Champ inconnu -> ValueError (400 côté handler).
+"""
+import json
+from datetime import datetime
+from functools import lru_cache
+from operator import attrgetter
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.orm import Session
+
+from establishment_index import parse_types
+from models import Establishment, Review, User
+
+VIEWS = ("summary", "full")
+
+Getter = Callable[[object], object]
+
+
+def _iso(name: str) -> Getter:
+    get = attrgetter(name)
+    return lambda o: _isoformat(get(o))
+
+
+def _isoformat(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def _or_zero(name: str) -> Getter:
+    get = attrgetter(name)
+    return lambda o: get(o) or 0
+
+
+def _column(model, name: str) -> Tuple[tuple, Getter]:
+    return (getattr(model, name),), attrgetter(name)
+
+
+# champ exposé -> (colonnes à lire, getter sur la ligne) ; ordre = ordre des schémas
+ESTABLISHMENT: Dict[str, Tuple[tuple, Getter]] = {
+    "id": _column(Establishment, "id"),
+    "google_place_id": _column(Establishment, "google_place_id"),
+    "name": _column(Establishment, "name"),
+    "address": _column(Establishment, "address"),
+    "google_rating": _column(Establishment, "google_rating"),
+    "types": ((Establishment.types_json,), lambda o: parse_types(o.types_json)),
+    "lat": _column(Establishment, "lat"),
+    "lng": _column(Establishment, "lng"),
+    "created_at": ((Establishment.created_at,), _iso("created_at")),
+}
+
+AGGREGATES: Dict[str, Tuple[tuple, Getter]] = {
+    "thena_avg": _column(Establishment, "thena_avg"),
+    "thena_count_scored": _column(Establishment, "thena_count_scored"),
+    "thena_count_total": _column(Establishment, "thena_count_total"),
+    "version": ((Establishment.version,), _or_zero("version")),
+}
+
+REVIEW: Dict[str, Tuple[tuple, Getter]] = {
+    "id": _column(Review, "id"),
+    "establishment_id": _column(Review, "establishment_id"),
+    "user_id": _column(Review, "user_id"),
+    "user_pseudo": ((User.pseudo.label("user_pseudo"),), lambda r: r.user_pseudo or "Anon"),
+    "score": _column(Review, "score"),
+    "comment": _column(Review, "comment"),
+    "role": _column(Review, "role"),
+    "contract": _column(Review, "contract"),
+    "housing": _column(Review, "housing"),
+    "housing_quality": _column(Review, "housing_quality"),
+    "coupure": _column(Review, "coupure"),
+    "unpaid_overtime": _column(Review, "unpaid_overtime"),
+    "toxic_manager": _column(Review, "toxic_manager"),
+    "harassment": _column(Review, "harassment"),
+    "recommend": _column(Review, "recommend"),
+    "version": ((Review.version,), _or_zero("version")),
+    "created_at": ((Review.created_at,), _iso("created_at")),
+}
+
+# items de liste (EstablishmentSummary / EstablishmentNear)
+LIST: Dict[str, Tuple[tuple, Getter]] = {
+    **{k: ESTABLISHMENT[k] for k in ("id", "google_place_id", "name", "address", "google_rating", "types")},
+    "thena_avg": AGGREGATES["thena_avg"],
+    "thena_count_total": AGGREGATES["thena_count_total"],
+    "lat": ESTABLISHMENT["lat"],
+    "lng": ESTABLISHMENT["lng"],
+}
+LIST_FIELDS = tuple(LIST)
+NEAR_FIELDS = LIST_FIELDS + ("distance_km",)
+
+DETAIL_FIELDS = (
+    tuple(f"establishment.{k}" for k in ESTABLISHMENT)
+    + tuple(AGGREGATES)
+    + tuple(f"reviews.{k}" for k in REVIEW)
+)
+DETAIL_SUMMARY = (
+    tuple(f"establishment.{k}" for k in ("id", "google_place_id", "name", "address", "google_rating", "types"))
+    + tuple(AGGREGATES)
+)
+LIST_SUMMARY = ("id", "name", "thena_avg", "thena_count_total")
+NEAR_SUMMARY = LIST_SUMMARY + ("distance_km",)
+
+# json.dumps avec options recrée un encodeur à chaque appel ; mêmes options que JSONResponse
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+
+def encode(payload) -> bytes:
+    return _encode(payload).encode("utf-8")
+
+
+def parse(fields: Optional[str], view: Optional[str], vocabulary: Sequence[str],
+          summary: Sequence[str], always: Sequence[str] = ("id",)) -> Optional[Tuple[str, ...]]:
+    """
+    Jeu de champs canonique (ordre du vocabulaire, clé des caches), ou None
+    pour la représentation complète. "x" développe tous les "x.*".
+    """
+    if fields is None:
+        if view is None or view == "full":
+            return None
+        if view != "summary":
+            raise ValueError(f"Unknown view: {view} (expected one of {', '.join(VIEWS)})")
+        return tuple(summary)
+
+    wanted = set(always)
+    for name in (f.strip() for f in fields.split(",")):
+        if not name:
+            continue
+        expanded = [v for v in vocabulary if v == name or v.startswith(name + ".")]
+        if not expanded:
+            raise ValueError(f"Unknown field: {name}")
+        wanted.update(expanded)
+    return tuple(v for v in vocabulary if v in wanted)
+
+
+def _serializer(spec: Dict[str, Tuple[tuple, Getter]], names: Iterable[str]) -> Callable[[object], dict]:
+    getters = tuple((name, spec[name][1]) for name in names)
+
+    def serialize(row) -> dict:
+        return {name: get(row) for name, get in getters}
+
+    return serialize
+
+
+def _columns(spec: Dict[str, Tuple[tuple, Getter]], names: Iterable[str]) -> List:
+    out = []
+    for name in names:
+        for col in spec[name][0]:
+            if not any(col is c for c in out):
+                out.append(col)
+    return out
+
+
+# ---------------- fiche (GET /establishments/{id}, /by_google/{gid}, batch) ----------------
+class _DetailPlan:
+    __slots__ = ("establishment", "aggregates", "reviews", "est_columns",
+                 "one", "many", "reviews_one", "reviews_many")
+
+    def __init__(self, selected: Tuple[str, ...]):
+        est = [f.split(".", 1)[1] for f in selected if f.startswith("establishment.")]
+        aggregates = [f for f in selected if f in AGGREGATES]
+        reviews = [f.split(".", 1)[1] for f in selected if f.startswith("reviews.")]
+
+        self.establishment = _serializer(ESTABLISHMENT, est) if est else None
+        self.aggregates = _serializer(AGGREGATES, aggregates)
+        self.reviews = _serializer(REVIEW, reviews) if reviews else None
+
+        # id + google_place_id toujours lus : clés de la réponse batch (missing_*)
+        self.est_columns = _columns(ESTABLISHMENT, ["id", "google_place_id", *est]) + _columns(AGGREGATES, aggregates)
+        self.one = select(*self.est_columns).where(Establishment.id == bindparam("est_id"))
+        self.many = select(*self.est_columns).where(
+            Establishment.id.in_(bindparam("ids", expanding=True))
+            | Establishment.google_place_id.in_(bindparam("gids", expanding=True))
+        )
+
+        self.reviews_one = self.reviews_many = None
+        if reviews:
+            cols = _columns(REVIEW, reviews)
+            join_user = "user_pseudo" in reviews
+            stmt = select(*cols).where(Review.establishment_id == bindparam("est_id"))
+            if join_user:
+                stmt = stmt.outerjoin(User, User.id == Review.user_id)
+            self.reviews_one = stmt.order_by(Review.created_at.desc())
+
+            ranked = (
+                select(
+                    Review.id.label("id"),
+                    func.row_number().over(
+                        partition_by=Review.establishment_id,
+                        order_by=(Review.created_at.desc(), Review.id.desc()),
+                    ).label("rn"),
+                )
+                .where(Review.establishment_id.in_(bindparam("est_ids", expanding=True)))
+                .subquery()
+            )
+            stmt = (
+                select(Review.establishment_id.label("batch_est_id"), *cols)
+                .join(ranked, ranked.c.id == Review.id)
+                .where(ranked.c.rn <= bindparam("limit"))
+            )
+            if join_user:
+                stmt = stmt.outerjoin(User, User.id == Review.user_id)
+            self.reviews_many = stmt.order_by(Review.establishment_id, ranked.c.rn)
+
+    def bundle(self, row, reviews: Optional[list]) -> dict:
+        out = {}
+        if self.establishment is not None:
+            out["establishment"] = self.establishment(row)
+        if reviews is not None:
+            out["reviews"] = reviews
+        out.update(self.aggregates(row))
+        return out
+
+
+@lru_cache(maxsize=128)
+def detail_plan(selected: Tuple[str, ...]) -> _DetailPlan:
+    return _DetailPlan(selected)
+
+
+def detail(db: Session, est_id: int, selected: Tuple[str, ...]) -> Optional[bytes]:
+    """JSON de la fiche réduite aux champs demandés ; None si l'établissement n'existe pas."""
+    plan = detail_plan(selected)
+    row = db.execute(plan.one, {"est_id": est_id}).first()
+    if row is None:
+        return None
+    reviews = None
+    if plan.reviews is not None:
+        serialize = plan.reviews
+        reviews = [serialize(r) for r in db.execute(plan.reviews_one, {"est_id": est_id})]
+    return encode(plan.bundle(row, reviews))
+
+
+def batch(db: Session, ids: Iterable[int], gids: Iterable[str], reviews_limit: int,
+          selected: Tuple[str, ...]) -> bytes:
+    """Même forme que EstablishmentBatch, fiches réduites ; deux requêtes au plus."""
+    ids, gids = set(ids), set(gids)
+    plan = detail_plan(selected)
+    rows = db.execute(plan.many, {"ids": list(ids), "gids": list(gids)}).all() if ids or gids else []
+
+    by_est: Dict[int, Optional[list]] = {row.id: None for row in rows}
+    if rows and plan.reviews is not None:
+        by_est = {est_id: [] for est_id in by_est}
+        if reviews_limit:
+            serialize = plan.reviews
+            params = {"est_ids": list(by_est), "limit": reviews_limit}
+            for r in db.execute(plan.reviews_many, params):
+                by_est[r.batch_est_id].append(serialize(r))
+
+    items = {row.id: plan.bundle(row, by_est[row.id]) for row in rows}
+    found_gids = {row.google_place_id for row in rows}
+    return encode({
+        "items": items,
+        "missing_ids": sorted(ids - items.keys()),
+        "missing_google_place_ids": sorted(gids - found_gids),
+    })
+
+
+# ---------------- listes (GET /establishments, /establishments/near) ----------------
+@lru_cache(maxsize=128)
+def list_columns(selected: Tuple[str, ...]) -> tuple:
+    """Attributs ORM pour load_only() (distance_km est calculé)."""
+    return tuple(_columns(LIST, [f for f in selected if f in LIST]))
+
+
+@lru_cache(maxsize=128)
+def list_serializer(selected: Tuple[str, ...]) -> Callable[[object], dict]:
+    return _serializer(LIST, [f for f in selected if f in LIST])
@@ -0,0 +1,201 @@
+# geo.py
+"""
+Recherche "autour de moi" sur les établissements.
+
+Chaque établissement géolocalisé reçoit un numéro de cellule de grille
+(geo_cell, indexé) : cellules de GEO_CELL_DEG degrés, numérotées ligne par
+ligne. Un rayon se traduit en quelques plages contiguës de geo_cell (une par
+ligne de cellules couverte) -> lectures d'index par plage, puis filtre exact
+par distance (haversine) sur les seuls candidats. Fonctionne à l'identique
+sur SQLite et Postgres.
+
+Backfill des coordonnées des établissements existants (Places details, via
+places.PlacesClient : breaker, hedging et budget propre au backfill, à
+retrancher de THENA_PLACES_DAILY_QUOTA) :
+    python geo.py
+"""
+import heapq
+import math
+import os
+import sys
+import time
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session, load_only
+
+from models import Establishment
+
+GEO_CELL_DEG = 0.02  # ~2,2 km en latitude
+_NX = int(math.ceil(360 / GEO_CELL_DEG))
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEG_LAT = 111.32
+MAX_RADIUS_KM = 50
+
+# part du quota Google réservée au backfill (process à part, budget à part)
+GEO_BACKFILL_QPS = float(os.getenv("THENA_GEO_BACKFILL_QPS", "2"))
+GEO_BACKFILL_DAILY_QUOTA = int(os.getenv("THENA_GEO_BACKFILL_DAILY_QUOTA", "1000"))
+GEO_BACKFILL_MAX_WAIT = 60.0  # au-delà (quota du jour épuisé) : arrêt, à relancer plus tard
+
+
+def geo_cell(lat: float, lng: float) -> int:
+    cy = int((lat + 90) // GEO_CELL_DEG)
+    cx = min(int((lng + 180) // GEO_CELL_DEG), _NX - 1)
+    return cy * _NX + cx
+
+
+def set_location(est: Establishment, lat: Optional[float], lng: Optional[float]):
+    if lat is None or lng is None:
+        est.lat = est.lng = est.geo_cell = None
+        return
+    est.lat = lat
+    est.lng = lng
+    est.geo_cell = geo_cell(lat, lng)
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def cell_ranges(lat: float, lng: float, radius_km: float) -> List[Tuple[int, int]]:
+    """Plages [lo, hi] de geo_cell couvrant la boîte englobante du cercle."""
+    dlat = radius_km / KM_PER_DEG_LAT
+    cos_lat = max(math.cos(math.radians(lat)), 0.01)
+    dlng = min(radius_km / (KM_PER_DEG_LAT * cos_lat), 180)
+
+    lat0, lat1 = max(lat - dlat, -90), min(lat + dlat, 90 - 1e-9)
+    lng0, lng1 = max(lng - dlng, -180), min(lng + dlng, 180 - 1e-9)
+
+    cy0, cy1 = int((lat0 + 90) // GEO_CELL_DEG), int((lat1 + 90) // GEO_CELL_DEG)
+    cx0, cx1 = int((lng0 + 180) // GEO_CELL_DEG), int((lng1 + 180) // GEO_CELL_DEG)
+    return [(cy * _NX + cx0, cy * _NX + cx1) for cy in range(cy0, cy1 + 1)]
+
+
+def near(
+    db: Session,
+    lat: float,
+    lng: float,
+    radius_km: float,
+    limit: int = 20,
+    sort: str = "distance",
+    columns: Optional[Sequence] = None,
+) -> List[Tuple[Establishment, float]]:
+    """
+    [(establishment, distance_km)] dans le rayon.
+    sort="distance" : plus proche d'abord (puis meilleure note)
+    sort="score"    : meilleure note d'abord (puis plus proche)
+    columns         : colonnes chargées pour les résultats (load_only) ; None = toutes
+    """
+    ranges = cell_ranges(lat, lng, radius_km)
+    dlat = radius_km / KM_PER_DEG_LAT
+    # candidats : colonnes brutes uniquement (pas d'objets ORM), via l'index geo_cell
+    candidates = (
+        db.query(Establishment.id, Establishment.lat, Establishment.lng, Establishment.sort_avg)
+        .filter(or_(*[Establishment.geo_cell.between(lo, hi) for lo, hi in ranges]))
+        # bornes de latitude : élimine les bords des cellules sans coût
+        .filter(and_(Establishment.lat >= lat - dlat, Establishment.lat <= lat + dlat))
+        .all()
+    )
+
+    hits = []
+    for est_id, est_lat, est_lng, sort_avg in candidates:
+        d = haversine_km(lat, lng, est_lat, est_lng)
+        if d <= radius_km:
+            hits.append((d, -sort_avg, est_id) if sort != "score" else (-sort_avg, d, est_id))
+    top = heapq.nsmallest(limit, hits)
+    if not top:
+        return []
+
+    q = db.query(Establishment).filter(Establishment.id.in_([h[2] for h in top]))
+    if columns is not None:
+        q = q.options(load_only(*columns))
+    by_id = {e.id: e for e in q}
+    if sort == "score":
+        return [(by_id[est_id], d) for _, d, est_id in top]
+    return [(by_id[est_id], d) for d, _, est_id in top]
+
+
+def backfill(session_factory, fetch_location, batch_size: int = 100, pause_seconds: float = 0.05) -> int:
+    """
+    Renseigne lat/lng/geo_cell des établissements qui n'en ont pas.
+    fetch_location(google_place_id) -> (lat, lng) | None (Google n'a pas de
+    coordonnées : geo_not_found_at posé, jamais redemandé ; remettre la colonne
+    à NULL pour réessayer). Chaque établissement localisé change de version :
+    son snapshot est régénéré à la lecture suivante.
+    """
+    done = 0
+    last_id = 0
+    while True:
+        db = session_factory()
+        try:
+            batch = (
+                db.query(Establishment)
+                .filter(
+                    Establishment.id > last_id,
+                    Establishment.geo_cell.is_(None),
+                    Establishment.geo_not_found_at.is_(None),
+                )
+                .order_by(Establishment.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not batch:
+                return done
+            for est in batch:
+                if est.lat is None or est.lng is None:
+                    try:
+                        loc = fetch_location(est.google_place_id)
+                    except Exception:
+                        db.commit()  # coordonnées déjà obtenues (et facturées) conservées
+                        raise
+                    if pause_seconds:
+                        time.sleep(pause_seconds)
+                    if loc is None:
+                        est.geo_not_found_at = datetime.utcnow()
+                        continue
+                    set_location(est, *loc)
+                else:
+                    set_location(est, est.lat, est.lng)
+                # UPDATE ... SET version = version + 1 : pas de course avec une écriture d'avis
+                est.version = Establishment.version + 1
+                done += 1
+            db.commit()
+            last_id = batch[-1].id
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    import places
+    from database import SessionLocal
+
+    load_dotenv()
+    key = os.getenv("GOOGLE_API_KEY")
+    if not key:
+        sys.exit("GOOGLE_API_KEY missing: nothing fetched (and nothing marked as not found)")
+    client = places.PlacesClient(key, qps=GEO_BACKFILL_QPS, daily_quota=GEO_BACKFILL_DAILY_QUOTA)
+
+    def fetch_location(place_id):
+        while True:
+            try:
+                return client.location(place_id)
+            except places.PlacesError:
+                return None  # NOT_FOUND, INVALID_REQUEST... : pas de coordonnées
+            except places.PlacesUnavailable as e:
+                if e.retry_after > GEO_BACKFILL_MAX_WAIT:
+                    raise
+                time.sleep(e.retry_after)  # rythme du budget / breaker ouvert
+
+    try:
+        # pas de pause fixe : le budget par seconde cadence les appels
+        print("establishments geolocated:", backfill(SessionLocal, fetch_location, pause_seconds=0))
+    except places.PlacesUnavailable as e:
+        print("stopped:", e.reason, "- rerun later to resume")
+    print(client.stats())
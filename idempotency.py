@@ -0,0 +1,394 @@
+# idempotency.py
+"""
+En-tête Idempotency-Key pour les POST rejoués par les clients mobiles
+(connexion instable : la réponse se perd, l'app renvoie la même requête).
+
+- la première réponse de chaque (propriétaire, clé) est gardée
+  (table idempotency_keys, durée de vie par route) et rejouée à l'octet près
+  aux essais suivants, sans exécuter le handler : pas de nouvel avis, pas de
+  nouveau LoginToken, pas de rate limit consommé ;
+- propriétaire = cookie de session haché (utilisateur connecté), sinon IP :
+  la clé d'un client ne peut pas rejouer la réponse d'un autre ;
+- cache mémoire (LRU) devant la table : un essai rejoué par le même worker ne
+  touche pas la base ;
+- doublons concurrents : la ligne est insérée AVANT d'exécuter la requête
+  (INSERT ... ON CONFLICT DO NOTHING = verrou partagé entre workers, repris
+  après LOCK_SECONDS si le worker est mort). Le doublon attend la fin de la
+  première (asyncio.Event dans le même worker, sinon relecture périodique)
+  puis rejoue sa réponse ; 409 si elle dure plus de WAIT_SECONDS ;
+- même clé, requête différente (corps, chemin) : 422 ;
+- 5xx, 429 et réponses tronquées ne sont pas gardés : l'essai suivant
+  s'exécute normalement ;
+- champs secrets (redact, ex. dev_link de /auth/magic-link) : retirés du
+  corps JSON AVANT stockage ; seule la première réponse les contient, les
+  essais rejoués reçoivent le reste. Corps illisible -> pas gardé.
+
+Placé sous la compression : le corps gardé est le corps brut, recompressé
+selon l'Accept-Encoding de chaque essai.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import DateTime, LargeBinary, bindparam, text
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from security import COOKIE_NAME, hash_token
+
+IDEMPOTENCY_TTL_HOURS = float(os.getenv("THENA_IDEMPOTENCY_TTL_HOURS", "24"))
+LOCK_SECONDS = 60          # requête "en cours" plus vieille : worker mort, la clé est reprise
+WAIT_SECONDS = 10.0        # attente max d'un doublon concurrent avant 409
+POLL_SECONDS = 0.05
+MAX_KEY_LENGTH = 255
+MAX_BODY = 1 << 20         # au-delà, la réponse n'est pas gardée
+CACHE_SIZE = 2000
+CACHE_MAX_BODY = 64 * 1024
+PURGE_SECONDS = 600
+_SKIPPED_HEADERS = {b"date", b"server"}
+
+
+class StoredResponse:
+    __slots__ = ("fingerprint", "status", "headers", "body", "expires_at")
+
+    def __init__(self, fingerprint: str, status: Optional[int], headers: list, body: bytes, expires_at: datetime):
+        self.fingerprint = fingerprint
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires_at = expires_at
+
+
+_CLAIM = text(
+    "INSERT INTO idempotency_keys (owner, idem_key, fingerprint, locked_at, expires_at)"
+    " VALUES (:owner, :idem_key, :fingerprint, :now, :expires_at)"
+    " ON CONFLICT (owner, idem_key) DO NOTHING"
+).bindparams(bindparam("now", type_=DateTime), bindparam("expires_at", type_=DateTime))
+
+# reprise d'une ligne expirée ou d'un verrou abandonné
+_TAKE_OVER = text(
+    "UPDATE idempotency_keys SET fingerprint = :fingerprint, status = NULL, headers = NULL, body = NULL,"
+    " locked_at = :now, expires_at = :expires_at"
+    " WHERE owner = :owner AND idem_key = :idem_key"
+    " AND (expires_at < :now OR (status IS NULL AND locked_at < :stale))"
+).bindparams(
+    bindparam("now", type_=DateTime), bindparam("expires_at", type_=DateTime), bindparam("stale", type_=DateTime)
+)
+
+_SELECT = text(
+    "SELECT fingerprint, status, headers, body, expires_at FROM idempotency_keys"
+    " WHERE owner = :owner AND idem_key = :idem_key"
+).columns(expires_at=DateTime, body=LargeBinary)
+
+_SAVE = text(
+    "UPDATE idempotency_keys SET status = :status, headers = :headers, body = :body"
+    " WHERE owner = :owner AND idem_key = :idem_key AND fingerprint = :fingerprint"
+).bindparams(bindparam("body", type_=LargeBinary))
+
+_RELEASE = text(
+    "DELETE FROM idempotency_keys"
+    " WHERE owner = :owner AND idem_key = :idem_key AND fingerprint = :fingerprint AND status IS NULL"
+)
+
+_PURGE = text("DELETE FROM idempotency_keys WHERE expires_at < :now").bindparams(
+    bindparam("now", type_=DateTime)
+)
+
+
+class IdempotencyStore:
+    """Table idempotency_keys (partagée entre workers) + cache mémoire du worker."""
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self._cache: "OrderedDict[Tuple[str, str], StoredResponse]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+        self.counters = {
+            "executed": 0, "replayed_memory": 0, "replayed_db": 0, "waited": 0,
+            "in_progress_409": 0, "mismatch_422": 0, "stored": 0, "not_stored": 0, "purged": 0,
+        }
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    # ---------------- cache ----------------
+    def cached(self, ident: Tuple[str, str]) -> Optional[StoredResponse]:
+        with self._lock:
+            stored = self._cache.get(ident)
+            if stored is None:
+                return None
+            if stored.expires_at < datetime.utcnow():
+                del self._cache[ident]
+                return None
+            self._cache.move_to_end(ident)
+            return stored
+
+    def _remember(self, ident: Tuple[str, str], stored: StoredResponse):
+        if len(stored.body) > CACHE_MAX_BODY:
+            return
+        with self._lock:
+            self._cache[ident] = stored
+            self._cache.move_to_end(ident)
+            while len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    # ---------------- base (appelé dans le threadpool) ----------------
+    def claim(self, owner: str, key: str, fingerprint: str, ttl: float) -> Tuple[bool, Optional[StoredResponse]]:
+        """
+        (True, None) : la requête est à nous, l'exécuter ; sinon (False, ligne
+        existante), status None = en cours ailleurs (None : libérée entre-temps).
+        """
+        now = datetime.utcnow()
+        params = {
+            "owner": owner, "idem_key": key, "fingerprint": fingerprint,
+            "now": now, "expires_at": now + timedelta(seconds=ttl),
+        }
+        db = self.session_factory()
+        try:
+            claimed = db.execute(_CLAIM, params).rowcount == 1
+            if not claimed:
+                stale = now - timedelta(seconds=LOCK_SECONDS)
+                claimed = db.execute(_TAKE_OVER, {**params, "stale": stale}).rowcount == 1
+            db.commit()
+            if claimed:
+                return True, None
+            row = db.execute(_SELECT, {"owner": owner, "idem_key": key}).first()
+        finally:
+            db.close()
+        if row is None:
+            return False, None
+        if row.status is None:
+            return False, StoredResponse(row.fingerprint, None, [], b"", row.expires_at)
+        stored = StoredResponse(row.fingerprint, row.status, json.loads(row.headers), row.body, row.expires_at)
+        self._remember((owner, key), stored)
+        return False, stored
+
+    def save(self, owner: str, key: str, fingerprint: str, ttl: float, status: int, headers: list, body: bytes):
+        db = self.session_factory()
+        try:
+            db.execute(_SAVE, {
+                "owner": owner, "idem_key": key, "fingerprint": fingerprint,
+                "status": status, "headers": json.dumps(headers), "body": body,
+            })
+            db.commit()
+            if time.monotonic() - self._last_purge > PURGE_SECONDS:
+                self._last_purge = time.monotonic()
+                purged = db.execute(_PURGE, {"now": datetime.utcnow()}).rowcount
+                db.commit()
+                with self._lock:
+                    self.counters["purged"] += purged
+        finally:
+            db.close()
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+        self._remember((owner, key), StoredResponse(fingerprint, status, headers, body, expires_at))
+        self.count("stored")
+
+    def release(self, owner: str, key: str, fingerprint: str):
+        db = self.session_factory()
+        try:
+            db.execute(_RELEASE, {"owner": owner, "idem_key": key, "fingerprint": fingerprint})
+            db.commit()
+        finally:
+            db.close()
+        self.count("not_stored")
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self.counters)
+            out["cache_size"] = len(self._cache)
+        return out
+
+
+def request_fingerprint(scope: Scope, body: bytes) -> str:
+    h = hashlib.sha256()
+    for part in (scope["method"].encode(), scope["path"].encode(), scope.get("query_string", b""), body):
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+
+def session_owner(session_hash: str) -> str:
+    """Propriétaire des clés d'une session (sessions.session_hash) : purge de compte."""
+    return "s:" + session_hash[:32]
+
+
+def owner_of(scope: Scope) -> str:
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            for part in value.decode("latin-1").split(";"):
+                k, _, v = part.strip().partition("=")
+                if k == COOKIE_NAME and v:
+                    return session_owner(hash_token(v))
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+def redact_body(headers: list, body: bytes, fields: Iterable[str]) -> Optional[Tuple[list, bytes]]:
+    """Corps JSON sans `fields` (content-length recalculé) ; None si le corps n'est pas un objet JSON."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    for field in fields:
+        data.pop(field, None)
+    body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    headers = [(k, str(len(body)) if k.lower() == "content-length" else v) for k, v in headers]
+    return headers, body
+
+
+async def _send_json(send: Send, status: int, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+
+class IdempotencyMiddleware:
+    """
+    routes : {chemin: durée de vie en secondes} des POST concernés ; les
+    autres requêtes (et celles sans en-tête) passent sans surcoût.
+    redact : {chemin: champs JSON jamais stockés (jetons, liens de connexion)}.
+    """
+
+    def __init__(self, app: ASGIApp, store: IdempotencyStore, routes: Dict[str, float],
+                 redact: Optional[Dict[str, Tuple[str, ...]]] = None):
+        self.app = app
+        self.store = store
+        self.routes = routes
+        self.redact = redact or {}
+        self._inflight: Dict[Tuple[str, str], asyncio.Event] = {}  # requêtes exécutées par ce worker
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.routes:
+            await self.app(scope, receive, send)
+            return
+        key = None
+        for name, value in scope["headers"]:
+            if name == b"idempotency-key":
+                key = value.decode("latin-1").strip()
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+        if not key or len(key) > MAX_KEY_LENGTH:
+            await _send_json(send, 400, f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+            return
+
+        # corps lu en entier : il entre dans l'empreinte, puis est redonné à l'app
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+        fingerprint = request_fingerprint(scope, body)
+        owner = owner_of(scope)
+        ident = (owner, key)
+        ttl = self.routes[scope["path"]]
+
+        deadline = time.monotonic() + WAIT_SECONDS
+        while True:
+            stored = self.store.cached(ident)
+            if stored is not None:
+                self.store.count("replayed_memory")
+                return await self._replay(stored, fingerprint, send)
+            running = self._inflight.get(ident)
+            if running is not None:  # doublon concurrent dans ce worker
+                self.store.count("waited")
+                try:
+                    await asyncio.wait_for(running.wait(), max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    break
+                continue
+            event = self._inflight[ident] = asyncio.Event()
+            try:
+                claimed, stored = await run_in_threadpool(self.store.claim, owner, key, fingerprint, ttl)
+            except BaseException:
+                del self._inflight[ident]
+                event.set()
+                raise
+            if claimed:
+                try:
+                    await self._execute(scope, body, receive, send, ident, fingerprint, ttl)
+                finally:
+                    del self._inflight[ident]
+                    event.set()
+                return
+            del self._inflight[ident]
+            event.set()
+            if stored is not None and (stored.status is not None or stored.fingerprint != fingerprint):
+                if stored.status is not None:
+                    self.store.count("replayed_db")
+                return await self._replay(stored, fingerprint, send)
+            if time.monotonic() >= deadline:  # en cours dans un autre worker
+                break
+            await asyncio.sleep(POLL_SECONDS)
+        self.store.count("in_progress_409")
+        await _send_json(send, 409, "A request with this Idempotency-Key is still in progress")
+
+    async def _replay(self, stored: StoredResponse, fingerprint: str, send: Send):
+        if stored.fingerprint != fingerprint:
+            self.store.count("mismatch_422")
+            await _send_json(send, 422, "Idempotency-Key was already used with a different request")
+            return
+        headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in stored.headers]
+        headers.append((b"idempotent-replayed", b"true"))
+        await send({"type": "http.response.start", "status": stored.status, "headers": headers})
+        await send({"type": "http.response.body", "body": stored.body})
+
+    async def _execute(self, scope: Scope, body: bytes, receive: Receive, send: Send,
+                       ident: Tuple[str, str], fingerprint: str, ttl: float):
+        self.store.count("executed")
+        replayed = False
+
+        async def receive_body() -> Message:
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        response = {"status": None, "headers": [], "chunks": [], "size": 0, "complete": False}
+
+        async def send_capture(message: Message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [
+                    (k.decode("latin-1"), v.decode("latin-1"))
+                    for k, v in message.get("headers", []) if k.lower() not in _SKIPPED_HEADERS
+                ]
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                response["size"] += len(chunk)
+                if response["size"] <= MAX_BODY:
+                    response["chunks"].append(chunk)
+                response["complete"] = not message.get("more_body", False)
+            await send(message)
+
+        owner, key = ident
+        try:
+            await self.app(scope, receive_body, send_capture)
+        finally:
+            status = response["status"]
+            kept = None
+            if status is not None and status < 500 and status != 429 and response["complete"] \
+                    and response["size"] <= MAX_BODY:
+                kept = response["headers"], b"".join(response["chunks"])
+                if scope["path"] in self.redact:
+                    kept = redact_body(*kept, self.redact[scope["path"]])
+            if kept is not None:
+                await run_in_threadpool(self.store.save, owner, key, fingerprint, ttl, status, *kept)
+            else:
+                await run_in_threadpool(self.store.release, owner, key, fingerprint)
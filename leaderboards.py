@@ -0,0 +1,265 @@
+# leaderboards.py
+"""
+Classements d'établissements, matérialisés dans leaderboard_entries.
+
+- "overall" et "type:<type>" : moyenne bayésienne
+      (prior_weight * prior_mean + somme des notes) / (prior_weight + nb notes)
+  -> un établissement à 1 avis reste proche de la moyenne globale.
+- "harassment" / "unpaid_overtime" : nombre de signalements.
+
+Chaque écriture d'avis met à jour les lignes de SON établissement (quelques
+lignes) ; un top-N est une lecture de l'index (board, score) : O(N).
+
+Le prior (moyenne globale) est figé dans leaderboard_params entre deux rebuilds,
+sinon chaque avis déplacerait tous les scores. Le rebuild périodique recalcule
+le prior et les agrégats depuis `reviews`, et corrige toute dérive. Chaque lot
+prend le verrou d'écriture AVANT de lire (comme rollups.rebuild) : un avis
+écrit pendant le rebuild attend la fin du lot au lieu d'être écrasé par des
+agrégats lus avant lui. Un seul worker le lance (is_leader, voir RebuildJob).
+"""
+import os
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import insert, text
+from sqlalchemy.orm import Session
+
+from database import dialect_insert
+from establishment_index import AGGREGATE_COLUMNS, parse_types
+from models import Establishment, EstablishmentType, LeaderboardEntry, LeaderboardParams, Review
+
+PRIOR_WEIGHT = float(os.getenv("THENA_BAYES_PRIOR_WEIGHT", "5"))
+DEFAULT_PRIOR_MEAN = 5.0
+REBUILD_SECONDS = int(os.getenv("THENA_LEADERBOARD_REBUILD_SECONDS", "3600"))
+
+BOARDS = ("overall", "harassment", "unpaid_overtime")
+
+
+def type_board(type_name: str) -> str:
+    return f"type:{type_name}"[:80]
+
+
+def get_params(db: Session) -> Tuple[float, float]:
+    p = db.query(LeaderboardParams).get(1)
+    if p is None:
+        return DEFAULT_PRIOR_MEAN, PRIOR_WEIGHT
+    return p.prior_mean, p.prior_weight
+
+
+def bayes_score(score_sum: float, count: int, prior_mean: float, prior_weight: float) -> float:
+    return (prior_weight * prior_mean + score_sum) / (prior_weight + count)
+
+
+def entries_for(est: Establishment, prior_mean: float, prior_weight: float) -> Dict[str, Tuple[float, int]]:
+    """board -> (score, review_count) attendus pour un établissement."""
+    out = {}
+    if est.thena_count_scored:
+        score = bayes_score(est.score_sum or 0, est.thena_count_scored, prior_mean, prior_weight)
+        out["overall"] = (score, est.thena_count_scored)
+        for t in parse_types(est.types_json):
+            out[type_board(t)] = (score, est.thena_count_scored)
+    if est.harassment_count:
+        out["harassment"] = (float(est.harassment_count), est.thena_count_total)
+    if est.unpaid_overtime_count:
+        out["unpaid_overtime"] = (float(est.unpaid_overtime_count), est.thena_count_total)
+    return out
+
+
+def update_establishment(db: Session, est_id: int):
+    """Dans la transaction d'écriture d'un avis, après establishment_index.refresh_aggregates."""
+    est = db.query(Establishment).get(est_id)
+    db.refresh(est)  # agrégats mis à jour par UPDATE en masse
+    prior_mean, prior_weight = get_params(db)
+
+    db.query(LeaderboardEntry).filter(LeaderboardEntry.establishment_id == est_id).delete(
+        synchronize_session=False
+    )
+    db.add_all(
+        LeaderboardEntry(board=board, establishment_id=est_id, score=score, review_count=count)
+        for board, (score, count) in entries_for(est, prior_mean, prior_weight).items()
+    )
+
+
+def update_establishments(db: Session, est_ids: Iterable[int]):
+    """Idem pour un lot (purge de comptes), après establishment_index.refresh_aggregates_many."""
+    est_ids = sorted(set(est_ids))
+    if not est_ids:
+        return
+    ests = db.query(Establishment).filter(Establishment.id.in_(est_ids)).populate_existing().all()
+    prior_mean, prior_weight = get_params(db)
+
+    db.query(LeaderboardEntry).filter(LeaderboardEntry.establishment_id.in_(est_ids)).delete(
+        synchronize_session=False
+    )
+    # executemany (pas d'objets ORM) : des milliers de lignes par lot
+    rows = [
+        {"board": board, "establishment_id": est.id, "score": score, "review_count": count}
+        for est in ests
+        for board, (score, count) in entries_for(est, prior_mean, prior_weight).items()
+    ]
+    if rows:
+        db.execute(insert(LeaderboardEntry.__table__), rows)
+
+
+def top(
+    db: Session,
+    board: str,
+    limit: int = 20,
+    worst: bool = False,
+) -> List[Tuple[LeaderboardEntry, Establishment]]:
+    q = db.query(LeaderboardEntry).filter(LeaderboardEntry.board == board)
+    if worst:
+        q = q.order_by(LeaderboardEntry.score.asc(), LeaderboardEntry.establishment_id.asc())
+    else:
+        q = q.order_by(LeaderboardEntry.score.desc(), LeaderboardEntry.establishment_id.desc())
+    entries = q.limit(limit).all()
+    if not entries:
+        return []
+    ests = {
+        e.id: e for e in
+        db.query(Establishment).filter(Establishment.id.in_([x.establishment_id for x in entries]))
+    }
+    return [(x, ests[x.establishment_id]) for x in entries if x.establishment_id in ests]
+
+
+# ---------------- rebuild / vérification ----------------
+def rebuild(session_factory, batch_size: int = 500) -> dict:
+    """
+    Recalcule tout depuis `reviews` : prior, agrégats dénormalisés, classements.
+    Par lots d'établissements (une transaction par lot, verrou d'écriture pris
+    en premier). Renvoie le nombre d'établissements dont les lignes ont dû être
+    corrigées.
+    """
+    db = session_factory()
+    try:
+        total_sum, total_count = db.query(
+            AGGREGATE_COLUMNS[3], AGGREGATE_COLUMNS[1]
+        ).select_from(Review).one()
+        prior_mean = (total_sum / total_count) if total_count else DEFAULT_PRIOR_MEAN
+
+        p = db.query(LeaderboardParams).get(1)
+        prior_changed = p is None or abs(p.prior_mean - prior_mean) > 1e-9 or p.prior_weight != PRIOR_WEIGHT
+        # upsert : premiers démarrages simultanés de plusieurs workers sans IntegrityError sur id=1
+        values = {"prior_mean": prior_mean, "prior_weight": PRIOR_WEIGHT, "rebuilt_at": datetime.utcnow()}
+        db.execute(
+            dialect_insert(db.get_bind())(LeaderboardParams.__table__).values(id=1, **values)
+            .on_conflict_do_update(index_elements=["id"], set_=values)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+    fixed = 0
+    checked = 0
+    last_id = 0
+    while True:
+        db = session_factory()
+        try:
+            q = db.query(Establishment).filter(Establishment.id > last_id).order_by(Establishment.id).limit(batch_size)
+            if db.get_bind().dialect.name == "postgresql":
+                q = q.with_for_update()  # lignes du lot verrouillées : refresh_aggregates attend
+            else:
+                # SQLite : une écriture (sans effet) en tête de transaction prend le verrou
+                db.execute(text("UPDATE leaderboard_params SET prior_weight = prior_weight WHERE id = 1"))
+            batch = q.all()
+            if not batch:
+                break
+            ids = [e.id for e in batch]
+
+            agg = {
+                row[0]: row[1:]
+                for row in db.query(Review.establishment_id, *AGGREGATE_COLUMNS)
+                .filter(Review.establishment_id.in_(ids))
+                .group_by(Review.establishment_id)
+            }
+            current: Dict[int, Dict[str, Tuple[float, int]]] = {}
+            for est_id, board, score, count in db.query(
+                LeaderboardEntry.establishment_id, LeaderboardEntry.board,
+                LeaderboardEntry.score, LeaderboardEntry.review_count,
+            ).filter(LeaderboardEntry.establishment_id.in_(ids)):
+                current.setdefault(est_id, {})[board] = (score, count)
+
+            for est in batch:
+                avg, scored, total, score_sum, harassment, unpaid = agg.get(est.id, (None, 0, 0, 0, 0, 0))
+                thena_avg = round(avg, 1) if avg is not None else None
+                sort_avg = thena_avg if thena_avg is not None else -1
+                if est.sort_avg != sort_avg:
+                    db.query(EstablishmentType).filter(EstablishmentType.establishment_id == est.id).update(
+                        {EstablishmentType.sort_avg: sort_avg}, synchronize_session=False
+                    )
+                est.thena_avg = thena_avg
+                est.thena_count_scored = scored
+                est.thena_count_total = total
+                est.sort_avg = sort_avg
+                est.score_sum = score_sum or 0
+                est.harassment_count = harassment or 0
+                est.unpaid_overtime_count = unpaid or 0
+
+                expected = entries_for(est, prior_mean, PRIOR_WEIGHT)
+                have = current.get(est.id, {})
+                if expected.keys() != have.keys() or any(
+                    abs(expected[b][0] - have[b][0]) > 1e-9 or expected[b][1] != have[b][1] for b in expected
+                ):
+                    fixed += 1
+                    db.query(LeaderboardEntry).filter(LeaderboardEntry.establishment_id == est.id).delete(
+                        synchronize_session=False
+                    )
+                    db.add_all(
+                        LeaderboardEntry(board=b, establishment_id=est.id, score=s, review_count=c)
+                        for b, (s, c) in expected.items()
+                    )
+            db.commit()
+            checked += len(batch)
+            last_id = batch[-1].id
+        finally:
+            db.close()
+
+    return {"checked": checked, "fixed": fixed, "prior_mean": prior_mean, "prior_changed": prior_changed}
+
+
+class RebuildJob:
+    """
+    Rebuild périodique en thread de fond (même schéma que SnapshotStore).
+    `is_leader` : ne tourne que dans le worker élu (main.py : celui qui tient le
+    verrou du pipeline) ; les autres workers passent leur tour.
+    """
+
+    def __init__(self, session_factory, interval_seconds: int = REBUILD_SECONDS,
+                 is_leader: Callable[[], bool] = lambda: True):
+        self.session_factory = session_factory
+        self.interval_seconds = interval_seconds
+        self.is_leader = is_leader
+        self.last_result: Optional[dict] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None or self.interval_seconds <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="thena-leaderboards", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            if not self.is_leader():
+                continue
+            try:
+                self.last_result = rebuild(self.session_factory)
+                if self.last_result["fixed"] and not self.last_result["prior_changed"]:
+                    print("LEADERBOARDS: drift fixed on", self.last_result["fixed"], "establishments")
+            except Exception as e:
+                print("LEADERBOARDS: rebuild failed:", repr(e))
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    print(rebuild(SessionLocal))
@@ -0,0 +1,237 @@
+# live.py
+"""
+Canal "live" par établissement (Server-Sent Events).
+
+Les handlers d'écriture publient des deltas compacts (avis upsert / supprimé +
+agrégats) ; chaque abonné SSE a sa propre file bornée. Un abonné trop lent
+(file pleine) est décroché : il reçoit un événement "resync" et le navigateur
+se reconnecte puis recharge la fiche.
+
+Le backend est interchangeable :
+- "local"  : fan-out en mémoire, un seul worker (défaut, tests)
+- "sqlite" : table d'événements partagée, chaque worker la poll -> multi-workers
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+LIVE_BACKEND = os.getenv("THENA_LIVE_BACKEND", "local")
+LIVE_DB_PATH = os.getenv("THENA_LIVE_DB", "./thena_live.db")
+LIVE_QUEUE_SIZE = int(os.getenv("THENA_LIVE_QUEUE_SIZE", "64"))
+LIVE_KEEPALIVE_SECONDS = 15.0
+
+
+class Subscriber:
+    def __init__(self, establishment_id: int, loop: asyncio.AbstractEventLoop, maxsize: int):
+        self.establishment_id = establishment_id
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = False
+
+    def offer(self, message: str):
+        # exécuté dans la boucle de l'abonné (call_soon_threadsafe)
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # slow consumer : on vide et on force une resynchro côté client
+            self.dropped = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class LiveHub:
+    """Fan-out in-process : establishment_id -> abonnés."""
+
+    def __init__(self, maxsize: int = LIVE_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self._subs: Dict[int, Set[Subscriber]] = {}
+        self._listeners: List[Callable[[int, str], None]] = []
+        self._lock = threading.Lock()
+        self.dropped_total = 0
+
+    def subscribe(self, establishment_id: int) -> Subscriber:
+        sub = Subscriber(establishment_id, asyncio.get_running_loop(), self.maxsize)
+        with self._lock:
+            self._subs.setdefault(establishment_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        with self._lock:
+            subs = self._subs.get(sub.establishment_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subs[sub.establishment_id]
+        if sub.dropped:
+            self.dropped_total += 1
+
+    def add_listener(self, listener: Callable[[int, str], None]):
+        """Écouteur in-process de TOUS les événements (ex. feed.py), appelé dans le thread de dispatch."""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def subscriber_count(self, establishment_id: Optional[int] = None) -> int:
+        with self._lock:
+            if establishment_id is not None:
+                return len(self._subs.get(establishment_id, ()))
+            return sum(len(s) for s in self._subs.values())
+
+    def dispatch(self, establishment_id: int, message: str):
+        # appelable depuis n'importe quel thread (handlers sync = threadpool)
+        with self._lock:
+            subs = list(self._subs.get(establishment_id, ()))
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(establishment_id, message)
+            except Exception as e:
+                print("LIVE: listener failed:", repr(e))
+        for sub in subs:
+            try:
+                sub.loop.call_soon_threadsafe(sub.offer, message)
+            except RuntimeError:
+                # boucle fermée : l'abonné sera retiré par son générateur
+                pass
+
+
+# ---------------- BACKENDS ----------------
+class LocalBackend:
+    """Un seul process : publier = dispatcher directement."""
+
+    def __init__(self, hub: LiveHub):
+        self.hub = hub
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def publish(self, establishment_id: int, message: str):
+        self.hub.dispatch(establishment_id, message)
+
+
+class SQLiteBackend:
+    """
+    Multi-workers : chaque publish insère une ligne, chaque worker poll les
+    nouvelles lignes (id > dernier vu) et les dispatch à ses abonnés locaux.
+    """
+
+    def __init__(self, hub: LiveHub, path: str = LIVE_DB_PATH, poll_interval: float = 0.2,
+                 retention_seconds: int = 300):
+        self.hub = hub
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention_seconds = retention_seconds
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_id = 0
+
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS live_events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " establishment_id INTEGER NOT NULL,"
+            " message TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        conn.commit()
+        conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def start(self):
+        if self._thread is not None:
+            return
+        conn = self._connect()
+        row = conn.execute("SELECT COALESCE(MAX(id), 0) FROM live_events").fetchone()
+        conn.close()
+        self._last_id = row[0]
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="thena-live-poll", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def publish(self, establishment_id: int, message: str):
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT INTO live_events (establishment_id, message, created_at) VALUES (?, ?, ?)",
+                (establishment_id, message, time.time()),
+            )
+        finally:
+            conn.close()
+
+    def _run(self):
+        conn = self._connect()
+        last_prune = 0.0
+        try:
+            while not self._stop.wait(self.poll_interval):
+                rows = conn.execute(
+                    "SELECT id, establishment_id, message FROM live_events WHERE id > ? ORDER BY id",
+                    (self._last_id,),
+                ).fetchall()
+                for event_id, est_id, message in rows:
+                    self._last_id = event_id
+                    self.hub.dispatch(est_id, message)
+
+                now = time.time()
+                if now - last_prune > 60:
+                    conn.execute("DELETE FROM live_events WHERE created_at < ?", (now - self.retention_seconds,))
+                    last_prune = now
+        finally:
+            conn.close()
+
+
+def make_backend(hub: LiveHub, name: str = LIVE_BACKEND):
+    if name == "sqlite":
+        return SQLiteBackend(hub)
+    if name == "local":
+        return LocalBackend(hub)
+    raise ValueError(f"Unknown THENA_LIVE_BACKEND: {name}")
+
+
+hub = LiveHub()
+backend = make_backend(hub)
+
+
+def publish(establishment_id: int, event: dict):
+    """Appelé après commit par les handlers d'écriture."""
+    message = json.dumps(event, separators=(",", ":"), default=str)
+    backend.publish(establishment_id, message)
+
+
+async def event_stream(establishment_id: int, request):
+    """Générateur SSE pour un abonné."""
+    sub = hub.subscribe(establishment_id)
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            if await request.is_disconnected():
+                break
+            try:
+                message = await asyncio.wait_for(sub.queue.get(), timeout=LIVE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if message is None:
+                yield 'event: resync\ndata: {}\n\n'
+                break
+            yield f"event: delta\ndata: {message}\n\n"
+    finally:
+        hub.unsubscribe(sub)
@@ -1,28 +1,60 @@
 # main.py
 import os
 import json
-import requests
+import math
+from array import array
 from datetime import datetime
+from typing import List, Optional
 from dotenv import load_dotenv
 
 from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
-
-from database import SessionLocal, engine, Base
-from models import Establishment, Review, User, LoginToken, Session as DbSession
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import func, or_, update
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from database import DATABASE_URL, SessionLocal, engine, Base, sync_schema, dialect_insert
+from models import (
+    Establishment, Review, ReviewTombstone, User, LoginToken, Session as DbSession, LeaderboardParams
+)
 from schemas import (
-    EstablishmentCreate, EstablishmentOut,
-    ReviewCreate, ReviewOut,
-    EstablishmentWithStats,
+    EstablishmentCreate, EstablishmentOut, EstablishmentSummary, EstablishmentPage, EstablishmentNear,
+    Leaderboard, LeaderboardRow,
+    ReviewCreate, ReviewBatch, ReviewOut,
+    EstablishmentWithStats, EstablishmentChanges, EstablishmentBatchRequest, EstablishmentBatch,
+    FeedItem, FeedPage, DuplicateReview, FlaggedReview, AccountPurgeRequest, AccountPurgeResult,
+    RollupPage,
+    ReviewSearchHit, ReviewSearchPage,
     AuthRequestLink, MeOut, UserOut
 )
 from security import (
     new_token, hash_token, expires_in_minutes, expires_in_days,
     COOKIE_NAME, LOGINLINK_MINUTES, SESSION_DAYS
 )
-from auth import get_current_user
+from auth import get_current_user, get_db, require_admin
+import accounts
+import backup
+import dedup
+import establishment_index
+import eventlog
+import feed
+import fieldsets
+import geo
+import idempotency
+import leaderboards
+import live
+import metrics
+import pipeline
+import places
+import ratelimit
+import rollups
+import search
+import static_assets
+from compression import CompressionMiddleware
+from static_assets import StaticAssets
+from snapshots import SnapshotStore, SNAPSHOT_DIR, SNAPSHOTS_ENABLED
 
 
 # ---------------- ENV ----------------
@@ -32,17 +64,118 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")  # peut être None sur Render si pa
 
 # ---------------- APP ----------------
 app = FastAPI(title="THENA", version="1.0.0")
+# Idempotency-Key sur les POST que les mobiles réessaient (voir idempotency.py) ;
+# sous la compression : réponse gardée non compressée
+idempotency_store = idempotency.IdempotencyStore(SessionLocal)
+metrics.register("idempotency", idempotency_store.stats)
+IDEMPOTENCY_TTL = idempotency.IDEMPOTENCY_TTL_HOURS * 3600
+app.add_middleware(idempotency.IdempotencyMiddleware, store=idempotency_store, routes={
+    "/reviews": IDEMPOTENCY_TTL,
+    "/reviews/batch": IDEMPOTENCY_TTL,
+    "/establishments": IDEMPOTENCY_TTL,
+    "/establishments/batch": IDEMPOTENCY_TTL,
+    "/auth/magic-link": LOGINLINK_MINUTES * 60,  # pas plus longtemps que le lien envoyé
+}, redact={
+    "/auth/magic-link": ("dev_link",),  # identifiant de connexion : jamais en base ni rejoué
+})
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(eventlog.AccessLogMiddleware)  # le plus externe : durée totale, octets compressés
 
 Base.metadata.create_all(bind=engine)
+added_columns = sync_schema(engine)
+search.setup(engine)
+# types normalisés + agrégats dénormalisés pour les lignes d'avant la migration
+# (et après suppression des doublons d'avis par la contrainte d'unicité)
+establishment_index.backfill(
+    SessionLocal,
+    aggregates=any(c.startswith("establishments.") or c.startswith("reviews.uq_") for c in added_columns),
+)
+
+
+# snapshots JSON des fiches (voir snapshots.py) ; build_establishment_stats est défini plus bas
+snapshots = SnapshotStore(SNAPSHOT_DIR, SessionLocal, lambda est_id, db: build_establishment_stats(est_id, db))
+# rebuild dans le seul worker élu par le pipeline (review_pipeline, défini plus bas)
+leaderboard_job = leaderboards.RebuildJob(SessionLocal, is_leader=lambda: review_pipeline.leader)
+metrics.register("leaderboards", lambda: leaderboard_job.last_result or {})
+
+# sauvegardes SQLite planifiées (voir backup.py ; Postgres : outils natifs)
+backup_job = None
+if backup.sqlite_path_from_url(DATABASE_URL):
+    backup_job = backup.BackupJob(backup.sqlite_path_from_url(DATABASE_URL))
+    metrics.register("backup", lambda: backup_job.last_result or {})
+
+rate_limiter = ratelimit.RateLimiter()
+metrics.register("ratelimit", rate_limiter.stats)
+
+# fil global : ring buffer alimenté par les événements live (voir feed.py)
+feed_buffer = feed.FeedBuffer()
+live.hub.add_listener(feed_buffer.on_live_event)
+metrics.register("feed", feed_buffer.stats)
+
+# quasi-doublons : index MinHash/LSH en mémoire (voir dedup.py)
+dedup_index = dedup.DedupIndex()
+live.hub.add_listener(dedup_index.on_live_event)
+metrics.register("dedup", dedup_index.stats)
+
+
+def apply_review_analysis(db: Session, review_id: int, result: dict) -> dict:
+    # résultats du pipeline hors requête (voir pipeline.py) -> colonnes de l'avis
+    sig = array("H", result["signature"]) if result["signature"] else None
+    match = dedup_index.check_review(db, review_id, sig)  # marque un éventuel copier-coller
+    return {
+        "language": result["language"],
+        "pii_count": result["pii_count"],
+        "profanity_count": result["profanity_count"],
+        "duplicate_of_id": match[0] if match else None,
+        "duplicate_similarity": round(match[1], 3) if match else None,
+    }
+
+
+review_pipeline = pipeline.ReviewPipeline(SessionLocal, apply_review_analysis, publish=live.publish)
+metrics.register("pipeline", review_pipeline.stats)
+
+# journal d'événements JSONL, écrit par lots en arrière-plan (voir eventlog.py)
+metrics.register("eventlog", eventlog.log.stats)
+
+
+@app.on_event("startup")
+def on_startup():
+    eventlog.log.start()
+    with SessionLocal() as db:
+        feed_buffer.fill(db)
+        dedup_index.load(db)
+    live.backend.start()
+    if SNAPSHOTS_ENABLED:
+        snapshots.start()
+    with SessionLocal() as db:
+        first_run = db.query(LeaderboardParams).get(1) is None
+    if first_run:
+        leaderboard_job.last_result = leaderboards.rebuild(SessionLocal)
+    leaderboard_job.start()
+    with SessionLocal() as db:
+        if rollups.is_empty(db) and db.query(Review.id).first() is not None:
+            rollups.rebuild(db)
+    if backup_job is not None:
+        backup_job.start()
+    if "reviews.processed_version" in added_columns:
+        pipeline.backfill(SessionLocal)  # avis d'avant le pipeline : langue, PII, grossièretés
+    review_pipeline.start()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    live.backend.stop()
+    snapshots.stop()
+    leaderboard_job.stop()
+    if backup_job is not None:
+        backup_job.stop()
+    review_pipeline.stop()
+    eventlog.log.stop()  # en dernier : vide la file
 
 
 # ---------------- DB ----------------
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# get_db vient de auth.py : même dépendance que get_current_user -> FastAPI la
+# résout une fois par requête, une seule session (et connexion) par requête.
 
 
 # ---------------- HELPERS ----------------
@@ -51,6 +184,30 @@ def require_google_key():
         raise HTTPException(status_code=500, detail="GOOGLE_API_KEY missing (Render env var)")
 
 
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+
+def enforce_rate_limit(rule: str, key, cost: int = 1):
+    # 429 + Retry-After (voir ratelimit.py)
+    if not ratelimit.RATELIMIT_ENABLED:
+        return
+    limit = ratelimit.RULES[rule]
+    if cost > limit.limit:
+        # ne passera jamais dans la fenêtre : pas de 429 (Retry-After mensonger)
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch of {cost} exceeds the {rule} limit of {limit.limit} per {limit.period} s",
+        )
+    wait = rate_limiter.check(rule, str(key), cost)
+    if wait is not None:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+
+
 def to_review_out(r: Review) -> ReviewOut:
     return ReviewOut(
         id=r.id,
@@ -68,20 +225,128 @@ def to_review_out(r: Review) -> ReviewOut:
         toxic_manager=r.toxic_manager,
         harassment=r.harassment,
         recommend=r.recommend,
+        version=r.version or 0,
         created_at=r.created_at,
     )
 
 
+def bump_establishment_version(est_id: int, db: Session) -> Optional[int]:
+    # incrément atomique dans la transaction d'écriture -> version monotone par établissement
+    # (None si l'établissement n'existe pas)
+    return db.execute(
+        update(Establishment)
+        .where(Establishment.id == est_id)
+        .values(version=Establishment.version + 1)
+        .returning(Establishment.version)
+    ).scalar()
+
+
+def on_review_write(est_id: int, db: Session):
+    # dans la transaction d'écriture d'un avis (après flush, avant commit)
+    establishment_index.refresh_aggregates(db, est_id)
+    leaderboards.update_establishment(db, est_id)
+
+
+def to_establishment_out(est: Establishment) -> EstablishmentOut:
+    return EstablishmentOut(
+        id=est.id,
+        google_place_id=est.google_place_id,
+        name=est.name,
+        address=est.address,
+        google_rating=est.google_rating,
+        types=establishment_index.parse_types(est.types_json),
+        lat=est.lat,
+        lng=est.lng,
+        created_at=est.created_at,
+    )
+
+
+def to_establishment_summary(est: Establishment) -> EstablishmentSummary:
+    return EstablishmentSummary(
+        id=est.id,
+        google_place_id=est.google_place_id,
+        name=est.name,
+        address=est.address,
+        google_rating=est.google_rating,
+        types=establishment_index.parse_types(est.types_json),
+        thena_avg=est.thena_avg,
+        thena_count_total=est.thena_count_total,
+        lat=est.lat,
+        lng=est.lng,
+    )
+
+
+def review_aggregates(est_id: int, db: Session) -> dict:
+    # agrégats dénormalisés (establishment_index.refresh_aggregates) : lecture par clé primaire
+    avg, scored, total = (
+        db.query(Establishment.thena_avg, Establishment.thena_count_scored, Establishment.thena_count_total)
+        .filter(Establishment.id == est_id)
+        .one()
+    )
+    return {
+        "thena_avg": avg,
+        "thena_count_scored": scored,
+        "thena_count_total": total,
+    }
+
+
+def publish_review_upserted(review: ReviewOut, establishment_name: str, db: Session):
+    live.publish(review.establishment_id, {
+        "type": "review_upserted",
+        "review": review.model_dump(mode="json"),
+        "establishment_name": establishment_name,
+        "version": review.version,
+        **review_aggregates(review.establishment_id, db),
+    })
+
+
+def publish_review_deleted(review_id: int, est_id: int, version: int, db: Session):
+    live.publish(est_id, {
+        "type": "review_deleted",
+        "review_id": review_id,
+        "version": version,
+        **review_aggregates(est_id, db),
+    })
+
+
+def purge_accounts(user_ids: List[int], budget_seconds: Optional[float] = None) -> dict:
+    # avis, agrégats, rollups, classements et live : accounts.py ; ici les snapshots
+    def on_commit(est_ids):
+        for est_id in est_ids:
+            snapshots.mark_dirty(est_id)
+
+    return accounts.purge_users(SessionLocal, user_ids, budget_seconds, on_commit=on_commit)
+
+
+# ---------------- METRICS ----------------
+@app.get("/metrics")
+def get_metrics():
+    return metrics.snapshot()
+
+
 # ---------------- AUTH ----------------
 @app.get("/me", response_model=MeOut)
 def me(user: User = Depends(get_current_user)):
     return {"user": UserOut.model_validate(user)}
 
 
+@app.delete("/me")
+def delete_me(request: Request, response: Response, user: User = Depends(get_current_user)):
+    # sessions révoquées, avis retirés des agrégats, puis compte supprimé (voir accounts.py)
+    result = purge_accounts([user.id])
+    response.delete_cookie(COOKIE_NAME, path="/")
+    eventlog.emit("auth.account_deleted", user_id=user.id, reviews=result["reviews_deleted"], ip=client_ip(request))
+    return {"ok": True, "reviews_deleted": result["reviews_deleted"]}
+
+
 @app.post("/auth/magic-link")
 def auth_magic_link(payload: AuthRequestLink, request: Request, db: Session = Depends(get_db)):
+    enforce_rate_limit("magic_link_ip", client_ip(request))
+    enforce_rate_limit("magic_link_email", hash_token(payload.email.lower()))
+
     # create user if needed
     user = db.query(User).filter(User.email == payload.email).first()
+    new_user = user is None
     if not user:
         user = User(email=payload.email, pseudo=payload.pseudo)
         db.add(user)
@@ -102,24 +367,29 @@ def auth_magic_link(payload: AuthRequestLink, request: Request, db: Session = De
 
     link = str(request.base_url) + f"auth/verify?token={raw}"
 
-    # DEV MODE: tu peux le voir dans les logs
-    print("MAGIC LINK:", link)
+    # jamais le lien dans le journal : c'est un identifiant de connexion
+    eventlog.emit("auth.magic_link", user_id=user.id, new_user=new_user, ip=client_ip(request))
 
     # En prod tu mettras un vrai email. Pour l’instant on renvoie aussi le lien (pratique).
     return {"ok": True, "dev_link": link}
 
 
 @app.get("/auth/verify")
-def auth_verify(token: str, response: Response, db: Session = Depends(get_db)):
+def auth_verify(token: str, request: Request, response: Response, db: Session = Depends(get_db)):
     token_h = hash_token(token)
     lt = db.query(LoginToken).filter(LoginToken.token_hash == token_h).first()
 
+    failure = None
     if not lt:
-        raise HTTPException(status_code=400, detail="Invalid token")
-    if lt.used_at is not None:
-        raise HTTPException(status_code=400, detail="Token already used")
-    if lt.expires_at < datetime.utcnow():
-        raise HTTPException(status_code=400, detail="Token expired")
+        failure = "Invalid token"
+    elif lt.used_at is not None:
+        failure = "Token already used"
+    elif lt.expires_at < datetime.utcnow():
+        failure = "Token expired"
+    if failure:
+        eventlog.emit("auth.verify", ok=False, reason=failure, user_id=lt.user_id if lt else None,
+                      ip=client_ip(request))
+        raise HTTPException(status_code=400, detail=failure)
 
     # mark token used
     lt.used_at = datetime.utcnow()
@@ -136,6 +406,7 @@ def auth_verify(token: str, response: Response, db: Session = Depends(get_db)):
     )
     db.add(s)
     db.commit()
+    eventlog.emit("auth.verify", ok=True, user_id=lt.user_id, ip=client_ip(request))
 
     # set cookie
     response.set_cookie(
@@ -155,96 +426,373 @@ def auth_verify(token: str, response: Response, db: Session = Depends(get_db)):
 
 
 @app.post("/auth/logout")
-def logout(response: Response):
+def logout(request: Request, response: Response):
     response.delete_cookie(COOKIE_NAME, path="/")
+    eventlog.emit("auth.logout", ip=client_ip(request))
     return {"ok": True}
 
 
 # ---------------- GOOGLE API ----------------
-@app.get("/api/google/autocomplete")
-def google_autocomplete(q: str = Query(min_length=1)):
-    require_google_key()
+# budget, circuit breaker, timeouts adaptatifs et hedging : voir places.py
+places_client = places.PlacesClient(GOOGLE_API_KEY)
+metrics.register("places", places_client.stats)
+autocomplete_gate = places.LatestQueryGate()
+metrics.register("autocomplete", autocomplete_gate.stats)
+PLACES_LOCAL_FALLBACK_LIMIT = 5
+
+
+def places_unavailable(e: places.PlacesUnavailable):
+    return HTTPException(
+        status_code=503,
+        detail=f"Google Places unavailable ({e.reason})",
+        headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+    )
 
-    url = "https://maps.googleapis.com/maps/api/place/autocomplete/json"
-    params = {"input": q, "types": "establishment", "language": "fr", "key": GOOGLE_API_KEY}
 
-    r = requests.get(url, params=params, timeout=15)
-    data = r.json()
+def place_out(result: dict) -> dict:
+    location = (result.get("geometry") or {}).get("location") or {}
+    return {
+        "google_place_id": result["place_id"],
+        "name": result["name"],
+        "address": result.get("formatted_address"),
+        "google_rating": result.get("rating"),
+        "types": result.get("types", []),
+        "lat": location.get("lat"),
+        "lng": location.get("lng"),
+    }
+
+
+def local_autocomplete(db: Session, q: str) -> list:
+    rows = (
+        db.query(Establishment.google_place_id, Establishment.name, Establishment.address)
+        .filter(Establishment.name.ilike(f"%{q.strip()}%"))
+        .order_by(Establishment.thena_count_total.desc())
+        .limit(PLACES_LOCAL_FALLBACK_LIMIT)
+        .all()
+    )
+    return [
+        {"place_id": gid, "description": f"{name}, {address}" if address else name}
+        for gid, name, address in rows
+    ]
 
-    if data.get("status") not in ("OK", "ZERO_RESULTS"):
-        raise HTTPException(status_code=400, detail=data)
 
-    return [{"place_id": p["place_id"], "description": p["description"]} for p in data.get("predictions", [])]
+def autocomplete_session(request: Request) -> Optional[str]:
+    """
+    Clé "dernière saisie gagne" : l'onglet (en-tête X-Thena-Tab, tiré au hasard
+    par l'UI), sous la session si connecté. Jamais l'IP seule : saisonniers
+    derrière le même NAT / wifi de station. Sans onglet : pas de remplacement.
+    """
+    tab = request.headers.get("x-thena-tab", "")[:64]
+    if not tab:
+        return None
+    owner = idempotency.owner_of(request.scope)
+    return f"tab:{tab}" if owner.startswith("ip:") else f"{owner}:{tab}"
+
+
+@app.get("/api/google/autocomplete")
+async def google_autocomplete(
+    request: Request, response: Response, q: str = Query(min_length=1), db: Session = Depends(get_db)
+):
+    # async : la déconnexion du client est vue pendant l'attente et annule l'appel Google non parti
+    require_google_key()
+    try:
+        return await autocomplete_gate.run(
+            autocomplete_session(request), request.receive, lambda: places_client.autocomplete(q)
+        )
+    except places.Superseded:
+        raise HTTPException(status_code=409, detail="Superseded by a newer autocomplete request")
+    except places.ClientGone:
+        return Response(status_code=499)  # personne ne lit la réponse (convention nginx)
+    except places.PlacesError as e:
+        raise HTTPException(status_code=400, detail=f"Google Places: {e.status}")
+    except places.PlacesUnavailable as e:
+        # repli : dernière réponse connue, puis établissements déjà en base
+        cached = places_client.stale(("autocomplete", q.strip().lower()))
+        if cached is not None:
+            response.headers["X-Thena-Fallback"] = "cache"
+            return cached["predictions"]
+        items = await run_in_threadpool(local_autocomplete, db, q)
+        if not items:
+            raise places_unavailable(e)
+        response.headers["X-Thena-Fallback"] = "local"
+        return items
 
 
 @app.get("/api/google/place")
-def google_place(place_id: str):
+def google_place(place_id: str, response: Response, db: Session = Depends(get_db)):
     require_google_key()
+    try:
+        return place_out(places_client.details(place_id))
+    except places.PlacesError as e:
+        raise HTTPException(status_code=404 if e.status == "NOT_FOUND" else 400, detail=f"Google Places: {e.status}")
+    except places.PlacesUnavailable as e:
+        cached = places_client.stale(("details", place_id))
+        if cached is not None:
+            response.headers["X-Thena-Fallback"] = "cache"
+            return place_out(cached)
+        est = db.query(Establishment).filter(Establishment.google_place_id == place_id).first()
+        if est is None:
+            raise places_unavailable(e)
+        response.headers["X-Thena-Fallback"] = "local"
+        return {
+            "google_place_id": est.google_place_id,
+            "name": est.name,
+            "address": est.address,
+            "google_rating": est.google_rating,
+            "types": establishment_index.parse_types(est.types_json),
+            "lat": est.lat,
+            "lng": est.lng,
+        }
 
-    url = "https://maps.googleapis.com/maps/api/place/details/json"
-    params = {
-        "place_id": place_id,
-        "fields": "place_id,name,formatted_address,rating,types",
-        "language": "fr",
-        "key": GOOGLE_API_KEY,
-    }
 
-    r = requests.get(url, params=params, timeout=15)
-    data = r.json()
+# ---------------- ESTABLISHMENTS ----------------
+# ?fields= / ?view=summary : réponses partielles (voir fieldsets.py)
+FIELDS_QUERY = Query(None, max_length=2000, description="champs séparés par des virgules (prime sur view)")
+VIEW_QUERY = Query(None, pattern="^(summary|full)$")
 
-    if data.get("status") != "OK":
-        raise HTTPException(status_code=400, detail=data)
 
-    result = data["result"]
-    return {
-        "google_place_id": result["place_id"],
-        "name": result["name"],
-        "address": result.get("formatted_address"),
-        "google_rating": result.get("rating"),
-        "types": result.get("types", []),
-    }
+def sparse_fields(fields: Optional[str], view: Optional[str], vocabulary, summary, always=("id",)):
+    try:
+        return fieldsets.parse(fields, view, vocabulary, summary, always)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def detail_fields(fields: Optional[str], view: Optional[str]):
+    return sparse_fields(fields, view, fieldsets.DETAIL_FIELDS, fieldsets.DETAIL_SUMMARY, ("establishment.id",))
+
+
+def json_response(data: bytes) -> Response:
+    return Response(content=data, media_type="application/json")
 
 
-# ---------------- ESTABLISHMENTS ----------------
 @app.post("/establishments", response_model=EstablishmentOut)
 def create_establishment(payload: EstablishmentCreate, db: Session = Depends(get_db)):
-    existing = db.query(Establishment).filter(Establishment.google_place_id == payload.google_place_id).first()
-    if existing:
-        return existing
-
-    est = Establishment(
+    # une seule instruction INSERT ... ON CONFLICT : pas de course sur google_place_id
+    has_location = payload.lat is not None and payload.lng is not None
+    created_at = datetime.utcnow()
+    ins = dialect_insert(engine)(Establishment).values(
         google_place_id=payload.google_place_id,
         name=payload.name,
         address=payload.address,
         google_rating=payload.google_rating,
         types_json=json.dumps(payload.types or []),
+        lat=payload.lat if has_location else None,
+        lng=payload.lng if has_location else None,
+        geo_cell=geo.geo_cell(payload.lat, payload.lng) if has_location else None,
+        created_at=created_at,
     )
-    db.add(est)
+    # établissement existant créé avant la géoloc : on profite des coordonnées reçues
+    stmt = ins.on_conflict_do_update(
+        index_elements=[Establishment.google_place_id],
+        set_={"lat": ins.excluded.lat, "lng": ins.excluded.lng, "geo_cell": ins.excluded.geo_cell},
+        where=Establishment.geo_cell.is_(None) & ins.excluded.geo_cell.isnot(None),
+    ).returning(Establishment)
+    est = db.scalars(stmt, execution_options={"populate_existing": True}).first()
+
+    if est is None:
+        # conflit sans mise à jour : rien à écrire, simple lecture
+        est = db.query(Establishment).filter(Establishment.google_place_id == payload.google_place_id).one()
+        return to_establishment_out(est)
+
+    out = to_establishment_out(est)
+    if est.created_at == created_at:
+        # vraiment inséré (et non mis à jour) : index des types
+        establishment_index.set_types(db, est)
     db.commit()
-    db.refresh(est)
-    return est
+    snapshots.mark_dirty(out.id)
+    return out
+
+
+@app.get("/establishments", response_model=EstablishmentPage)
+def list_establishments(
+    type: Optional[str] = Query(None, max_length=64),
+    sort: str = Query("thena_avg", pattern="^(thena_avg|recent)$"),
+    after: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    fields: Optional[str] = FIELDS_QUERY,
+    view: Optional[str] = VIEW_QUERY,
+    db: Session = Depends(get_db),
+):
+    selected = sparse_fields(fields, view, fieldsets.LIST_FIELDS, fieldsets.LIST_SUMMARY)
+    try:
+        rows, next_cursor = establishment_index.list_establishments(
+            db, type_=type, sort=sort, after=after, limit=limit,
+            columns=fieldsets.list_columns(selected) if selected else None,
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if selected:
+        serialize = fieldsets.list_serializer(selected)
+        return json_response(fieldsets.encode({"items": [serialize(est) for est in rows], "next_cursor": next_cursor}))
+    return EstablishmentPage(items=[to_establishment_summary(est) for est in rows], next_cursor=next_cursor)
+
+
+@app.get("/establishments/near", response_model=List[EstablishmentNear])
+def establishments_near(
+    lat: float = Query(ge=-90, le=90),
+    lng: float = Query(ge=-180, le=180),
+    radius: float = Query(5, gt=0, le=geo.MAX_RADIUS_KM, description="km"),
+    sort: str = Query("distance", pattern="^(distance|score)$"),
+    limit: int = Query(20, ge=1, le=100),
+    fields: Optional[str] = FIELDS_QUERY,
+    view: Optional[str] = VIEW_QUERY,
+    db: Session = Depends(get_db),
+):
+    selected = sparse_fields(fields, view, fieldsets.NEAR_FIELDS, fieldsets.NEAR_SUMMARY)
+    if selected:
+        hits = geo.near(db, lat, lng, radius, limit=limit, sort=sort, columns=fieldsets.list_columns(selected))
+        serialize = fieldsets.list_serializer(selected)
+        if "distance_km" in selected:
+            items = [{**serialize(est), "distance_km": round(distance, 3)} for est, distance in hits]
+        else:
+            items = [serialize(est) for est, _ in hits]
+        return json_response(fieldsets.encode(items))
+    return [
+        EstablishmentNear(**to_establishment_summary(est).model_dump(), distance_km=round(distance, 3))
+        for est, distance in geo.near(db, lat, lng, radius, limit=limit, sort=sort)
+    ]
+
+
+def serve_establishment(est_id: int, version: int, db: Session):
+    # snapshot à jour -> octets du fichier tels quels (ni ORM ni pydantic)
+    if SNAPSHOTS_ENABLED:
+        data = snapshots.read_fresh(est_id, version)
+        if data is not None:
+            return Response(content=data, media_type="application/json", headers={"X-Thena-Snapshot": "hit"})
+        snapshots.mark_dirty(est_id)
+    return build_establishment_stats(est_id, db)
+
+
+@app.post("/establishments/batch", response_model=EstablishmentBatch)
+def get_establishments_batch(
+    payload: EstablishmentBatchRequest,
+    fields: Optional[str] = FIELDS_QUERY,
+    view: Optional[str] = VIEW_QUERY,
+    db: Session = Depends(get_db),
+):
+    # nombre de requêtes constant quel que soit le nombre d'établissements demandés
+    selected = detail_fields(fields, view)
+    if selected is not None:
+        return json_response(
+            fieldsets.batch(db, payload.ids, payload.google_place_ids, payload.reviews_limit, selected)
+        )
+    ids = set(payload.ids)
+    gids = set(payload.google_place_ids)
+    if not ids and not gids:
+        return EstablishmentBatch(items={})
+
+    # 1) établissements (+ agrégats dénormalisés) : un seul IN
+    conds = []
+    if ids:
+        conds.append(Establishment.id.in_(ids))
+    if gids:
+        conds.append(Establishment.google_place_id.in_(gids))
+    ests = db.query(Establishment).filter(or_(*conds)).all()
+
+    # 2) top-M avis par établissement : une requête fenêtrée (+ auteurs en jointure)
+    by_est = {est.id: [] for est in ests}
+    if by_est and payload.reviews_limit:
+        ranked = (
+            db.query(
+                Review.id.label("id"),
+                func.row_number().over(
+                    partition_by=Review.establishment_id,
+                    order_by=(Review.created_at.desc(), Review.id.desc()),
+                ).label("rn"),
+            )
+            .filter(Review.establishment_id.in_(by_est))
+            .subquery()
+        )
+        reviews = (
+            db.query(Review)
+            .options(joinedload(Review.user))
+            .join(ranked, ranked.c.id == Review.id)
+            .filter(ranked.c.rn <= payload.reviews_limit)
+            .order_by(Review.establishment_id, ranked.c.rn)
+            .all()
+        )
+        for r in reviews:
+            by_est[r.establishment_id].append(r)
+
+    items = {
+        est.id: EstablishmentWithStats(
+            establishment=to_establishment_out(est),
+            reviews=[to_review_out(r) for r in by_est[est.id]],
+            thena_avg=est.thena_avg,
+            thena_count_scored=est.thena_count_scored,
+            thena_count_total=est.thena_count_total,
+            version=est.version or 0,
+        )
+        for est in ests
+    }
+    found_gids = {est.google_place_id for est in ests}
+    return EstablishmentBatch(
+        items=items,
+        missing_ids=sorted(ids - items.keys()),
+        missing_google_place_ids=sorted(gids - found_gids),
+    )
 
 
 @app.get("/establishments/by_google/{google_place_id}", response_model=EstablishmentWithStats)
-def get_by_google(google_place_id: str, db: Session = Depends(get_db)):
-    est = db.query(Establishment).filter(Establishment.google_place_id == google_place_id).first()
-    if not est:
+def get_by_google(
+    google_place_id: str,
+    fields: Optional[str] = FIELDS_QUERY,
+    view: Optional[str] = VIEW_QUERY,
+    db: Session = Depends(get_db),
+):
+    selected = detail_fields(fields, view)
+    row = (
+        db.query(Establishment.id, Establishment.version)
+        .filter(Establishment.google_place_id == google_place_id)
+        .first()
+    )
+    if not row:
         raise HTTPException(status_code=404, detail="Not in THENA")
-    return build_establishment_stats(est.id, db)
+    if selected is not None:
+        data = fieldsets.detail(db, row.id, selected)
+        if data is None:
+            raise HTTPException(status_code=404, detail="Not in THENA")
+        return json_response(data)
+    return serve_establishment(row.id, row.version, db)
 
 
 @app.get("/establishments/{establishment_id}", response_model=EstablishmentWithStats)
-def get_establishment(establishment_id: int, db: Session = Depends(get_db)):
-    est = db.query(Establishment).get(establishment_id)
-    if not est:
+def get_establishment(
+    establishment_id: int,
+    fields: Optional[str] = FIELDS_QUERY,
+    view: Optional[str] = VIEW_QUERY,
+    db: Session = Depends(get_db),
+):
+    selected = detail_fields(fields, view)
+    if selected is not None:
+        # pas de snapshot (fiche complète) : lecture des seules colonnes demandées
+        data = fieldsets.detail(db, establishment_id, selected)
+        if data is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        return json_response(data)
+    version = db.query(Establishment.version).filter(Establishment.id == establishment_id).scalar()
+    if version is None:
         raise HTTPException(status_code=404, detail="Not found")
-    return build_establishment_stats(est.id, db)
+    return serve_establishment(establishment_id, version, db)
+
+
+@app.get("/establishments/{establishment_id}/live")
+async def establishment_live(establishment_id: int, request: Request):
+    # SSE : deltas (review_upserted / review_deleted + agrégats) poussés après chaque écriture
+    return StreamingResponse(
+        live.event_stream(establishment_id, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 def build_establishment_stats(est_id: int, db: Session) -> EstablishmentWithStats:
     est = db.query(Establishment).get(est_id)
     reviews = (
         db.query(Review)
+        .options(joinedload(Review.user))
         .filter(Review.establishment_id == est_id)
         .order_by(Review.created_at.desc())
         .all()
@@ -253,88 +801,274 @@ def build_establishment_stats(est_id: int, db: Session) -> EstablishmentWithStat
     scores = [r.score for r in reviews if r.score is not None]
     avg = round(sum(scores) / len(scores), 1) if scores else None
 
-    try:
-        types = json.loads(est.types_json) if est.types_json else []
-    except Exception:
-        types = []
-
     return EstablishmentWithStats(
-        establishment=EstablishmentOut(
-            id=est.id,
-            google_place_id=est.google_place_id,
-            name=est.name,
-            address=est.address,
-            google_rating=est.google_rating,
-            types=types,
-            created_at=est.created_at,
-        ),
+        establishment=to_establishment_out(est),
         reviews=[to_review_out(r) for r in reviews],
         thena_avg=avg,
         thena_count_scored=len(scores),
         thena_count_total=len(reviews),
+        version=est.version or 0,
+    )
+
+
+@app.get("/establishments/{establishment_id}/changes", response_model=EstablishmentChanges)
+def establishment_changes(
+    establishment_id: int,
+    since: int = Query(0, ge=0),
+    db: Session = Depends(get_db),
+):
+    version = db.query(Establishment.version).filter(Establishment.id == establishment_id).scalar()
+    if version is None:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    q = db.query(Review).options(joinedload(Review.user)).filter(Review.establishment_id == establishment_id)
+    deleted = []
+    if since > 0:
+        # since=0 -> snapshot complet (les avis antérieurs au versioning ont version=0)
+        q = q.filter(Review.version > since)
+        deleted = [
+            t.review_id for t in
+            db.query(ReviewTombstone.review_id)
+            .filter(ReviewTombstone.establishment_id == establishment_id, ReviewTombstone.version > since)
+            .order_by(ReviewTombstone.version)
+        ]
+    reviews = q.order_by(Review.version).all()
+
+    return EstablishmentChanges(
+        establishment_id=establishment_id,
+        since=since,
+        version=version,
+        reviews=[to_review_out(r) for r in reviews],
+        deleted=deleted,
+        **review_aggregates(establishment_id, db),
     )
 
 
+# ---------------- LEADERBOARDS ----------------
+@app.get("/leaderboards/{board}", response_model=Leaderboard)
+def get_leaderboard(
+    board: str,
+    type: Optional[str] = Query(None, max_length=64, description="overall uniquement : classement par type"),
+    order: str = Query("best", pattern="^(best|worst)$"),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+):
+    if board not in leaderboards.BOARDS:
+        raise HTTPException(status_code=404, detail="Unknown leaderboard")
+    if type and board != "overall":
+        raise HTTPException(status_code=400, detail="type filter only applies to overall")
+    key = leaderboards.type_board(type) if type else board
+
+    prior_mean, prior_weight = leaderboards.get_params(db)
+    rows = leaderboards.top(db, key, limit=limit, worst=order == "worst")
+    return Leaderboard(
+        board=key,
+        order=order,
+        prior_mean=prior_mean,
+        prior_weight=prior_weight,
+        items=[
+            LeaderboardRow(
+                rank=i + 1,
+                score=round(entry.score, 3),
+                review_count=entry.review_count,
+                establishment=to_establishment_summary(est),
+            )
+            for i, (entry, est) in enumerate(rows)
+        ],
+    )
+
+
+# ---------------- STATS ----------------
+@app.get("/stats/rollups", response_model=RollupPage)
+def stats_rollups(
+    group_by: str = Query("month", description="dimensions séparées par des virgules : " + ",".join(rollups.DIMENSIONS)),
+    month_from: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+    month_to: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+    type: Optional[str] = Query(None, max_length=64),
+    role: Optional[str] = Query(None, max_length=80),
+    contract: Optional[str] = Query(None, max_length=40),
+    housing: Optional[str] = Query(None, max_length=40),
+    db: Session = Depends(get_db),
+):
+    # lit les rollups pré-agrégés (voir rollups.py), jamais reviews
+    dims = [d.strip() for d in group_by.split(",") if d.strip()]
+    unknown = [d for d in dims if d not in rollups.DIMENSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown dimension: {unknown[0]}")
+    items = rollups.query(
+        db, group_by=dims, month_from=month_from, month_to=month_to,
+        filters={"type": type, "role": role, "contract": contract, "housing": housing},
+    )
+    return RollupPage(group_by=[d for d in rollups.DIMENSIONS if d in dims], items=items)
+
+
+# ---------------- FEED ----------------
+@app.get("/feed", response_model=FeedPage)
+def get_feed(
+    after: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+):
+    try:
+        items, next_cursor = feed.latest(db, feed_buffer, after=after, limit=limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return FeedPage(items=[FeedItem(**item) for item in items], next_cursor=next_cursor)
+
+
+# ---------------- SEARCH ----------------
+@app.get("/search/reviews", response_model=ReviewSearchPage)
+def search_reviews(
+    q: str = Query(min_length=2, max_length=200),
+    role: Optional[str] = None,
+    contract: Optional[str] = None,
+    coupure: Optional[bool] = None,
+    unpaid_overtime: Optional[bool] = None,
+    toxic_manager: Optional[bool] = None,
+    harassment: Optional[bool] = None,
+    recommend: Optional[bool] = None,
+    limit: int = Query(20, ge=1, le=100),
+    after: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    try:
+        hits, next_cursor = search.search_reviews(
+            db, q, limit=limit, after=after,
+            role=role, contract=contract, coupure=coupure, unpaid_overtime=unpaid_overtime,
+            toxic_manager=toxic_manager, harassment=harassment, recommend=recommend,
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    ids = [review_id for review_id, _, _ in hits]
+    reviews = {
+        r.id: r for r in
+        db.query(Review)
+        .options(joinedload(Review.user), joinedload(Review.establishment))
+        .filter(Review.id.in_(ids))
+    } if ids else {}
+
+    items = [
+        ReviewSearchHit(
+            review=to_review_out(reviews[review_id]),
+            establishment_name=reviews[review_id].establishment.name,
+            snippet=snippet,
+            rank=rank,
+        )
+        for review_id, rank, snippet in hits
+        if review_id in reviews
+    ]
+    return ReviewSearchPage(items=items, next_cursor=next_cursor)
+
+
 # ---------------- REVIEWS (AUTH REQUIRED) ----------------
+REVIEW_FIELDS = (
+    "score", "comment", "role", "contract", "housing", "housing_quality",
+    "coupure", "unpaid_overtime", "toxic_manager", "harassment", "recommend",
+)
+
+
+def upsert_review(payload: ReviewCreate, user: User, db: Session) -> Optional[Review]:
+    """
+    1 avis max par (établissement, utilisateur) -> update si déjà existant (best UX).
+    INSERT ... ON CONFLICT DO UPDATE ... RETURNING : une instruction, sans
+    course sur uq_review_establishment_user. None si l'établissement n'existe pas.
+    """
+    version = bump_establishment_version(payload.establishment_id, db)
+    if version is None:
+        return None
+    previous = rollups.snapshot_existing(db, payload.establishment_id, user.id)  # à retirer des rollups
+    values = {name: getattr(payload, name) for name in REVIEW_FIELDS}
+    ins = dialect_insert(engine)(Review).values(
+        establishment_id=payload.establishment_id,
+        user_id=user.id,
+        version=version,
+        created_at=datetime.utcnow(),
+        **values,
+    )
+    stmt = ins.on_conflict_do_update(
+        index_elements=[Review.establishment_id, Review.user_id],
+        set_={name: ins.excluded[name] for name in (*REVIEW_FIELDS, "version")},
+    ).returning(Review)
+    review = db.scalars(stmt, execution_options={"populate_existing": True}).one()
+    set_committed_value(review, "user", user)  # pseudo déjà connu : pas de lazy load
+    pipeline.enqueue(db, review.id, review.version)  # texte, doublons : hors requête (pipeline.py)
+    rollups.on_review_upserted(db, review, previous, review.establishment.types_json)
+    return review
+
+
 @app.post("/reviews", response_model=ReviewOut)
 def create_or_update_review(
     payload: ReviewCreate,
+    request: Request,
     db: Session = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
-    est = db.query(Establishment).get(payload.establishment_id)
-    if not est:
+    enforce_rate_limit("review_write_user", user.id)
+    enforce_rate_limit("review_write_ip", client_ip(request))
+    review = upsert_review(payload, user, db)
+    if review is None:
         raise HTTPException(status_code=404, detail="Establishment not found")
 
-    # 1 avis max -> update si déjà existant (best UX)
-    existing = db.query(Review).filter(
-        Review.establishment_id == payload.establishment_id,
-        Review.user_id == user.id
-    ).first()
-
-    if existing:
-        existing.score = payload.score
-        existing.comment = payload.comment
-        existing.role = payload.role
-        existing.contract = payload.contract
-        existing.housing = payload.housing
-        existing.housing_quality = payload.housing_quality
-        existing.coupure = payload.coupure
-        existing.unpaid_overtime = payload.unpaid_overtime
-        existing.toxic_manager = payload.toxic_manager
-        existing.harassment = payload.harassment
-        existing.recommend = payload.recommend
-        db.commit()
-        db.refresh(existing)
-        return to_review_out(existing)
+    on_review_write(payload.establishment_id, db)
+    out = to_review_out(review)
+    est_name = review.establishment.name
+    duplicate_of = review.duplicate_of_id
+    db.commit()
+    eventlog.emit("review.upserted", review_id=out.id, establishment_id=out.establishment_id,
+                  user_id=user.id, duplicate_of=duplicate_of)
+    publish_review_upserted(out, est_name, db)
+    snapshots.mark_dirty(out.establishment_id)
+    return out
 
-    review = Review(
-        establishment_id=payload.establishment_id,
-        user_id=user.id,
-        score=payload.score,
-        comment=payload.comment,
-        role=payload.role,
-        contract=payload.contract,
-        housing=payload.housing,
-        housing_quality=payload.housing_quality,
-        coupure=payload.coupure,
-        unpaid_overtime=payload.unpaid_overtime,
-        toxic_manager=payload.toxic_manager,
-        harassment=payload.harassment,
-        recommend=payload.recommend,
-    )
-    db.add(review)
+
+@app.post("/reviews/batch", response_model=List[ReviewOut])
+def create_or_update_reviews_batch(
+    payload: ReviewBatch,
+    request: Request,
+    db: Session = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    # un lot compte pour autant d'écritures que d'avis
+    enforce_rate_limit("review_write_user", user.id, cost=len(payload.reviews))
+    enforce_rate_limit("review_write_ip", client_ip(request), cost=len(payload.reviews))
+    # avis mis en file hors-ligne : tout ou rien, une seule transaction
+    reviews = []
+    for item in payload.reviews:
+        review = upsert_review(item, user, db)
+        if review is None:
+            db.rollback()
+            raise HTTPException(status_code=404, detail=f"Establishment {item.establishment_id} not found")
+        reviews.append(review)
+
+    est_ids = sorted({r.establishment_id for r in reviews})
+    for est_id in est_ids:
+        on_review_write(est_id, db)
+    # un même établissement envoyé deux fois : seule la dernière écriture compte
+    latest = {r.id: r for r in reviews}
+    outs = [(to_review_out(r), r.establishment.name) for r in latest.values()]
     db.commit()
-    db.refresh(review)
-    return to_review_out(review)
+    for out, _ in outs:
+        eventlog.emit("review.upserted", review_id=out.id, establishment_id=out.establishment_id,
+                      user_id=user.id, batch=True)
+
+    for out, est_name in outs:
+        publish_review_upserted(out, est_name, db)
+    for est_id in est_ids:
+        snapshots.mark_dirty(est_id)
+    return [out for out, _ in outs]
 
 
 @app.delete("/reviews/{review_id}")
 def delete_review(
     review_id: int,
+    request: Request,
     db: Session = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
+    enforce_rate_limit("review_write_user", user.id)
+    enforce_rate_limit("review_write_ip", client_ip(request))
+
     r = db.query(Review).get(review_id)
     if not r:
         raise HTTPException(status_code=404, detail="Review not found")
@@ -342,16 +1076,107 @@ def delete_review(
     if r.user_id != user.id:
         raise HTTPException(status_code=403, detail="Forbidden")
 
+    est_id = r.establishment_id
+    version = bump_establishment_version(est_id, db)
+    db.add(ReviewTombstone(establishment_id=est_id, review_id=review_id, version=version))
+    rollups.on_review_deleted(db, r, r.establishment.types_json)
     db.delete(r)
+    db.flush()
+    on_review_write(est_id, db)
     db.commit()
-    return {"ok": True}
+    eventlog.emit("review.deleted", review_id=review_id, establishment_id=est_id, user_id=user.id)
+    publish_review_deleted(review_id, est_id, version, db)
+    snapshots.mark_dirty(est_id)
+    return {"ok": True, "version": version}
+
+
+# ---------------- MODERATION (ADMIN) ----------------
+@app.get("/moderation/duplicates", response_model=List[DuplicateReview], dependencies=[Depends(require_admin)])
+def list_duplicate_reviews(
+    limit: int = Query(50, ge=1, le=200),
+    db: Session = Depends(get_db),
+):
+    # avis marqués par dedup.py, les plus récents d'abord
+    reviews = (
+        db.query(Review)
+        .options(joinedload(Review.user))
+        .filter(Review.duplicate_of_id.isnot(None))
+        .order_by(Review.created_at.desc(), Review.id.desc())
+        .limit(limit)
+        .all()
+    )
+    return [
+        DuplicateReview(
+            review=to_review_out(r),
+            duplicate_of_id=r.duplicate_of_id,
+            similarity=r.duplicate_similarity,
+        )
+        for r in reviews
+    ]
+
+
+@app.get("/moderation/flagged", response_model=List[FlaggedReview], dependencies=[Depends(require_admin)])
+def list_flagged_reviews(
+    limit: int = Query(50, ge=1, le=200),
+    db: Session = Depends(get_db),
+):
+    # données personnelles ou grossièretés repérées par le pipeline, les plus récents d'abord
+    reviews = (
+        db.query(Review)
+        .options(joinedload(Review.user))
+        .filter(or_(Review.pii_count > 0, Review.profanity_count > 0))
+        .order_by(Review.created_at.desc(), Review.id.desc())
+        .limit(limit)
+        .all()
+    )
+    return [
+        FlaggedReview(
+            review=to_review_out(r),
+            language=r.language,
+            pii_count=r.pii_count,
+            profanity_count=r.profanity_count,
+        )
+        for r in reviews
+    ]
+
+
+@app.post("/moderation/accounts/purge", response_model=AccountPurgeResult, dependencies=[Depends(require_admin)])
+def purge_user_accounts(payload: AccountPurgeRequest):
+    # lots courts dans le budget de temps ; remaining_user_ids non vide -> rappeler avec ces ids
+    result = purge_accounts(payload.user_ids, payload.budget_seconds)
+    eventlog.emit(
+        "accounts.purged",
+        users=result["users_deleted"],
+        reviews=result["reviews_deleted"],
+        remaining=len(result["remaining_user_ids"]),
+        ms=result["elapsed_ms"],
+    )
+    return result
+
+
+# ---------------- SNAPSHOTS (statique / CDN) ----------------
+if SNAPSHOTS_ENABLED:
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    app.mount("/snapshots", StaticFiles(directory=SNAPSHOT_DIR), name="snapshots")
 
 
 # ---------------- UI ----------------
-app.mount("/ui", StaticFiles(directory="ui", html=True), name="ui")
+# fichiers en mémoire, empreintes + variantes gzip/brotli pré-calculées (voir static_assets.py)
+ui_assets = StaticAssets("ui")
+
+
+@app.api_route("/ui/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+def ui_file(path: str, request: Request):
+    return ui_assets.response(path, request)
+
+
+@app.api_route("/", methods=["GET", "HEAD"], include_in_schema=False)
+def root(request: Request):
+    return ui_assets.response("index.html", request)
 
 
-@app.get("/")
-def root():
-    return FileResponse("ui/index.html")
+@app.api_route("/sw.js", methods=["GET", "HEAD"], include_in_schema=False)
+def service_worker(request: Request):
+    # à la racine : la portée du worker couvre "/" et les appels API de la page
+    return ui_assets.response(static_assets.SERVICE_WORKER, request)
 
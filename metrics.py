@@ -0,0 +1,23 @@
+# metrics.py
+"""
+Registre de métriques minimal exposé sur GET /metrics (JSON).
+
+Chaque sous-système enregistre une fonction qui renvoie un dict instantané ;
+pas de dépendance externe (prometheus & co).
+"""
+import threading
+from typing import Callable, Dict
+
+_collectors: Dict[str, Callable[[], dict]] = {}
+_lock = threading.Lock()
+
+
+def register(name: str, collector: Callable[[], dict]):
+    with _lock:
+        _collectors[name] = collector
+
+
+def snapshot() -> dict:
+    with _lock:
+        collectors = list(_collectors.items())
+    return {name: collect() for name, collect in collectors}
@@ -1,8 +1,8 @@
 # models.py
 from datetime import datetime
 from sqlalchemy import (
-    Column, Integer, String, Float, DateTime, ForeignKey, Text, Boolean,
-    UniqueConstraint
+    Column, Integer, String, Float, DateTime, ForeignKey, Text, Boolean, LargeBinary,
+    UniqueConstraint, Index
 )
 from sqlalchemy.orm import relationship
 
@@ -17,9 +17,11 @@ class User(Base):
     pseudo = Column(String(50), index=True, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
-    reviews = relationship("Review", back_populates="user", cascade="all, delete-orphan")
-    login_tokens = relationship("LoginToken", back_populates="user", cascade="all, delete-orphan")
-    sessions = relationship("Session", back_populates="user", cascade="all, delete-orphan")
+    # passive_deletes : pas de chargement des enfants, ON DELETE CASCADE en base ; supprimer un
+    # compte passe par accounts.py (agrégats, rollups et classements des établissements)
+    reviews = relationship("Review", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
+    login_tokens = relationship("LoginToken", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
+    sessions = relationship("Session", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
 
 
 class LoginToken(Base):
@@ -30,7 +32,7 @@ class LoginToken(Base):
     __tablename__ = "login_tokens"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
 
     token_hash = Column(String(64), unique=True, index=True, nullable=False)
 
@@ -49,7 +51,7 @@ class Session(Base):
     __tablename__ = "sessions"
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
 
     session_hash = Column(String(64), unique=True, index=True, nullable=False)
     expires_at = Column(DateTime, nullable=False)
@@ -71,15 +73,60 @@ class Establishment(Base):
     google_rating = Column(Float, nullable=True)
     types_json = Column(Text, nullable=True)
 
+    # version monotone, incrémentée à chaque écriture d'avis (delta-sync)
+    version = Column(Integer, default=0, server_default="0", nullable=False)
+
+    # agrégats dénormalisés, tenus à jour dans la transaction d'écriture des avis
+    thena_avg = Column(Float, nullable=True)
+    thena_count_scored = Column(Integer, default=0, server_default="0", nullable=False)
+    thena_count_total = Column(Integer, default=0, server_default="0", nullable=False)
+    sort_avg = Column(Float, default=-1, server_default="-1", nullable=False)  # thena_avg, -1 si pas de note
+    score_sum = Column(Float, default=0, server_default="0", nullable=False)
+    harassment_count = Column(Integer, default=0, server_default="0", nullable=False)
+    unpaid_overtime_count = Column(Integer, default=0, server_default="0", nullable=False)
+
+    # géoloc (Places geometry/location) + cellule de grille indexée (voir geo.py)
+    lat = Column(Float, nullable=True)
+    lng = Column(Float, nullable=True)
+    geo_cell = Column(Integer, nullable=True)
+    geo_not_found_at = Column(DateTime, nullable=True)  # Places sans coordonnées : backfill ne redemande pas
+
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
     reviews = relationship("Review", back_populates="establishment", cascade="all, delete-orphan")
+    type_rows = relationship("EstablishmentType", cascade="all, delete-orphan")
+
+    __table_args__ = (
+        Index("ix_establishments_sort_avg", "sort_avg", "id"),
+        # couvrant pour geo.near : les candidats sont lus dans l'index seul
+        Index("ix_establishments_geo", "geo_cell", "lat", "lng", "sort_avg"),
+    )
+
+
+class EstablishmentType(Base):
+    """
+    Types Google normalisés (1 ligne par type) : filtrage et tri indexés,
+    types_json reste la source d'affichage.
+    """
+    __tablename__ = "establishment_types"
+    __table_args__ = (
+        Index("ix_establishment_types_type_sort", "type", "sort_avg", "establishment_id"),
+    )
+
+    establishment_id = Column(Integer, ForeignKey("establishments.id", ondelete="CASCADE"), primary_key=True)
+    type = Column(String(64), primary_key=True)
+
+    sort_avg = Column(Float, default=-1, server_default="-1", nullable=False)  # copie de establishments.sort_avg
 
 
 class Review(Base):
     __tablename__ = "reviews"
     __table_args__ = (
         UniqueConstraint("establishment_id", "user_id", name="uq_review_establishment_user"),
+        Index("ix_reviews_establishment_version", "establishment_id", "version"),
+        Index("ix_reviews_created", "created_at", "id"),  # fil global (feed.py)
+        Index("ix_reviews_duplicate_of", "duplicate_of_id"),  # file de modération (dedup.py)
+        Index("ix_reviews_user", "user_id"),  # purge de comptes (accounts.py) + contrôle ON DELETE CASCADE
     )
 
     id = Column(Integer, primary_key=True, index=True)
@@ -102,10 +149,145 @@ class Review(Base):
     harassment = Column(Boolean, default=False, nullable=False)
     recommend = Column(Boolean, default=False, nullable=False)
 
+    # version de l'établissement au moment de la dernière écriture de cet avis
+    version = Column(Integer, default=0, server_default="0", nullable=False)
+
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
+    # quasi-doublon suspecté d'un autre avis (voir dedup.py), à modérer
+    duplicate_of_id = Column(Integer, ForeignKey("reviews.id", ondelete="SET NULL"), nullable=True)
+    duplicate_similarity = Column(Float, nullable=True)
+
+    # résultats du pipeline hors requête (voir pipeline.py) ; NULL = pas encore traité
+    language = Column(String(8), nullable=True)
+    pii_count = Column(Integer, nullable=True)        # emails, téléphones, IBAN dans le commentaire
+    profanity_count = Column(Integer, nullable=True)
+    processed_version = Column(Integer, nullable=True)  # version de l'avis analysée
+
     establishment = relationship("Establishment", back_populates="reviews")
     user = relationship("User", back_populates="reviews")
 
 
+class ReviewTombstone(Base):
+    """
+    Trace d'un avis supprimé : permet aux clients (cache local) de voir la
+    suppression via /establishments/{id}/changes?since=<version>.
+    """
+    __tablename__ = "review_tombstones"
+    __table_args__ = (
+        Index("ix_review_tombstones_establishment_version", "establishment_id", "version"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    establishment_id = Column(Integer, ForeignKey("establishments.id", ondelete="CASCADE"), nullable=False)
+    review_id = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False)
+
+    deleted_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+
+class ReviewSignature(Base):
+    """
+    Signature MinHash du commentaire (dedup.py), rechargée en mémoire au
+    démarrage. Vide si le commentaire est trop court pour être comparé.
+    """
+    __tablename__ = "review_signatures"
+
+    review_id = Column(Integer, ForeignKey("reviews.id", ondelete="CASCADE"), primary_key=True)
+    signature = Column(LargeBinary, nullable=False)
+
+
+class ReviewJob(Base):
+    """
+    File durable du pipeline de post-traitement des avis (pipeline.py) : une
+    ligne par avis à (re)traiter, les modifications successives fusionnent.
+    status : pending -> running -> (ligne supprimée) ; dead après
+    pipeline.MAX_ATTEMPTS échecs (dead letter, à relancer à la main).
+    """
+    __tablename__ = "review_jobs"
+    __table_args__ = (Index("ix_review_jobs_status_available", "status", "available_at"),)
+
+    review_id = Column(Integer, ForeignKey("reviews.id", ondelete="CASCADE"), primary_key=True)
+    version = Column(Integer, nullable=False)  # version de l'avis à traiter
+    status = Column(String(10), nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    enqueued_at = Column(DateTime, nullable=False)
+    available_at = Column(DateTime, nullable=False)  # nouvel essai différé (backoff)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+
+
+class ReviewRollup(Base):
+    """
+    Agrégats analytiques par (mois, type, rôle, contrat, logement), un
+    "grouping set" par grain, tenus à jour par deltas à chaque écriture d'avis
+    (voir rollups.py). "*" = tous confondus ; "" = dimension non renseignée.
+    """
+    __tablename__ = "review_rollups"
+    __table_args__ = {"sqlite_with_rowid": False}  # rangées rangées par clé : un grain = lecture contiguë
+
+    grain = Column(Integer, primary_key=True)  # masque des dimensions gardées (rôle, contrat, logement)
+    type = Column(String(64), primary_key=True)
+    month = Column(String(7), primary_key=True)  # "YYYY-MM"
+    role = Column(String(80), primary_key=True)
+    contract = Column(String(40), primary_key=True)
+    housing = Column(String(40), primary_key=True)
+
+    review_count = Column(Integer, default=0, nullable=False)
+    scored_count = Column(Integer, default=0, nullable=False)
+    score_sum = Column(Float, default=0, nullable=False)
+    coupure_count = Column(Integer, default=0, nullable=False)
+    unpaid_overtime_count = Column(Integer, default=0, nullable=False)
+    toxic_manager_count = Column(Integer, default=0, nullable=False)
+    harassment_count = Column(Integer, default=0, nullable=False)
+    recommend_count = Column(Integer, default=0, nullable=False)
+
+
+class IdempotencyKey(Base):
+    """
+    Première réponse d'une requête portant un en-tête Idempotency-Key, rejouée
+    telle quelle aux essais suivants (voir idempotency.py). status NULL =
+    requête en cours (verrou, repris après idempotency.LOCK_SECONDS).
+    """
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (Index("ix_idempotency_keys_expires", "expires_at"),)
+
+    owner = Column(String(80), primary_key=True)  # "s:<hash du cookie de session>" ou "ip:<adresse>"
+    idem_key = Column(String(255), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)  # sha256(méthode, chemin, query, corps)
+
+    status = Column(Integer, nullable=True)
+    headers = Column(Text, nullable=True)  # JSON [[nom, valeur], ...]
+    body = Column(LargeBinary, nullable=True)
+
+    locked_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class LeaderboardEntry(Base):
+    """
+    Classements matérialisés (voir leaderboards.py), 1 ligne par
+    (classement, établissement) ; top-N = lecture de l'index (board, score).
+    board : "overall", "type:<type google>", "harassment", "unpaid_overtime"
+    """
+    __tablename__ = "leaderboard_entries"
+    __table_args__ = (
+        Index("ix_leaderboard_entries_board_score", "board", "score", "establishment_id"),
+        Index("ix_leaderboard_entries_establishment", "establishment_id"),
+    )
+
+    board = Column(String(80), primary_key=True)
+    establishment_id = Column(Integer, ForeignKey("establishments.id", ondelete="CASCADE"), primary_key=True)
+
+    score = Column(Float, nullable=False)
+    review_count = Column(Integer, nullable=False)
+
+
+class LeaderboardParams(Base):
+    """Paramètres partagés par tous les workers (prior bayésien figé entre deux rebuilds)."""
+    __tablename__ = "leaderboard_params"
 
+    id = Column(Integer, primary_key=True)
+    prior_mean = Column(Float, nullable=False)
+    prior_weight = Column(Float, nullable=False)
+    rebuilt_at = Column(DateTime, default=datetime.utcnow, nullable=False)
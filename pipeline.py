@@ -0,0 +1,446 @@
+# pipeline.py
+"""
+Post-traitement des avis hors du chemin de la requête.
+
+Le handler commit l'avis brut et une ligne dans review_jobs (même
+transaction : rien ne se perd si le process meurt). Le travail CPU se fait
+ici, dans un ProcessPoolExecutor (hors GIL) :
+- normalisation du texte (NFC, espaces) ;
+- détection de la langue (mots-outils fr / en / es / it / de / pt) ;
+- repérage des données personnelles (emails, téléphones, IBAN) et des
+  grossièretés : compteurs pour la modération ;
+- signature MinHash (dedup.py) : la recherche de quasi-doublons se fait au
+  retour, dans l'index du worker.
+Au retour, `apply_result` (fourni par main.py) renvoie les colonnes de
+l'avis à écrire ; un UPDATE en executemany par lot. Après commit, `publish`
+diffuse un événement "review_signature" par avis : les autres workers
+indexent la signature calculée ici au lieu de la recalculer.
+
+- un seul consommateur par machine (verrou fichier, comme BackupJob) ; les
+  autres workers ne font qu'enfiler. Il réclame les jobs par lots
+  (UPDATE ... RETURNING, SKIP LOCKED sur Postgres) ;
+- backpressure : au plus IN_FLIGHT_PER_PROCESS lots par process du pool ;
+  le reste attend dans la table, pas en mémoire. Un avis modifié plusieurs
+  fois avant traitement = un seul job (dernière version) ;
+- échec : nouvel essai avec backoff exponentiel, "dead" après MAX_ATTEMPTS
+  (dead letter) ; un job "running" abandonné (process mort) est repris après
+  LEASE_SECONDS ;
+- métriques : jobs en attente, âge du plus ancien (queue lag), dead letters.
+
+Les agrégats (établissement, classements, rollups) et l'index plein texte
+restent dans la transaction d'écriture : quelques ms, et deltas non
+idempotents (un nouvel essai les compterait deux fois).
+
+    python pipeline.py              # état de la file
+    python pipeline.py dead         # dead letters
+    python pipeline.py retry-dead   # les remet en file
+"""
+import fcntl
+import functools
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import DateTime, bindparam, text
+from sqlalchemy.orm import Session
+
+import dedup
+from models import Review
+
+PIPELINE_PROCESSES = int(os.getenv("THENA_PIPELINE_PROCESSES", "2"))  # 0 : dans le thread consommateur
+PIPELINE_BATCH = int(os.getenv("THENA_PIPELINE_BATCH", "64"))
+PIPELINE_POLL_SECONDS = float(os.getenv("THENA_PIPELINE_POLL_SECONDS", "0.5"))
+PIPELINE_LOCK = os.getenv("THENA_PIPELINE_LOCK", "./thena_pipeline.lock")
+MAX_ATTEMPTS = int(os.getenv("THENA_PIPELINE_MAX_ATTEMPTS", "5"))
+IN_FLIGHT_PER_PROCESS = 2
+LEASE_SECONDS = 300
+BACKOFF_MAX_SECONDS = 600
+
+PENDING, RUNNING, DEAD = "pending", "running", "dead"
+
+
+# ---------------- analyse (process du pool) ----------------
+_SPACES_RE = re.compile(r"\s+")
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+_PHONE_RE = re.compile(r"(?<!\w)(?:\+\d{2}[\s.-]?|0)[1-9](?:[\s.-]?\d{2}){4}(?!\w)")
+_IBAN_RE = re.compile(r"\b[A-Z]{2}\d{2}(?:\s?[A-Z0-9]{4}){3,7}(?:\s?[A-Z0-9]{1,4})?\b")
+
+STOPWORDS = {
+    "fr": {"le", "la", "les", "des", "et", "est", "une", "pas", "que", "qui", "pour", "dans", "avec", "sur", "mais",
+           "tres", "tout", "on", "nous", "je", "il", "elle", "du", "au", "ce", "sont", "bien"},
+    "en": {"the", "and", "is", "was", "are", "not", "for", "with", "but", "very", "you", "they", "this", "that",
+           "of", "to", "it", "we", "my", "were", "have", "good", "staff"},
+    "es": {"el", "los", "las", "y", "es", "una", "muy", "pero", "con", "para", "por", "que", "del", "trabajo",
+           "no", "se", "lo", "mi"},
+    "it": {"il", "gli", "di", "e", "che", "non", "per", "con", "una", "sono", "molto", "ma", "lavoro", "della",
+           "anche", "mi"},
+    "de": {"der", "die", "das", "und", "ist", "nicht", "mit", "sehr", "ein", "eine", "aber", "ich", "wir", "zu",
+           "war", "auf"},
+    "pt": {"o", "os", "as", "e", "uma", "muito", "mas", "com", "para", "por", "nao", "do", "da", "trabalho",
+           "em", "eu"},
+}
+PROFANITY = {
+    "merde", "putain", "connard", "connasse", "salope", "encule", "enculé", "batard", "bâtard", "con", "conne",
+    "pute", "nique", "abruti", "fuck", "fucking", "shit", "bitch", "asshole", "bastard",
+}
+
+
+def normalize_text(comment: str) -> str:
+    return _SPACES_RE.sub(" ", unicodedata.normalize("NFC", comment)).strip()
+
+
+def detect_language(words: List[str]) -> Optional[str]:
+    """Langue dont les mots-outils sont les plus fréquents ; None si moins de 3 indices."""
+    scores = {lang: sum(1 for w in words if w in stop) for lang, stop in STOPWORDS.items()}
+    lang, hits = max(scores.items(), key=lambda item: item[1])
+    return lang if hits >= 3 else None
+
+
+def count_pii(comment: str) -> int:
+    return sum(len(regex.findall(comment)) for regex in (_EMAIL_RE, _PHONE_RE, _IBAN_RE))
+
+
+def analyze(comment: Optional[str]) -> dict:
+    text_ = normalize_text(comment or "")
+    words = dedup.normalize_words(text_)  # minuscules, sans accents
+    sig = dedup.signature(text_)
+    return {
+        "language": detect_language(words),
+        "pii_count": count_pii(text_),
+        "profanity_count": sum(1 for w in words if w in PROFANITY),
+        "signature": sig.tobytes() if sig is not None else b"",
+    }
+
+
+def analyze_batch(items: List[Tuple[int, str]]) -> Dict[int, dict]:
+    """Un lot par aller-retour avec le pool ; une erreur n'échoue que son avis."""
+    out = {}
+    for review_id, comment in items:
+        try:
+            out[review_id] = analyze(comment)
+        except Exception as e:
+            out[review_id] = {"error": repr(e)}
+    return out
+
+
+# ---------------- file (table review_jobs) ----------------
+def _dt(*names):
+    return [bindparam(name, type_=DateTime) for name in names]
+
+
+# même syntaxe SQLite / Postgres ; text() pour rester sur le cache d'instructions
+_ENQUEUE = text(
+    "INSERT INTO review_jobs (review_id, version, status, attempts, enqueued_at, available_at)"
+    " VALUES (:review_id, :version, 'pending', 0, :now, :now)"
+    " ON CONFLICT (review_id) DO UPDATE SET version = excluded.version, status = 'pending', attempts = 0,"
+    " available_at = excluded.available_at, last_error = NULL,"
+    # déjà en attente : on garde l'heure d'origine (queue lag)
+    " enqueued_at = CASE WHEN review_jobs.status = 'pending' THEN review_jobs.enqueued_at"
+    " ELSE excluded.enqueued_at END"
+).bindparams(*_dt("now"))
+
+_CLAIM_SQL = (
+    "UPDATE review_jobs SET status = 'running', locked_at = :now, attempts = attempts + 1"
+    " WHERE review_id IN (SELECT review_id FROM review_jobs"
+    " WHERE (status = 'pending' AND available_at <= :now) OR (status = 'running' AND locked_at < :stale)"
+    " ORDER BY available_at LIMIT :n{lock})"
+    " RETURNING review_id, version, attempts"
+)
+_CLAIM = {
+    dialect: text(_CLAIM_SQL.format(lock=lock)).bindparams(*_dt("now", "stale"))
+    for dialect, lock in (("sqlite", ""), ("postgresql", " FOR UPDATE SKIP LOCKED"))
+}
+
+_DONE = text("DELETE FROM review_jobs WHERE review_id = :review_id AND version = :version AND status = 'running'")
+
+# WHERE version : un job ré-enfilé entre-temps (nouvelle version) n'est pas touché
+_RETRY = text(
+    "UPDATE review_jobs SET status = :status, available_at = :available_at, last_error = :error"
+    " WHERE review_id = :review_id AND version = :version AND status = 'running'"
+).bindparams(*_dt("available_at"))
+
+_RETRY_DEAD = text(
+    "UPDATE review_jobs SET status = 'pending', attempts = 0, available_at = :now WHERE status = 'dead'"
+).bindparams(*_dt("now"))
+
+
+@functools.lru_cache(maxsize=8)
+def _update_reviews(columns: Tuple[str, ...]):
+    # executemany ; WHERE version : un avis réécrit pendant l'analyse n'est pas écrasé
+    sets = ", ".join(f"{c} = :{c}" for c in columns if c not in ("id", "version"))
+    return text(f"UPDATE reviews SET {sets}, processed_version = :version WHERE id = :id AND version = :version")
+
+
+def enqueue(db: Session, review_id: int, version: int):
+    """Dans la transaction d'écriture de l'avis."""
+    db.execute(_ENQUEUE, {"review_id": review_id, "version": version, "now": datetime.utcnow()})
+
+
+def backfill(session_factory) -> int:
+    """Met en file les avis jamais traités (colonnes ajoutées après coup)."""
+    with session_factory() as db:
+        n = db.execute(text(
+            "INSERT INTO review_jobs (review_id, version, status, attempts, enqueued_at, available_at)"
+            " SELECT id, version, 'pending', 0, :now, :now FROM reviews WHERE processed_version IS NULL"
+            " ON CONFLICT (review_id) DO NOTHING"
+        ).bindparams(*_dt("now")), {"now": datetime.utcnow()}).rowcount
+        db.commit()
+    return n
+
+
+def queue_stats(db: Session) -> dict:
+    counts = dict(db.execute(text("SELECT status, count(*) FROM review_jobs GROUP BY status")).all())
+    oldest = db.execute(
+        text("SELECT min(enqueued_at) AS oldest FROM review_jobs WHERE status != 'dead'").columns(oldest=DateTime)
+    ).scalar()
+    return {
+        "pending": counts.get(PENDING, 0),
+        "running": counts.get(RUNNING, 0),
+        "dead": counts.get(DEAD, 0),
+        "lag_seconds": round((datetime.utcnow() - oldest).total_seconds(), 3) if oldest else 0.0,
+    }
+
+
+# ---------------- consommateur ----------------
+Job = Tuple[int, int, int]  # (review_id, version, attempts)
+
+
+class ReviewPipeline:
+    """Consommateur en thread de fond (même schéma que RebuildJob / BackupJob)."""
+
+    def __init__(self, session_factory, apply_result: Callable[[Session, int, dict], dict],
+                 processes: int = PIPELINE_PROCESSES, batch: int = PIPELINE_BATCH,
+                 poll_seconds: float = PIPELINE_POLL_SECONDS, lock_path: str = PIPELINE_LOCK,
+                 publish: Optional[Callable[[int, dict], None]] = None):
+        self.session_factory = session_factory
+        self.apply_result = apply_result
+        self.publish = publish  # live.publish (main.py) ; pas d'import ici : le pool importe ce module
+        self.processes = processes
+        self.batch = batch
+        self.poll_seconds = poll_seconds
+        self.lock_path = lock_path
+        self.leader = False
+        self._lock_file = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._counters_lock = threading.Lock()
+        self.counters = {"processed": 0, "skipped": 0, "retried": 0, "dead_lettered": 0, "batches": 0,
+                         "pool_restarts": 0}
+        self.last_batch_ms = None
+
+    def _count(self, name: str, n: int = 1):
+        with self._counters_lock:
+            self.counters[name] += n
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="thena-pipeline", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        if self._lock_file is not None:
+            self._lock_file.close()  # libère le verrou : un autre worker prend le relais
+            self._lock_file = None
+            self.leader = False
+
+    def _try_lead(self) -> bool:
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_path, "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self.leader = True
+        return True
+
+    def _get_pool(self) -> Optional[ProcessPoolExecutor]:
+        if self.processes <= 0:
+            return None
+        if self._pool is None:
+            # spawn : pas de fork d'un process à threads (verrous hérités)
+            self._pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def _run(self):
+        in_flight: Dict = {}
+        while not self._stop.is_set():
+            try:
+                if not self.leader and not self._try_lead():
+                    self._stop.wait(self.poll_seconds * 10)
+                    continue
+                self._pump(in_flight)
+            except Exception as e:
+                print("PIPELINE: failed:", repr(e))
+                self._stop.wait(self.poll_seconds)
+        # arrêt : les lots en cours repartent en file tout de suite (sans attendre LEASE_SECONDS)
+        jobs = [job for batch, _ in in_flight.values() for job in batch]
+        if jobs:
+            try:
+                self._release(jobs)
+            except Exception as e:
+                print("PIPELINE: release failed:", repr(e))
+
+    def _pump(self, in_flight: Dict):
+        # backpressure : pas plus de lots en cours que le pool n'en absorbe
+        pool = self._get_pool()
+        drained = False
+        while len(in_flight) < max(1, self.processes) * IN_FLIGHT_PER_PROCESS:
+            jobs, items = self.claim(self.batch)
+            if jobs:
+                started = time.perf_counter()
+                if pool is None:
+                    self.finish(jobs, analyze_batch(items), started)
+                else:
+                    in_flight[pool.submit(analyze_batch, items)] = (jobs, started)
+            if len(jobs) < self.batch:
+                # file vidée : les suivants s'accumulent jusqu'au prochain tour (lots plus gros,
+                # moins de transactions d'écriture concurrentes des requêtes)
+                drained = True
+                break
+        if not in_flight:
+            self._stop.wait(self.poll_seconds)
+            return
+        done, _ = wait(list(in_flight), timeout=self.poll_seconds, return_when=FIRST_COMPLETED)
+        for future in done:
+            jobs, started = in_flight.pop(future)
+            try:
+                results = future.result()
+            except Exception as e:  # pool cassé (process tué, OOM) : on le recrée
+                self._count("pool_restarts")
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False, cancel_futures=True)
+                    self._pool = None
+                results = {review_id: {"error": repr(e)} for review_id, _, _ in jobs}
+            self.finish(jobs, results, started)
+        if drained and not in_flight:
+            self._stop.wait(self.poll_seconds)
+
+    def claim(self, n: int) -> Tuple[List[Job], List[Tuple[int, str]]]:
+        now = datetime.utcnow()
+        with self.session_factory() as db:
+            claim = _CLAIM["postgresql" if db.get_bind().dialect.name == "postgresql" else "sqlite"]
+            jobs = [tuple(row) for row in db.execute(claim, {
+                "now": now, "stale": now - timedelta(seconds=LEASE_SECONDS), "n": n,
+            })]
+            db.commit()
+            if not jobs:
+                return [], []
+            comments = dict(
+                db.query(Review.id, Review.comment).filter(Review.id.in_([j[0] for j in jobs])).all()
+            )
+        return jobs, [(review_id, comments.get(review_id) or "") for review_id, _, _ in jobs]
+
+    def finish(self, jobs: List[Job], results: Dict[int, dict], started: float):
+        """Écrit les résultats d'un lot ; en cas d'erreur, avis par avis."""
+        ok = [j for j in jobs if "error" not in results.get(j[0], {"error": "missing result"})]
+        failed = [j for j in jobs if j not in ok]
+        try:
+            self._apply(ok, results)
+        except Exception:
+            failed_apply = []
+            for job in ok:
+                try:
+                    self._apply([job], results)
+                except Exception as e:
+                    failed_apply.append(job)
+                    results[job[0]] = {"error": repr(e)}
+            failed += failed_apply
+        if failed:
+            self._fail(failed, results)
+        self._count("batches")
+        self.last_batch_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    def _apply(self, jobs: List[Job], results: Dict[int, dict]):
+        if not jobs:
+            return
+        with self.session_factory() as db:
+            current = {
+                review_id: (version, est_id) for review_id, version, est_id in
+                db.query(Review.id, Review.version, Review.establishment_id).filter(Review.id.in_([j[0] for j in jobs]))
+            }
+            rows = [
+                {"id": review_id, "version": version, **self.apply_result(db, review_id, results[review_id])}
+                for review_id, version, _ in jobs
+                # avis supprimé, ou réécrit : la nouvelle version a son propre job
+                if current.get(review_id, (None,))[0] == version
+            ]
+            if rows:
+                db.execute(_update_reviews(tuple(rows[0])), rows)
+            db.execute(_DONE, [{"review_id": review_id, "version": version} for review_id, version, _ in jobs])
+            db.commit()
+        if self.publish is not None:
+            for row in rows:
+                sig = results[row["id"]]["signature"]
+                if sig:
+                    self.publish(current[row["id"]][1], {
+                        "type": "review_signature", "review_id": row["id"], "version": row["version"],
+                        "signature": array("H", sig).tolist(),
+                    })
+        self._count("processed", len(rows))
+        self._count("skipped", len(jobs) - len(rows))
+
+    def _fail(self, jobs: List[Job], results: Dict[int, dict]):
+        now = datetime.utcnow()
+        with self.session_factory() as db:
+            for review_id, version, attempts in jobs:
+                dead = attempts >= MAX_ATTEMPTS
+                db.execute(_RETRY, {
+                    "review_id": review_id, "version": version,
+                    "status": DEAD if dead else PENDING,
+                    "available_at": now + timedelta(seconds=min(2 ** attempts, BACKOFF_MAX_SECONDS)),
+                    "error": results.get(review_id, {}).get("error", "missing result")[:2000],
+                })
+                self._count("dead_lettered" if dead else "retried")
+            db.commit()
+
+    def _release(self, jobs: List[Job]):
+        with self.session_factory() as db:
+            for review_id, version, _ in jobs:
+                db.execute(_RETRY, {"review_id": review_id, "version": version, "status": PENDING,
+                                    "available_at": datetime.utcnow(), "error": None})
+            db.commit()
+
+    def stats(self) -> dict:
+        with self.session_factory() as db:
+            out = queue_stats(db)
+        with self._counters_lock:
+            out.update(self.counters)
+        out.update({"leader": self.leader, "processes": self.processes, "last_batch_ms": self.last_batch_ms})
+        return out
+
+
+if __name__ == "__main__":
+    import json
+
+    from database import SessionLocal
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    with SessionLocal() as db:
+        if command == "dead":
+            for row in db.execute(text(
+                "SELECT review_id, version, attempts, last_error FROM review_jobs WHERE status = 'dead'"
+            )):
+                print(dict(row._mapping))
+        elif command == "retry-dead":
+            print("requeued", db.execute(_RETRY_DEAD, {"now": datetime.utcnow()}).rowcount)
+            db.commit()
+        else:
+            print(json.dumps(queue_stats(db), indent=2))
@@ -0,0 +1,502 @@
+# places.py
+"""
+Client Google Places (autocomplete / details) avec couche de résilience :
+
+- budget : deux token buckets, par seconde (rafales) et par jour (quota),
+  vérifiés AVANT l'appel : quota épuisé -> refus immédiat, pas de
+  OVER_QUERY_LIMIT facturé. Budgets par process : avec serve.py, diviser le
+  quota par le nombre de workers ;
+- circuit breaker : ouvert après BREAKER_FAILURES échecs consécutifs
+  (erreur réseau, HTTP 5xx, OVER_QUERY_LIMIT / UNKNOWN_ERROR / REQUEST_DENIED,
+  appel plus lent que BREAKER_SLOW_SECONDS) ; pendant BREAKER_COOLDOWN
+  secondes les appels échouent tout de suite, puis un seul appel d'essai
+  (half-open) décide de la fermeture ;
+- timeout adaptatif : p99 observé x 2 (borné), au lieu de 15 s fixes ;
+- details : requête "hedgée" — si la réponse n'est pas arrivée au p95
+  observé (au plus 3 x la médiane), un second appel part en parallèle et le
+  premier qui répond gagne ;
+- dernier résultat connu gardé en mémoire (LRU) : servi si Google est
+  indisponible (le handler peut aussi se replier sur la base locale) ;
+- autocomplete : "la dernière saisie gagne" par session (LatestQueryGate) —
+  les requêtes encore en file devenues obsolètes, ou dont le client s'est
+  déconnecté, ne partent jamais chez Google.
+
+THENA_PLACES_URL permet de viser le stub à fautes injectées (places_stub.py).
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Optional, Tuple
+
+import requests
+from starlette.concurrency import run_in_threadpool
+from starlette.types import Receive
+
+import eventlog
+
+PLACES_URL = os.getenv("THENA_PLACES_URL", "https://maps.googleapis.com/maps/api/place").rstrip("/")
+PLACES_QPS = float(os.getenv("THENA_PLACES_QPS", "10"))
+PLACES_DAILY_QUOTA = int(os.getenv("THENA_PLACES_DAILY_QUOTA", "5000"))
+BREAKER_FAILURES = int(os.getenv("THENA_PLACES_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("THENA_PLACES_BREAKER_COOLDOWN", "30"))
+BREAKER_SLOW_SECONDS = float(os.getenv("THENA_PLACES_SLOW_SECONDS", "3"))
+HEDGE_ENABLED = os.getenv("THENA_PLACES_HEDGE", "1") != "0"
+
+TIMEOUT_MIN = 1.0
+TIMEOUT_MAX = 5.0          # tant que l'historique est trop court : TIMEOUT_MAX
+HEDGE_MIN_DELAY = 0.05
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+CACHE_SIZE = 2000
+
+# statuts qui signalent un Google en difficulté (ou une clé bloquée) -> échec du breaker
+_UPSTREAM_FAILURES = ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR", "REQUEST_DENIED")
+
+
+class PlacesUnavailable(Exception):
+    """Google injoignable, breaker ouvert ou budget épuisé : réessayer après retry_after."""
+
+    def __init__(self, reason: str, retry_after: float = 1.0):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class PlacesError(Exception):
+    """Réponse Google valide mais en erreur pour cette requête (INVALID_REQUEST, NOT_FOUND...)."""
+
+    def __init__(self, status: str):
+        super().__init__(status)
+        self.status = status
+
+
+class Superseded(Exception):
+    """Une saisie plus récente de la même session a pris la place de cette requête."""
+
+
+class ClientGone(Exception):
+    """Client déconnecté (requête abandonnée côté navigateur) avant la réponse."""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate            # jetons / seconde
+        self.capacity = capacity
+        self._tokens = capacity
+        self._at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._at) * self.rate)
+        self._at = now
+
+    def take(self, n: float = 1) -> Optional[float]:
+        """None si les jetons sont pris, sinon l'attente (secondes) avant d'en avoir assez."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= n:
+                self._tokens -= n
+                return None
+            return (n - self._tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def give_back(self, n: float = 1):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + n)
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.trips = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> Optional[float]:
+        """None si l'appel peut partir, sinon le Retry-After (secondes)."""
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self._opened_at + self.cooldown - time.monotonic()
+                if remaining > 0:
+                    self.rejected += 1
+                    return remaining
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self.rejected += 1
+                    return 1.0
+                self._probe_in_flight = True
+            return None
+
+    def closed(self) -> bool:
+        with self._lock:
+            return self.state == self.CLOSED
+
+    def release_probe(self):
+        """L'appel autorisé n'est pas parti (budget) : rien à conclure, l'essai suivant peut partir."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record(self, ok: bool):
+        with self._lock:
+            self._probe_in_flight = False
+            if ok:
+                self.consecutive = 0
+                self.state = self.CLOSED
+                return
+            self.consecutive += 1
+            if self.state == self.HALF_OPEN or self.consecutive >= self.failures:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Dernières latences réussies d'un endpoint -> percentiles pour timeout et hedge."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < LATENCY_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+    def timeout(self) -> float:
+        p99 = self.percentile(0.99)
+        return TIMEOUT_MAX if p99 is None else min(max(2 * p99, TIMEOUT_MIN), TIMEOUT_MAX)
+
+    def hedge_delay(self) -> Optional[float]:
+        # p95, sauf si la queue dépasse 5 % des appels (p95 déjà dans la queue) : 3 x médiane
+        p95 = self.percentile(0.95)
+        if p95 is None:
+            return None
+        return max(min(p95, 3 * self.percentile(0.5)), HEDGE_MIN_DELAY)
+
+
+class PlacesClient:
+    def __init__(self, api_key: Optional[str], base_url: str = PLACES_URL,
+                 qps: float = PLACES_QPS, daily_quota: int = PLACES_DAILY_QUOTA,
+                 hedge: bool = HEDGE_ENABLED):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.per_second = TokenBucket(qps, max(qps, 1))
+        self.daily = TokenBucket(daily_quota / 86400, daily_quota)
+        self.breaker = CircuitBreaker()
+        self.hedge = hedge
+        self.latency = {"autocomplete": LatencyTracker(), "details": LatencyTracker()}
+        self._http = requests.Session()  # keep-alive : pas de handshake TLS par appel
+        self._pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="thena-places")
+        self._cache: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {
+            "calls": 0, "errors": 0, "timeouts": 0, "slow": 0, "budget_rejected": 0,
+            "hedges": 0, "hedge_wins": 0, "stale_served": 0,
+        }
+
+    def _count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    # ---------------- cache (dernier résultat connu) ----------------
+    def _remember(self, key: tuple, data: dict):
+        with self._lock:
+            self._cache[key] = data
+            self._cache.move_to_end(key)
+            while len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def stale(self, key: tuple) -> Optional[dict]:
+        with self._lock:
+            data = self._cache.get(key)
+        if data is not None:
+            self._count("stale_served")
+        return data
+
+    # ---------------- appels ----------------
+    def _take_budget(self):
+        wait_s = self.per_second.take()
+        if wait_s is None:
+            wait_s = self.daily.take()
+            if wait_s is not None:
+                self.per_second.give_back()  # l'appel ne part pas
+        if wait_s is not None:
+            self._count("budget_rejected")
+            raise PlacesUnavailable("quota budget exhausted", wait_s)
+
+    def _get(self, endpoint: str, params: dict) -> dict:
+        """Un appel HTTP ; enregistre latence et verdict du breaker."""
+        tracker = self.latency[endpoint]
+        started = time.monotonic()
+        self._count("calls")
+        outcome = "ok"
+        try:
+            try:
+                r = self._http.get(
+                    f"{self.base_url}/{endpoint}/json",
+                    params={**params, "key": self.api_key},
+                    timeout=tracker.timeout(),
+                )
+                if r.status_code >= 500:
+                    raise requests.HTTPError(f"HTTP {r.status_code}")
+                data = r.json()
+            except requests.Timeout:
+                outcome = "timeout"
+                self._count("timeouts")
+                self.breaker.record(False)
+                raise PlacesUnavailable("Google Places timeout")
+            except (requests.RequestException, ValueError) as e:
+                outcome = e.__class__.__name__
+                self._count("errors")
+                self.breaker.record(False)
+                raise PlacesUnavailable(f"Google Places error: {e.__class__.__name__}")
+
+            elapsed = time.monotonic() - started
+            status = data.get("status")
+            if status in _UPSTREAM_FAILURES:
+                outcome = status
+                self._count("errors")
+                self.breaker.record(False)
+                raise PlacesUnavailable(f"Google Places {status}", 5.0 if status == "OVER_QUERY_LIMIT" else 1.0)
+            tracker.add(elapsed)
+            if elapsed > BREAKER_SLOW_SECONDS:
+                outcome = "slow"
+                self._count("slow")
+                self.breaker.record(False)  # réponse utilisable, mais compte comme échec
+            else:
+                self.breaker.record(True)
+            return data
+        finally:
+            eventlog.emit("google", endpoint=endpoint, outcome=outcome,
+                          ms=round((time.monotonic() - started) * 1000, 2))
+
+    def _call(self, endpoint: str, params: dict) -> dict:
+        retry = self.breaker.allow()
+        if retry is not None:
+            raise PlacesUnavailable("circuit open", retry)
+        try:
+            self._take_budget()
+        except PlacesUnavailable:
+            self.breaker.release_probe()  # Google n'est pas en cause : ni succès ni échec
+            raise
+        return self._get(endpoint, params)
+
+    def _call_hedged(self, endpoint: str, params: dict) -> dict:
+        delay = self.latency[endpoint].hedge_delay()
+        if not self.hedge or delay is None or not self.breaker.closed():
+            return self._call(endpoint, params)
+        retry = self.breaker.allow()
+        if retry is not None:
+            raise PlacesUnavailable("circuit open", retry)
+        try:
+            self._take_budget()
+        except PlacesUnavailable:
+            self.breaker.release_probe()  # rouvert entre-temps : l'essai éventuel n'est pas parti
+            raise
+        first = self._pool.submit(self._get, endpoint, params)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        # queue de latence : second appel, seulement si le budget le permet
+        futures = [first]
+        try:
+            self._take_budget()
+            futures.append(self._pool.submit(self._get, endpoint, params))
+            self._count("hedges")
+        except PlacesUnavailable:
+            pass
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                try:
+                    result = f.result()
+                except PlacesUnavailable as e:
+                    error = e
+                    continue
+                if f is not first:
+                    self._count("hedge_wins")
+                return result  # le perdant termine en arrière-plan
+        raise error
+
+    # ---------------- API ----------------
+    def autocomplete(self, q: str) -> list:
+        key = ("autocomplete", q.strip().lower())
+        data = self._call("autocomplete", {"input": q, "types": "establishment", "language": "fr"})
+        if data.get("status") not in ("OK", "ZERO_RESULTS"):
+            raise PlacesError(data.get("status") or "UNKNOWN")
+        predictions = [
+            {"place_id": p["place_id"], "description": p["description"]} for p in data.get("predictions", [])
+        ]
+        self._remember(key, {"predictions": predictions})
+        return predictions
+
+    def details(self, place_id: str) -> dict:
+        data = self._call_hedged("details", {
+            "place_id": place_id,
+            "fields": "place_id,name,formatted_address,rating,types,geometry/location",
+            "language": "fr",
+        })
+        if data.get("status") != "OK":
+            raise PlacesError(data.get("status") or "UNKNOWN")
+        result = data["result"]
+        self._remember(("details", place_id), result)
+        return result
+
+    def location(self, place_id: str) -> Tuple[float, float]:
+        """(lat, lng) seuls, champ geometry uniquement : backfill de geo.py."""
+        data = self._call_hedged("details", {"place_id": place_id, "fields": "geometry/location"})
+        if data.get("status") != "OK":
+            raise PlacesError(data.get("status") or "UNKNOWN")
+        loc = data["result"]["geometry"]["location"]
+        return loc["lat"], loc["lng"]
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self.counters)
+            out["cache_size"] = len(self._cache)
+        out.update({
+            "breaker_state": self.breaker.state,
+            "breaker_trips": self.breaker.trips,
+            "breaker_rejected": self.breaker.rejected,
+            "budget_second_tokens": round(self.per_second.tokens, 2),
+            "budget_daily_tokens": int(self.daily.tokens),
+        })
+        for endpoint, tracker in self.latency.items():
+            out[endpoint] = {
+                "p50": tracker.percentile(0.5),
+                "p95": tracker.percentile(0.95),
+                "p99": tracker.percentile(0.99),
+                "timeout": tracker.timeout(),
+            }
+        return out
+
+
+# ---------------- autocomplete : la dernière saisie gagne ----------------
+async def client_gone(receive: Receive):
+    """Se termine quand le client se déconnecte (GET : le corps est déjà lu)."""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+class _Ticket:
+    """
+    Course entre le thread d'appel et l'abandon : l'appel Google part ou est
+    annulé, jamais les deux. begin() côté thread, drop() côté boucle asyncio.
+    """
+
+    __slots__ = ("_lock", "started", "error", "dropped")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._lock = threading.Lock()
+        self.started = False
+        self.error = None
+        self.dropped = loop.create_future()
+
+    def begin(self) -> bool:
+        with self._lock:
+            if self.error is None:
+                self.started = True
+            return self.started
+
+    def drop(self, error: type) -> bool:
+        """True si l'appel n'était pas encore parti (économisé)."""
+        with self._lock:
+            if self.started or self.error is not None:
+                return False
+            self.error = error
+        self.dropped.set_result(error)
+        return True
+
+
+def _ignore_result(future: asyncio.Future):
+    if not future.cancelled():
+        future.exception()
+
+
+class LatestQueryGate:
+    """
+    Autocomplete "la dernière saisie gagne", par session, côté boucle asyncio
+    (pas de verrou entre requêtes) :
+    - une saisie plus récente de la même session annule les requêtes plus
+      anciennes dont l'appel Google n'est pas encore parti (en attente d'un
+      thread) -> Superseded ;
+    - client déconnecté (AbortController côté UI) avant le départ de l'appel
+      -> ClientGone, sans appel ; déjà en vol, l'appel termine en arrière-plan
+      (il remplit le cache) mais la requête est libérée tout de suite.
+    Aucune attente ajoutée : un appel déjà parti n'est pas remboursé par
+    Google, on ne gagne que sur les requêtes en file.
+    """
+
+    def __init__(self):
+        self._tickets = {}  # session -> tickets des requêtes en cours
+        self.counters = {
+            "requests": 0, "superseded": 0, "gone_before_call": 0, "abandoned_in_flight": 0,
+        }
+
+    async def run(self, owner: Optional[str], receive: Receive, call: Callable[[], object]):
+        # owner None : session inconnue, rien à remplacer (l'abandon client reste géré)
+        tickets = self._tickets.setdefault(owner, set()) if owner else set()
+        for older in list(tickets):
+            if older.drop(Superseded):
+                self.counters["superseded"] += 1
+        ticket = _Ticket(asyncio.get_running_loop())
+        tickets.add(ticket)
+        self.counters["requests"] += 1
+
+        def guarded():
+            if not ticket.begin():
+                raise ticket.error()
+            return call()
+
+        work = asyncio.ensure_future(run_in_threadpool(guarded))
+        gone = asyncio.ensure_future(client_gone(receive))
+        try:
+            await asyncio.wait({work, gone, ticket.dropped}, return_when=asyncio.FIRST_COMPLETED)
+            if work.done():
+                return work.result()
+            work.add_done_callback(_ignore_result)  # le thread finit seul (appel en vol, ou refus immédiat)
+            if ticket.dropped.done():
+                raise ticket.error()
+            if ticket.drop(ClientGone):
+                self.counters["gone_before_call"] += 1
+            else:
+                self.counters["abandoned_in_flight"] += 1
+            raise ClientGone()
+        finally:
+            gone.cancel()
+            tickets.discard(ticket)
+            if owner and not tickets:
+                del self._tickets[owner]
+
+    def stats(self) -> dict:
+        out = dict(self.counters)
+        out["saved_calls"] = out["superseded"] + out["gone_before_call"]
+        out["sessions"] = len(self._tickets)
+        return out
@@ -0,0 +1,140 @@
+# places_stub.py
+"""
+Faux Google Places local, avec fautes injectables, pour tester places.py
+(breaker, budget, hedging) sans quota ni réseau.
+
+    python places_stub.py --port 8099 --tail-rate 0.05 --tail-ms 2000
+    THENA_PLACES_URL=http://127.0.0.1:8099 GOOGLE_API_KEY=stub uvicorn main:app
+
+Endpoints servis : /autocomplete/json et /details/json (mêmes formes de
+réponse que Google). Les fautes se changent à chaud :
+
+    curl 'http://127.0.0.1:8099/_faults?error_rate=1'      # tout en HTTP 500
+    curl 'http://127.0.0.1:8099/_faults?status=OVER_QUERY_LIMIT&status_rate=1'
+    curl 'http://127.0.0.1:8099/_faults'                   # état + compteurs
+
+Fautes : latency_ms (base), tail_rate / tail_ms (queue de latence),
+error_rate (HTTP 500), status / status_rate (statut Google en erreur),
+hang_rate (pas de réponse avant hang_ms : timeouts).
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FAULTS = {
+    "latency_ms": 20.0,
+    "tail_rate": 0.0,
+    "tail_ms": 1000.0,
+    "error_rate": 0.0,
+    "status": "OVER_QUERY_LIMIT",
+    "status_rate": 0.0,
+    "hang_rate": 0.0,
+    "hang_ms": 30000.0,
+}
+COUNTS = {"requests": 0, "errors": 0, "tail": 0, "hangs": 0}
+_lock = threading.Lock()
+
+
+def _place(place_id: str) -> dict:
+    n = sum(place_id.encode()) % 1000
+    return {
+        "place_id": place_id,
+        "name": f"Stub {place_id}",
+        "formatted_address": f"{n} rue du Stub, Paris",
+        "rating": round(3 + (n % 20) / 10, 1),
+        "types": ["restaurant", "food", "establishment"],
+        "geometry": {"location": {"lat": 48.85 + n / 10000, "lng": 2.35 + n / 10000}},
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, comme Google
+    disable_nagle_algorithm = True  # en-têtes et corps écrits séparément
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, code: int, payload: dict):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client parti (timeout côté places.py)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path == "/_faults":
+            with _lock:
+                for k, v in params.items():
+                    if k in FAULTS:
+                        FAULTS[k] = v if k == "status" else float(v)
+                if "reset" in params:
+                    COUNTS.update({k: 0 for k in COUNTS})
+                return self._json(200, {"faults": FAULTS, "counts": COUNTS})
+
+        with _lock:
+            faults = dict(FAULTS)
+            COUNTS["requests"] += 1
+
+        if random.random() < faults["hang_rate"]:
+            with _lock:
+                COUNTS["hangs"] += 1
+            time.sleep(faults["hang_ms"] / 1000)
+        delay = faults["latency_ms"]
+        if random.random() < faults["tail_rate"]:
+            with _lock:
+                COUNTS["tail"] += 1
+            delay = faults["tail_ms"]
+        time.sleep(delay / 1000)
+
+        if random.random() < faults["error_rate"]:
+            with _lock:
+                COUNTS["errors"] += 1
+            return self._json(500, {"error": "injected"})
+        if random.random() < faults["status_rate"]:
+            return self._json(200, {"status": faults["status"], "error_message": "injected"})
+
+        if url.path == "/autocomplete/json":
+            q = params.get("input", "")
+            predictions = [
+                {"place_id": f"stub-{q}-{i}", "description": f"{q} {i}, Paris"} for i in range(5)
+            ]
+            return self._json(200, {"status": "OK", "predictions": predictions})
+        if url.path == "/details/json":
+            place_id = params.get("place_id", "")
+            if place_id.startswith("missing"):
+                return self._json(200, {"status": "NOT_FOUND"})
+            return self._json(200, {"status": "OK", "result": _place(place_id)})
+        return self._json(404, {"error": "unknown endpoint"})
+
+
+def serve(host: str = "127.0.0.1", port: int = 8099) -> ThreadingHTTPServer:
+    """Démarre le stub dans un thread (tests / benchs) ; server.shutdown() pour l'arrêter."""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="places-stub", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Google Places stub with fault injection")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    for name, default in FAULTS.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=type(default), default=default)
+    args = parser.parse_args()
+    FAULTS.update({name: getattr(args, name) for name in FAULTS})
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"places stub on http://{args.host}:{args.port}", FAULTS)
+    server.serve_forever()
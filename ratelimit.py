@@ -0,0 +1,217 @@
+# ratelimit.py
+"""
+Limitation de débit (fenêtre glissante) pour les endpoints d'écriture :
+magic-link (par IP et par email haché) et avis (par utilisateur et par IP).
+
+Compteur à fenêtre glissante approché : on garde le compte de la fenêtre
+courante et de la précédente,
+    estimation = précédente * (part de la fenêtre précédente encore couverte) + courante
+Mémoire fixe par worker : chaque règle est une table de hachage à taille fixe
+(tableaux `array` : empreinte 64 bits, n° de fenêtre, deux compteurs),
+soit 24 octets par slot. Une clé inconnue remplace un slot périmé, ou à
+défaut le moins chargé de son voisinage.
+
+Tier partagé optionnel (THENA_RATELIMIT_BACKEND=sqlite) : mêmes compteurs
+dans une table SQLite commune à tous les workers, consultée seulement si le
+tier local laisse passer (un flood est rejeté sans toucher au disque).
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+RATELIMIT_ENABLED = os.getenv("THENA_RATELIMIT", "1") != "0"
+RATELIMIT_BACKEND = os.getenv("THENA_RATELIMIT_BACKEND", "local")
+RATELIMIT_DB_PATH = os.getenv("THENA_RATELIMIT_DB", "./thena_ratelimit.db")
+RATELIMIT_SLOTS = int(os.getenv("THENA_RATELIMIT_SLOTS", "65536"))
+_PROBES = 4
+
+
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    limit: int
+    period: int  # secondes
+
+
+RULES: Dict[str, Rule] = {
+    rule.name: rule for rule in (
+        Rule("magic_link_ip", 10, 600),
+        Rule("magic_link_email", 3, 600),
+        Rule("review_write_user", 30, 600),
+        Rule("review_write_ip", 60, 600),
+    )
+}
+
+
+def fingerprint(key: str) -> int:
+    # jamais 0 : 0 = slot libre
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+
+def sliding_estimate(prev: int, cur: int, elapsed_fraction: float) -> float:
+    return prev * (1.0 - elapsed_fraction) + cur
+
+
+def retry_after(rule: Rule, prev: int, cur: int, now: float, cost: int = 1) -> float:
+    """Secondes avant que l'estimation + cost repasse sous la limite."""
+    into = now % rule.period
+    if cur + cost <= rule.limit:
+        # il suffit que la fenêtre précédente "sorte" assez
+        needed = 1.0 - (rule.limit - cost - cur) / prev if prev else 0.0
+        return max(needed * rule.period - into, 1.0)
+    # fenêtre courante pleine : attendre la suivante, où `cur` devient `prev`
+    needed = max(0.0, 1.0 - (rule.limit - cost) / cur) if cur else 0.0
+    return max(rule.period - into + needed * rule.period, 1.0)
+
+
+class LocalLimiter:
+    """Compteurs d'une règle en mémoire fixe (par worker)."""
+
+    def __init__(self, rule: Rule, slots: int = RATELIMIT_SLOTS):
+        self.rule = rule
+        self.slots = slots
+        self._fp = array("Q", bytes(8 * slots))
+        self._window = array("q", bytes(8 * slots))
+        self._cur = array("I", bytes(4 * slots))
+        self._prev = array("I", bytes(4 * slots))
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    def _find(self, fp: int, window: int) -> int:
+        base = fp % self.slots
+        victim, victim_load = base, None
+        for k in range(_PROBES):
+            i = (base + k) % self.slots
+            if self._fp[i] == fp:
+                return i
+            if self._fp[i] == 0 or self._window[i] < window - 1:
+                load = -1  # libre ou périmé : prioritaire
+            else:
+                load = self._cur[i] + self._prev[i]
+            if victim_load is None or load < victim_load:
+                victim, victim_load = i, load
+        self._fp[victim] = fp
+        self._window[victim] = window
+        self._cur[victim] = 0
+        self._prev[victim] = 0
+        return victim
+
+    def hit(self, key: str, cost: int = 1, now: Optional[float] = None) -> Optional[float]:
+        """Compte `cost` appels ; renvoie None si autorisé, sinon le Retry-After en secondes."""
+        now = time.time() if now is None else now
+        window = int(now // self.rule.period)
+        fp = fingerprint(key)
+        with self._lock:
+            i = self._find(fp, window)
+            if self._window[i] != window:
+                self._prev[i] = self._cur[i] if self._window[i] == window - 1 else 0
+                self._cur[i] = 0
+                self._window[i] = window
+            prev, cur = self._prev[i], self._cur[i]
+            if sliding_estimate(prev, cur, (now % self.rule.period) / self.rule.period) + cost > self.rule.limit:
+                self.rejected += 1
+                return retry_after(self.rule, prev, cur, now, cost)
+            self._cur[i] = cur + cost
+            self.allowed += 1
+            return None
+
+
+class SQLiteLimiter:
+    """Tier partagé entre workers : une ligne (règle, empreinte, fenêtre) -> compte."""
+
+    def __init__(self, path: str = RATELIMIT_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._last_prune = 0.0
+        # connexion jetable : rien d'ouvert n'est hérité par les workers forkés (serve.py)
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            " rule TEXT NOT NULL,"
+            " fp INTEGER NOT NULL,"
+            " window INTEGER NOT NULL,"
+            " count INTEGER NOT NULL,"
+            " PRIMARY KEY (rule, fp, window)) WITHOUT ROWID"
+        )
+        conn.close()
+
+    def _conn(self) -> sqlite3.Connection:
+        # une connexion par thread (handlers sync = threadpool)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def hit(self, rule: Rule, key: str, cost: int = 1, now: Optional[float] = None) -> Optional[float]:
+        now = time.time() if now is None else now
+        window = int(now // rule.period)
+        fp = fingerprint(key) >> 1  # INTEGER SQLite signé
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            counts = dict(conn.execute(
+                "SELECT window, count FROM rate_limits WHERE rule = ? AND fp = ? AND window IN (?, ?)",
+                (rule.name, fp, window, window - 1),
+            ).fetchall())
+            prev, cur = counts.get(window - 1, 0), counts.get(window, 0)
+            if sliding_estimate(prev, cur, (now % rule.period) / rule.period) + cost > rule.limit:
+                conn.execute("ROLLBACK")
+                return retry_after(rule, prev, cur, now, cost)
+            conn.execute(
+                "INSERT INTO rate_limits (rule, fp, window, count) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (rule, fp, window) DO UPDATE SET count = count + excluded.count",
+                (rule.name, fp, window, cost),
+            )
+            if now - self._last_prune > 60:
+                self._last_prune = now
+                for r in RULES.values():
+                    conn.execute(
+                        "DELETE FROM rate_limits WHERE rule = ? AND window < ?",
+                        (r.name, int(now // r.period) - 1),
+                    )
+            conn.execute("COMMIT")
+            return None
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class RateLimiter:
+    def __init__(self, rules: Dict[str, Rule] = RULES, backend: str = RATELIMIT_BACKEND,
+                 slots: int = RATELIMIT_SLOTS):
+        self.local = {name: LocalLimiter(rule, slots) for name, rule in rules.items()}
+        if backend == "sqlite":
+            self.shared: Optional[SQLiteLimiter] = SQLiteLimiter()
+        elif backend == "local":
+            self.shared = None
+        else:
+            raise ValueError(f"Unknown THENA_RATELIMIT_BACKEND: {backend}")
+        self.shared_rejected = 0
+
+    def check(self, rule_name: str, key: str, cost: int = 1) -> Optional[float]:
+        local = self.local[rule_name]
+        wait = local.hit(key, cost)
+        if wait is None and self.shared is not None:
+            wait = self.shared.hit(local.rule, key, cost)
+            if wait is not None:
+                self.shared_rejected += 1
+        return wait
+
+    def stats(self) -> dict:
+        out = {
+            name: {"allowed": lim.allowed, "rejected": lim.rejected, "limit": lim.rule.limit,
+                   "period": lim.rule.period}
+            for name, lim in self.local.items()
+        }
+        out["backend"] = "sqlite" if self.shared is not None else "local"
+        out["shared_rejected"] = self.shared_rejected
+        return out
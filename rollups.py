@@ -0,0 +1,271 @@
+# rollups.py
+"""
+Agrégats analytiques pré-calculés (table review_rollups) pour les tableaux de
+bord : "% d'avis signalant des heures sup non payées par contrat et par mois",
+"note moyenne par rôle"...
+
+Lignes (grain, type, mois, rôle, contrat, logement) avec compteurs, somme des
+notes et nombre de chaque signalement. Le cube complet est trop gros (rôle en
+texte libre) pour être sommé à la lecture : on matérialise un "grouping set"
+par sous-ensemble de {rôle, contrat, logement} (grain = masque de bits, les
+dimensions agrégées valent "*"). Une requête lit seulement le grain qui
+correspond à ses dimensions : "contrat x mois" = quelques centaines de lignes.
+Un avis compte :
+- dans la ligne type = "*" (tous types : sommes sans double compte) ;
+- dans une ligne par type Google de son établissement.
+Rôle (texte libre) normalisé : minuscules, espaces réduits ; "" = non renseigné.
+
+Tenu à jour dans la transaction d'écriture de l'avis : l'ancienne version
+est retirée (delta négatif), la nouvelle ajoutée : un executemany de
+INSERT ... ON CONFLICT DO UPDATE (8 grains x (1 + nb types) lignes).
+GET /stats/rollups lit ces lignes au lieu de parcourir reviews ⋈ establishments.
+
+Vérification / reconstruction complète :
+    python rollups.py            # recalcule, compare et corrige
+    python rollups.py --dry-run  # compare seulement
+"""
+import sys
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import case, func, text
+from sqlalchemy.orm import Session
+
+from establishment_index import parse_types
+from models import Establishment, Review, ReviewRollup
+
+ALL = "*"
+DIMENSIONS = ("month", "type", "role", "contract", "housing")
+GRAIN_DIMENSIONS = ("role", "contract", "housing")  # bit i du grain = dimension gardée
+GRAINS = range(1 << len(GRAIN_DIMENSIONS))
+FLAGS = ("coupure", "unpaid_overtime", "toxic_manager", "harassment", "recommend")
+MEASURES = ("review_count", "scored_count", "score_sum") + tuple(f"{f}_count" for f in FLAGS)
+_SIZES = {"role": 80, "contract": 40, "housing": 40}
+
+Key = Tuple[int, str, str, str, str, str]  # (grain, type, month, role, contract, housing)
+KEY_COLUMNS = ("grain", "type", "month") + GRAIN_DIMENSIONS
+
+
+def normalize(value: Optional[str], size: int) -> str:
+    return " ".join((value or "").split()).lower()[:size]
+
+
+def grain_of(dims: Iterable[str]) -> int:
+    dims = set(dims)
+    return sum(1 << i for i, d in enumerate(GRAIN_DIMENSIONS) if d in dims)
+
+
+def keys_for(month: str, types_json: Optional[str], role, contract, housing) -> List[Key]:
+    values = (normalize(role, 80), normalize(contract, 40), normalize(housing, 40))
+    types = [ALL] + sorted({t[:64] for t in parse_types(types_json)})
+    keys = []
+    for grain in GRAINS:
+        kept = tuple(v if grain & (1 << i) else ALL for i, v in enumerate(values))
+        keys.extend((grain, t, month, *kept) for t in types)
+    return keys
+
+
+def review_measures(review) -> Tuple[float, ...]:
+    scored = review.score is not None
+    return (1, int(scored), review.score if scored else 0.0) + tuple(int(bool(getattr(review, f))) for f in FLAGS)
+
+
+def accumulate(deltas: Dict[Key, List[float]], keys: List[Key], measures, sign: int = 1):
+    for key in keys:
+        acc = deltas.get(key)
+        if acc is None:
+            acc = deltas[key] = [0] * len(MEASURES)
+        for i, m in enumerate(measures):
+            acc[i] += sign * m
+
+
+def add_review(deltas: Dict[Key, List[float]], review, types_json: Optional[str], sign: int = 1):
+    keys = keys_for(review.created_at.strftime("%Y-%m"), types_json, review.role, review.contract, review.housing)
+    accumulate(deltas, keys, review_measures(review), sign)
+
+
+# même syntaxe SQLite / Postgres ; text() est mis en cache (l'insert() de dialecte recompilé à chaque appel)
+_UPSERT = text(
+    f"INSERT INTO review_rollups ({', '.join(KEY_COLUMNS + MEASURES)})"
+    f" VALUES ({', '.join(':' + c for c in KEY_COLUMNS + MEASURES)})"
+    f" ON CONFLICT ({', '.join(KEY_COLUMNS)}) DO UPDATE SET "
+    + ", ".join(f"{m} = review_rollups.{m} + excluded.{m}" for m in MEASURES)
+)
+
+
+def apply(db: Session, deltas: Dict[Key, List[float]]):
+    """Applique les deltas (executemany d'un upsert) ; les clés à delta nul sont ignorées."""
+    rows = [
+        {**dict(zip(KEY_COLUMNS, key)), **dict(zip(MEASURES, values))}
+        for key, values in deltas.items() if any(values)
+    ]
+    if rows:
+        db.execute(_UPSERT, rows)
+
+
+class ReviewSnapshot:
+    """Valeurs d'un avis avant écriture (l'upsert écrase la ligne ORM)."""
+
+    __slots__ = ("created_at", "score", "role", "contract", "housing") + FLAGS
+
+    def __init__(self, review):
+        for name in self.__slots__:
+            setattr(self, name, getattr(review, name))
+
+
+def snapshot_existing(db: Session, establishment_id: int, user_id: int) -> Optional[ReviewSnapshot]:
+    row = (
+        db.query(Review.created_at, Review.score, Review.role, Review.contract, Review.housing,
+                 *[getattr(Review, f) for f in FLAGS])
+        .filter(Review.establishment_id == establishment_id, Review.user_id == user_id)
+        .first()
+    )
+    return ReviewSnapshot(row) if row is not None else None
+
+
+def on_review_upserted(db: Session, review: Review, previous: Optional[ReviewSnapshot], types_json: Optional[str]):
+    """Dans la transaction d'écriture : retire l'ancienne version, ajoute la nouvelle."""
+    deltas: Dict[Key, List[float]] = {}
+    if previous is not None:
+        add_review(deltas, previous, types_json, -1)
+    add_review(deltas, review, types_json, 1)
+    apply(db, deltas)
+
+
+def on_review_deleted(db: Session, review: Review, types_json: Optional[str]):
+    deltas: Dict[Key, List[float]] = {}
+    add_review(deltas, review, types_json, -1)
+    apply(db, deltas)
+
+
+# ---------------- requêtes ----------------
+def query(
+    db: Session,
+    group_by: Iterable[str] = ("month",),
+    month_from: Optional[str] = None,
+    month_to: Optional[str] = None,
+    filters: Optional[Dict[str, str]] = None,
+) -> List[dict]:
+    """
+    Somme des lignes du grain qui correspond aux dimensions demandées ; taux
+    (signalements / avis) et note moyenne calculés à la lecture.
+    """
+    group_by = [d for d in DIMENSIONS if d in set(group_by)]
+    filters = {k: v for k, v in (filters or {}).items() if v is not None}
+    cols = [getattr(ReviewRollup, d) for d in group_by]
+    q = (
+        db.query(*cols, *[func.sum(getattr(ReviewRollup, m)) for m in MEASURES])
+        .filter(ReviewRollup.grain == grain_of([*group_by, *filters]))
+    )
+    if "type" in filters:
+        q = q.filter(ReviewRollup.type == filters.pop("type"))
+    elif "type" in group_by:
+        q = q.filter(ReviewRollup.type != ALL)
+    else:
+        q = q.filter(ReviewRollup.type == ALL)
+    for dim, value in filters.items():
+        q = q.filter(getattr(ReviewRollup, dim) == normalize(value, _SIZES[dim]))
+    if month_from:
+        q = q.filter(ReviewRollup.month >= month_from)
+    if month_to:
+        q = q.filter(ReviewRollup.month <= month_to)
+    if cols:
+        q = q.group_by(*cols).order_by(*cols)
+
+    out = []
+    for row in q:
+        keys, sums = row[:len(group_by)], row[len(group_by):]
+        m = dict(zip(MEASURES, sums))
+        total = int(m["review_count"] or 0)
+        if not total:
+            continue
+        item = dict(zip(group_by, keys))
+        item["review_count"] = total
+        item["scored_count"] = int(m["scored_count"] or 0)
+        item["avg_score"] = round(m["score_sum"] / m["scored_count"], 2) if m["scored_count"] else None
+        for f in FLAGS:
+            item[f"{f}_count"] = int(m[f"{f}_count"] or 0)
+            item[f"{f}_rate"] = round(item[f"{f}_count"] / total, 4)
+        out.append(item)
+    return out
+
+
+# ---------------- recalcul complet ----------------
+def compute_all(db: Session) -> Dict[Key, List[float]]:
+    """
+    GROUP BY SQL sur les valeurs brutes (mois, types_json, rôle, contrat,
+    logement), puis normalisation + expansion en grains côté Python.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        month = func.to_char(Review.created_at, "YYYY-MM")
+    else:
+        month = func.strftime("%Y-%m", Review.created_at)
+    raw = (month, Establishment.types_json, Review.role, Review.contract, Review.housing)
+    q = (
+        db.query(
+            *raw,
+            func.count(Review.id), func.count(Review.score), func.coalesce(func.sum(Review.score), 0),
+            *[func.sum(case((getattr(Review, f), 1), else_=0)) for f in FLAGS],
+        )
+        .join(Establishment, Establishment.id == Review.establishment_id)
+        .group_by(*raw)
+    )
+    totals: Dict[Key, List[float]] = {}
+    for row in q:
+        accumulate(totals, keys_for(*row[:5]), row[5:])
+    return totals
+
+
+def _compare(expected: Dict[Key, List[float]], db: Session) -> Tuple[int, int]:
+    current = {
+        tuple(getattr(r, c) for c in KEY_COLUMNS): [getattr(r, m) for m in MEASURES]
+        for r in db.query(ReviewRollup)
+    }
+    zero = [0] * len(MEASURES)
+    drift = sum(
+        1 for key in expected.keys() | current.keys()
+        if any(abs(a - b) > 1e-6 for a, b in zip(expected.get(key, zero), current.get(key, zero)))
+    )
+    empty = sum(1 for values in current.values() if not any(values))  # tout retiré : inoffensif
+    return drift, empty
+
+
+def rebuild(db: Session) -> int:
+    """
+    Remplace tous les rollups, verrou d'écriture pris AVANT de lire `reviews` :
+    les écritures concurrentes attendent puis appliquent leur delta par-dessus.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("LOCK TABLE review_rollups IN EXCLUSIVE MODE"))
+    db.query(ReviewRollup).delete(synchronize_session=False)  # SQLite : prend le verrou d'écriture
+    expected = compute_all(db)
+    db.bulk_insert_mappings(ReviewRollup, [
+        {**dict(zip(KEY_COLUMNS, key)), **dict(zip(MEASURES, values))}
+        for key, values in expected.items()
+    ])
+    db.commit()
+    return len(expected)
+
+
+def recompute(session_factory, fix: bool = True) -> dict:
+    """Recalcule tout depuis `reviews`, compare aux rollups et, si écart, reconstruit."""
+    db = session_factory()
+    try:
+        expected = compute_all(db)
+        drift, empty = _compare(expected, db)
+        db.rollback()
+        fixed = bool(fix and drift)
+        if fixed:
+            rebuild(db)
+        return {"keys": len(expected), "drift": drift, "empty_rows": empty, "fixed": fixed}
+    finally:
+        db.close()
+
+
+def is_empty(db: Session) -> bool:
+    return db.query(ReviewRollup.month).first() is None
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    print(recompute(SessionLocal, fix="--dry-run" not in sys.argv))
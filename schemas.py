@@ -1,8 +1,10 @@
 # schemas.py
 from datetime import datetime
-from typing import Optional, List
+from typing import Dict, Optional, List
 from pydantic import BaseModel, EmailStr, Field
 
+from ratelimit import RULES
+
 
 # ---------- AUTH ----------
 class AuthRequestLink(BaseModel):
@@ -30,6 +32,8 @@ class EstablishmentCreate(BaseModel):
     address: Optional[str] = None
     google_rating: Optional[float] = None
     types: List[str] = []
+    lat: Optional[float] = Field(default=None, ge=-90, le=90)
+    lng: Optional[float] = Field(default=None, ge=-180, le=180)
 
 
 class EstablishmentOut(BaseModel):
@@ -39,12 +43,51 @@ class EstablishmentOut(BaseModel):
     address: Optional[str] = None
     google_rating: Optional[float] = None
     types: List[str] = []
+    lat: Optional[float] = None
+    lng: Optional[float] = None
     created_at: datetime
 
     class Config:
         from_attributes = True
 
 
+class EstablishmentSummary(BaseModel):
+    id: int
+    google_place_id: str
+    name: str
+    address: Optional[str] = None
+    google_rating: Optional[float] = None
+    types: List[str] = []
+    thena_avg: Optional[float] = None
+    thena_count_total: int = 0
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+
+
+class EstablishmentPage(BaseModel):
+    items: List[EstablishmentSummary]
+    next_cursor: Optional[str] = None
+
+
+class EstablishmentNear(EstablishmentSummary):
+    distance_km: float
+
+
+class LeaderboardRow(BaseModel):
+    rank: int
+    score: float
+    review_count: int
+    establishment: EstablishmentSummary
+
+
+class Leaderboard(BaseModel):
+    board: str
+    order: str
+    prior_mean: float
+    prior_weight: float
+    items: List[LeaderboardRow]
+
+
 # ---------- REVIEWS ----------
 class ReviewCreate(BaseModel):
     establishment_id: int
@@ -64,6 +107,11 @@ class ReviewCreate(BaseModel):
     recommend: bool = False
 
 
+class ReviewBatch(BaseModel):
+    # un lot compte pour autant d'écritures que d'avis : jamais plus que la limite par utilisateur
+    reviews: List[ReviewCreate] = Field(min_length=1, max_length=RULES["review_write_user"].limit)
+
+
 class ReviewOut(BaseModel):
     id: int
     establishment_id: int
@@ -86,6 +134,7 @@ class ReviewOut(BaseModel):
     harassment: bool
     recommend: bool
 
+    version: int = 0
     created_at: datetime
 
     class Config:
@@ -98,6 +147,129 @@ class EstablishmentWithStats(BaseModel):
     thena_avg: Optional[float] = None
     thena_count_scored: int
     thena_count_total: int
+    version: int = 0
+
+
+class EstablishmentChanges(BaseModel):
+    """
+    Delta depuis `since` : appliquer d'abord `deleted` (tombstones) puis
+    upsert `reviews`, et retenir `version` pour le prochain appel.
+    """
+    establishment_id: int
+    since: int
+    version: int
+    reviews: List[ReviewOut]
+    deleted: List[int]
+    thena_avg: Optional[float] = None
+    thena_count_scored: int
+    thena_count_total: int
+
+
+class EstablishmentBatchRequest(BaseModel):
+    ids: List[int] = Field(default=[], max_length=50)
+    google_place_ids: List[str] = Field(default=[], max_length=50)
+    reviews_limit: int = Field(default=20, ge=0, le=100)  # avis les plus récents par établissement
+
+
+class EstablishmentBatch(BaseModel):
+    """items : id -> fiche (reviews tronqué à reviews_limit, agrégats complets)."""
+    items: Dict[int, EstablishmentWithStats]
+    missing_ids: List[int] = []
+    missing_google_place_ids: List[str] = []
+
+
+# ---------- FEED ----------
+class FeedItem(BaseModel):
+    review_id: int
+    establishment_id: int
+    establishment_name: str
+    user_pseudo: str
+    score: Optional[float] = None
+    excerpt: str
+
+    coupure: bool
+    unpaid_overtime: bool
+    toxic_manager: bool
+    harassment: bool
+    recommend: bool
+
+    created_at: datetime
+
+
+class FeedPage(BaseModel):
+    items: List[FeedItem]
+    next_cursor: Optional[str] = None
+
+
+# ---------- SEARCH ----------
+class ReviewSearchHit(BaseModel):
+    review: ReviewOut
+    establishment_name: str
+    snippet: str
+    rank: float
+
+
+class ReviewSearchPage(BaseModel):
+    items: List[ReviewSearchHit]
+    next_cursor: Optional[str] = None
+
+
+# ---------- STATS ----------
+class RollupRow(BaseModel):
+    month: Optional[str] = None
+    type: Optional[str] = None
+    role: Optional[str] = None
+    contract: Optional[str] = None
+    housing: Optional[str] = None
+
+    review_count: int
+    scored_count: int
+    avg_score: Optional[float] = None
+
+    coupure_count: int
+    coupure_rate: float
+    unpaid_overtime_count: int
+    unpaid_overtime_rate: float
+    toxic_manager_count: int
+    toxic_manager_rate: float
+    harassment_count: int
+    harassment_rate: float
+    recommend_count: int
+    recommend_rate: float
+
+
+class RollupPage(BaseModel):
+    group_by: List[str]
+    items: List[RollupRow]
+
+
+# ---------- MODERATION ----------
+class DuplicateReview(BaseModel):
+    review: ReviewOut
+    duplicate_of_id: int
+    similarity: float
+
+
+class FlaggedReview(BaseModel):
+    review: ReviewOut
+    language: Optional[str] = None
+    pii_count: int
+    profanity_count: int
+
 
+class AccountPurgeRequest(BaseModel):
+    user_ids: List[int] = Field(min_length=1, max_length=10000)
+    # au-delà : on s'arrête entre deux lots, remaining_user_ids à renvoyer dans un nouvel appel
+    budget_seconds: float = Field(default=5, gt=0, le=60)
 
 
+class AccountPurgeResult(BaseModel):
+    requested: int
+    users_deleted: int
+    reviews_deleted: int
+    sessions_revoked: int
+    establishments: int
+    transactions: int
+    max_transaction_ms: float
+    elapsed_ms: float
+    remaining_user_ids: List[int]
@@ -0,0 +1,235 @@
+# search.py
+"""
+Recherche plein texte dans les commentaires d'avis.
+
+SQLite : table FTS5 "external content" (reviews_fts -> reviews.comment), tenue à
+jour par triggers (insert / update / delete, y compris les suppressions en
+cascade). Tokenizer unicode61 + remove_diacritics 2 : "payées" == "payees",
+l'apostrophe sépare les mots ("l'hôtel" -> "l", "hotel"). Classement BM25,
+extraits via snippet(). Pas de stemmer dans FTS5 : chaque mot de la requête
+est réduit par une troncature de suffixes française légère puis cherché en
+préfixe ("payées" -> pay* : payé, payer, paiement non) ; mots vides ignorés.
+
+Postgres : index GIN sur to_tsvector('french', unaccent(comment)),
+classement ts_rank_cd, extraits ts_headline (stemmer Snowball).
+
+Les deux backends restent proches sans être identiques : la troncature
+SQLite ratisse un peu plus large (pay* trouve aussi "pays"), ne suit pas
+les radicaux irréguliers, et les "phrases entre guillemets" y restent
+exactes mot pour mot.
+
+Pagination par curseur (rang, id) : pas d'OFFSET.
+"""
+import base64
+import re
+import unicodedata
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+SNIPPET_TOKENS = 16
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_PHRASE_RE = re.compile(r'"([^"]+)"')
+
+# suffixes flexionnels / dérivationnels courants, sans accents, du plus long au plus court
+_SUFFIXES = (
+    "issements", "issement", "ements", "ement", "ations", "ation", "euses", "euse", "ables", "able",
+    "eaux", "aux", "eux", "ees", "es", "ee", "er", "ez", "e", "s", "x",
+)
+_MIN_STEM = 3  # = prefix='3' de l'index FTS5
+# mots vides les plus fréquents (Postgres 'french' les ignore aussi)
+_STOPWORDS = frozenset(
+    "a au aux avec ce ces d dans de des du elle en et il je l la le les leur lui ma mais me mes mon "
+    "ne nous on ou par pas pour qu que qui sa se ses son sur ta te tes ton tu un une vos votre vous".split()
+)
+
+_SQLITE_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS reviews_fts USING fts5(
+        comment,
+        content='reviews',
+        content_rowid='id',
+        tokenize="unicode61 remove_diacritics 2",
+        prefix='3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS reviews_fts_ai AFTER INSERT ON reviews BEGIN
+        INSERT INTO reviews_fts(rowid, comment) VALUES (new.id, new.comment);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS reviews_fts_ad AFTER DELETE ON reviews BEGIN
+        INSERT INTO reviews_fts(reviews_fts, rowid, comment) VALUES ('delete', old.id, old.comment);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS reviews_fts_au AFTER UPDATE OF comment ON reviews BEGIN
+        INSERT INTO reviews_fts(reviews_fts, rowid, comment) VALUES ('delete', old.id, old.comment);
+        INSERT INTO reviews_fts(rowid, comment) VALUES (new.id, new.comment);
+    END
+    """,
+]
+
+_POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    # unaccent() n'est pas IMMUTABLE : wrapper pour pouvoir l'indexer
+    """
+    CREATE OR REPLACE FUNCTION thena_unaccent(text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$ SELECT public.unaccent($1) $$
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_reviews_comment_fts ON reviews
+        USING GIN (to_tsvector('french', thena_unaccent(comment)))
+    """,
+]
+
+
+def setup(engine: Engine):
+    """Crée l'index plein texte (idempotent) ; reconstruit l'index FTS5 à sa création."""
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            created = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='reviews_fts'")
+            ).first() is None
+            for ddl in _SQLITE_DDL:
+                conn.execute(text(ddl))
+            if created:
+                conn.execute(text("INSERT INTO reviews_fts(reviews_fts) VALUES ('rebuild')"))
+        elif engine.dialect.name == "postgresql":
+            for ddl in _POSTGRES_DDL:
+                conn.execute(text(ddl))
+
+
+def fold(word: str) -> str:
+    """
+    Minuscules sans accents, comme le tokenizer (remove_diacritics 2) : seules
+    les marques combinantes (Mn) tombent, "œ", "ß" ou "日本" restent.
+    """
+    return "".join(
+        c for c in unicodedata.normalize("NFKD", word.lower()) if unicodedata.category(c) != "Mn"
+    )
+
+
+def stem(word: str) -> str:
+    """Troncature légère : "payées" -> "pay", "harcèlement" -> "harcel" ; jamais sous _MIN_STEM."""
+    word = fold(word)
+    if word.isdigit():
+        return word
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= _MIN_STEM:
+            return word[:-len(suffix)]
+    return word
+
+
+def to_fts5_query(q: str) -> str:
+    """
+    Texte utilisateur -> requête FTS5 sûre : tous les mots requis (AND), chacun
+    en préfixe de son radical, mots vides ignorés ; les "phrases entre
+    guillemets" restent des phrases exactes.
+    """
+    parts = []
+    for phrase in _PHRASE_RE.findall(q):
+        words = _WORD_RE.findall(phrase)
+        if words:
+            parts.append('"' + " ".join(words) + '"')
+    rest = _PHRASE_RE.sub(" ", q)
+    for word in _WORD_RE.findall(rest):
+        folded = fold(word)
+        if not folded or folded in _STOPWORDS:
+            continue
+        root = stem(word)
+        # préfixe seulement pour un radical tronqué ou assez long : "mal" ne doit pas trouver "malade"
+        prefix = root != folded or len(root) > _MIN_STEM
+        parts.append(f'"{root}"*' if prefix and not root.isdigit() else f'"{root}"')
+    return " ".join(parts)
+
+
+def encode_cursor(rank: float, review_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{rank!r}:{review_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    rank, review_id = raw.split(":")
+    return float(rank), int(review_id)
+
+
+def _filters(filters: dict, params: dict) -> str:
+    sql = ""
+    if filters.get("role"):
+        sql += " AND lower(r.role) = lower(:role)"
+        params["role"] = filters["role"]
+    if filters.get("contract"):
+        sql += " AND r.contract = :contract"
+        params["contract"] = filters["contract"]
+    for flag in ("coupure", "unpaid_overtime", "toxic_manager", "harassment", "recommend"):
+        if filters.get(flag) is not None:
+            sql += f" AND r.{flag} = :{flag}"
+            params[flag] = bool(filters[flag])
+    return sql
+
+
+def search_reviews(
+    db: Session,
+    q: str,
+    limit: int = 20,
+    after: Optional[str] = None,
+    **filters,
+) -> Tuple[List[Tuple[int, float, str]], Optional[str]]:
+    """
+    Renvoie ([(review_id, rank, snippet), ...], next_cursor).
+    Rang croissant = plus pertinent (bm25 négatif / -ts_rank_cd).
+    """
+    dialect = db.get_bind().dialect.name
+    params = {"limit": limit + 1}
+    where = _filters(filters, params)
+
+    if after:
+        params["after_rank"], params["after_id"] = decode_cursor(after)
+        where += " AND (rank > :after_rank OR (rank = :after_rank AND r.id > :after_id))"
+
+    if dialect == "sqlite":
+        match = to_fts5_query(q)
+        if not match:
+            return [], None
+        params["q"] = match
+        sql = f"""
+            SELECT * FROM (
+                SELECT r.id AS id, bm25(reviews_fts) AS rank,
+                       snippet(reviews_fts, 0, '[', ']', '…', {SNIPPET_TOKENS}) AS snippet,
+                       r.role, r.contract, r.coupure, r.unpaid_overtime, r.toxic_manager,
+                       r.harassment, r.recommend
+                FROM reviews_fts JOIN reviews r ON r.id = reviews_fts.rowid
+                WHERE reviews_fts MATCH :q
+            ) r
+            WHERE 1=1 {where}
+            ORDER BY rank, id
+            LIMIT :limit
+        """
+    else:
+        params["q"] = q
+        sql = f"""
+            SELECT * FROM (
+                SELECT r.id AS id,
+                       -ts_rank_cd(to_tsvector('french', thena_unaccent(r.comment)), query) AS rank,
+                       ts_headline('french', r.comment, query,
+                                   'StartSel=[,StopSel=],MaxWords={SNIPPET_TOKENS},MinWords=5') AS snippet,
+                       r.role, r.contract, r.coupure, r.unpaid_overtime, r.toxic_manager,
+                       r.harassment, r.recommend
+                FROM reviews r, websearch_to_tsquery('french', thena_unaccent(:q)) query
+                WHERE to_tsvector('french', thena_unaccent(r.comment)) @@ query
+            ) r
+            WHERE 1=1 {where}
+            ORDER BY rank, id
+            LIMIT :limit
+        """
+
+    rows = db.execute(text(sql), params).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].rank, rows[-1].id)
+    return [(row.id, row.rank, row.snippet) for row in rows], next_cursor
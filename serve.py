@@ -0,0 +1,312 @@
+# serve.py
+"""
+Lanceur de production multi-process.
+
+    python serve.py [--workers N] [--port 8000] ...
+
+- l'app (main.py) est importée UNE fois dans le master puis les workers sont
+  forkés : mémoire partagée en copy-on-write, démarrage des workers immédiat ;
+- uvloop + httptools, keep-alive et backlog réglés pour un reverse proxy ;
+- socket d'écoute créé par le master (SO_REUSEPORT) et hérité par les
+  workers : file d'accept commune, un worker qui redémarre ne perd aucune
+  connexion en attente ; un second master peut se lier au même port pendant
+  un déploiement (démarrer le nouveau, puis SIGTERM à l'ancien) ;
+- SIGHUP : redémarrage des workers un par un (le remplaçant est prêt avant
+  l'arrêt gracieux de l'ancien) ; avec --no-preload, recharge aussi le code ;
+- recyclage d'un worker dont la mémoire privée dépasse --max-memory-mb
+  (même remplacement sans coupure) ; worker mort -> relancé ;
+- plus d'un worker : THENA_LIVE_BACKEND et THENA_RATELIMIT_BACKEND valent
+  "sqlite" par défaut ("local" = état par process : SSE et compteurs non
+  partagés) ; "local" explicite est refusé.
+
+Signaux : SIGTERM / SIGINT = arrêt gracieux, SIGHUP = rolling restart.
+"""
+import argparse
+import importlib
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import time
+from typing import Dict, Optional
+
+import uvicorn
+
+DEFAULT_BACKLOG = 2048
+DEFAULT_KEEPALIVE = 65  # > timeout d'inactivité usuel des load balancers (60 s)
+READY_TIMEOUT = 60
+MEMORY_CHECK_SECONDS = 10
+RESPAWN_DELAY = 1.0
+# backends d'état partagé entre workers (live.py, ratelimit.py)
+SHARED_BACKENDS = ("THENA_LIVE_BACKEND", "THENA_RATELIMIT_BACKEND")
+
+
+def default_workers() -> int:
+    try:
+        cores = len(os.sched_getaffinity(0))  # cœurs réellement alloués (cgroups / taskset)
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    return max(cores, 1)
+
+
+def require_shared_backends(workers: int):
+    """Avant l'import de l'app (lu à l'import) : "sqlite" par défaut dès 2 workers."""
+    if workers <= 1:
+        return
+    for name in SHARED_BACKENDS:
+        if os.environ.setdefault(name, "sqlite") == "local":
+            sys.exit(f"SERVE: {name}=local keeps state per worker; use sqlite or --workers 1")
+
+
+def load_app(path: str):
+    module, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module), attr or "app")
+
+
+def private_memory_mb(pid: int) -> Optional[float]:
+    """Mémoire non partagée du process (pages COW du master exclues)."""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            kb = sum(int(line.split()[1]) for line in f if line.startswith(("Private_Clean", "Private_Dirty")))
+        return kb / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def bind_socket(host: str, port: int, backlog: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class _WorkerServer(uvicorn.Server):
+    """Signale au master (pipe) que le worker accepte des connexions."""
+
+    def __init__(self, config: uvicorn.Config, ready_fd: int):
+        super().__init__(config)
+        self.ready_fd = ready_fd
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        if self.started:
+            os.write(self.ready_fd, b"R")
+            os.close(self.ready_fd)
+
+
+class Master:
+    def __init__(self, args):
+        self.args = args
+        self.app = None
+        self.sock: Optional[socket.socket] = None
+        self.workers: Dict[int, float] = {}  # pid -> heure de démarrage
+        self.retiring: set = set()           # pids arrêtés volontairement
+        self._stop = False
+        self._reload = False
+
+    # ---------------- workers ----------------
+    def uvicorn_config(self, app) -> uvicorn.Config:
+        a = self.args
+        max_requests = None
+        if a.max_requests:
+            # jitter : les workers ne se recyclent pas tous en même temps
+            max_requests = a.max_requests + random.randint(0, a.max_requests // 10)
+        return uvicorn.Config(
+            app,
+            loop="uvloop",
+            http="httptools",
+            lifespan="on",
+            backlog=a.backlog,
+            timeout_keep_alive=a.keepalive,
+            timeout_graceful_shutdown=a.graceful_timeout,
+            limit_max_requests=max_requests,
+            proxy_headers=True,
+            forwarded_allow_ips=a.forwarded_allow_ips,
+            access_log=a.access_log,
+            server_header=False,
+        )
+
+    def spawn(self) -> Optional[int]:
+        """Forke un worker ; renvoie son pid une fois prêt (None si échec)."""
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            code = 0
+            try:
+                self._run_worker(w)
+            except BaseException as e:
+                print(f"SERVE: worker {os.getpid()} crashed: {e!r}", file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(w)
+        self.workers[pid] = time.time()
+        ready, _, _ = select.select([r], [], [], READY_TIMEOUT)
+        ok = bool(ready) and os.read(r, 1) == b"R"
+        os.close(r)
+        if not ok:
+            print(f"SERVE: worker {pid} not ready after {READY_TIMEOUT}s", file=sys.stderr)
+            self.retire(pid, graceful=False)
+            return None
+        return pid
+
+    def _run_worker(self, ready_fd: int):
+        for sig in (signal.SIGHUP, signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, signal.SIG_DFL)
+        if self.app is not None:
+            # connexions héritées du master : jamais partagées entre process
+            from database import engine
+            engine.dispose(close=False)
+            app = self.app
+        else:
+            app = load_app(self.args.app)
+        server = _WorkerServer(self.uvicorn_config(app), ready_fd)
+        server.run(sockets=[self.sock])
+
+    def retire(self, pid: int, graceful: bool = True):
+        """Arrête un worker (SIGTERM, arrêt gracieux uvicorn), SIGKILL après le délai."""
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM if graceful else signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        deadline = time.time() + self.args.graceful_timeout + 5
+        while time.time() < deadline:
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if done:
+                break
+            time.sleep(0.05)
+        else:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.workers.pop(pid, None)
+        self.retiring.discard(pid)
+
+    def replace(self, pid: int, reason: str):
+        # le remplaçant accepte déjà des connexions avant l'arrêt de l'ancien
+        new_pid = self.spawn()
+        print(f"SERVE: replacing worker {pid} ({reason}) -> {new_pid}", file=sys.stderr)
+        if new_pid is not None:
+            self.retire(pid)
+
+    def rolling_restart(self):
+        for pid in list(self.workers):
+            if self._stop:
+                return
+            self.replace(pid, "reload")
+
+    def check_memory(self):
+        limit = self.args.max_memory_mb
+        for pid in list(self.workers):
+            mb = private_memory_mb(pid)
+            if mb is not None and mb > limit:
+                self.replace(pid, f"{mb:.0f} MB > {limit} MB")
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.workers and pid not in self.retiring:
+                # mort inattendue ou --max-requests atteint
+                del self.workers[pid]
+                if not self._stop:
+                    print(f"SERVE: worker {pid} exited (status {status}), respawning", file=sys.stderr)
+                    time.sleep(RESPAWN_DELAY)
+                    self.spawn()
+
+    # ---------------- master ----------------
+    def _on_stop(self, signum, frame):
+        self._stop = True
+
+    def _on_hup(self, signum, frame):
+        self._reload = True
+
+    def run(self):
+        a = self.args
+        require_shared_backends(a.workers)  # hérité par les workers, --no-preload compris
+        if a.preload:
+            self.app = load_app(a.app)
+            # aucune connexion ouverte dans le master ne doit être héritée
+            from database import engine
+            engine.dispose()
+        self.sock = bind_socket(a.host, a.port, a.backlog)
+        print(f"SERVE: listening on {a.host}:{a.port} with {a.workers} workers "
+              f"(preload={a.preload}, pid {os.getpid()})", file=sys.stderr)
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_hup)
+
+        for _ in range(a.workers):
+            self.spawn()
+
+        last_memory_check = time.time()
+        try:
+            while not self._stop:
+                time.sleep(0.5)
+                self.reap()
+                if self._reload:
+                    self._reload = False
+                    self.rolling_restart()
+                if a.max_memory_mb and time.time() - last_memory_check > MEMORY_CHECK_SECONDS:
+                    last_memory_check = time.time()
+                    self.check_memory()
+                missing = a.workers - len(self.workers)
+                for _ in range(max(missing, 0)):
+                    if not self._stop:
+                        self.spawn()
+        finally:
+            for pid in list(self.workers):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in list(self.workers):
+                self.retire(pid)
+            self.sock.close()
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="THENA production server")
+    p.add_argument("--app", default="main:app")
+    p.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    p.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    p.add_argument("--workers", type=int, default=int(os.getenv("THENA_WORKERS", "0")) or default_workers())
+    p.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG)
+    p.add_argument("--keepalive", type=int, default=DEFAULT_KEEPALIVE)
+    p.add_argument("--graceful-timeout", type=int, default=30)
+    p.add_argument("--max-memory-mb", type=int, default=int(os.getenv("THENA_WORKER_MAX_MEMORY_MB", "0")),
+                   help="recycle un worker au-delà (mémoire privée), 0 = désactivé")
+    p.add_argument("--max-requests", type=int, default=0, help="recycle un worker après N requêtes (+ jitter)")
+    p.add_argument("--forwarded-allow-ips", default=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"))
+    p.add_argument("--access-log", action="store_true")
+    p.add_argument("--no-preload", dest="preload", action="store_false",
+                   help="chaque worker importe l'app (SIGHUP recharge alors le code)")
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    Master(parse_args()).run()
@@ -0,0 +1,257 @@
+# snapshots.py
+"""
+Snapshots JSON pré-rendus des fiches établissement.
+
+    <dir>/establishments/<id>.json   -> EstablishmentWithStats (même JSON que l'API)
+    <dir>/types/<type>.json          -> index par type Google
+    <dir>/cities/<ville>.json        -> index par ville (déduite de l'adresse)
+
+Le dossier est servi en statique (/snapshots/...) : un CDN ou nginx peut le
+servir sans passer par FastAPI. Après chaque écriture d'avis, l'établissement
+est marqué "dirty" ; un thread de fond régénère uniquement ceux-là puis les
+index concernés. Chaque fichier est remplacé atomiquement (tmp + os.replace).
+
+Les endpoints de lecture servent le fichier quand sa version == version en base.
+
+Usage hors app (génération complète) :
+    python snapshots.py
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import unicodedata
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from sqlalchemy import or_, select
+from sqlalchemy.orm import Session
+
+from establishment_index import parse_types
+from models import Establishment, EstablishmentType
+
+SNAPSHOT_DIR = os.getenv("THENA_SNAPSHOT_DIR", "./snapshots")
+SNAPSHOTS_ENABLED = os.getenv("THENA_SNAPSHOTS", "1") != "0"
+
+_SLUG_RE = re.compile(r"[^a-z0-9]+")
+_CITY_RE = re.compile(r"\b\d{5}\s+([^,]+)")
+
+# colonnes des index par type / ville (pas d'objets ORM : tout l'annuaire au rebuild complet)
+_INDEX_COLUMNS = (
+    Establishment.id, Establishment.google_place_id, Establishment.name, Establishment.address,
+    Establishment.google_rating, Establishment.types_json, Establishment.thena_avg, Establishment.thena_count_total,
+)
+
+
+def slugify(value: str) -> str:
+    value = unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode("ascii")
+    return _SLUG_RE.sub("-", value.lower()).strip("-") or "unknown"
+
+
+def city_from_address(address: Optional[str]) -> Optional[str]:
+    """"12 Rue X, 74400 Chamonix-Mont-Blanc, France" -> "Chamonix-Mont-Blanc"."""
+    if not address:
+        return None
+    m = _CITY_RE.search(address)
+    if m:
+        return m.group(1).strip()
+    parts = [p.strip() for p in address.split(",") if p.strip()]
+    return parts[-2] if len(parts) >= 2 else None
+
+
+def atomic_write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class SnapshotStore:
+    def __init__(self, directory: str, session_factory, build: Callable, debounce_seconds: float = 0.5):
+        self.directory = directory
+        self.session_factory = session_factory
+        self.build = build  # (est_id, db) -> EstablishmentWithStats
+        self.debounce_seconds = debounce_seconds
+
+        self._dirty: Set[int] = set()
+        self._versions: Dict[int, int] = {}  # est_id -> version du fichier sur disque
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------------- chemins ----------------
+    def establishment_path(self, est_id: int) -> str:
+        return os.path.join(self.directory, "establishments", f"{est_id}.json")
+
+    def type_path(self, type_name: str) -> str:
+        return os.path.join(self.directory, "types", f"{slugify(type_name)}.json")
+
+    def city_path(self, city: str) -> str:
+        return os.path.join(self.directory, "cities", f"{slugify(city)}.json")
+
+    # ---------------- lecture ----------------
+    def read_fresh(self, est_id: int, version: int) -> Optional[bytes]:
+        """Contenu du snapshot s'il correspond à `version`, sinon None."""
+        with self._lock:
+            if est_id in self._dirty:
+                return None
+            known = self._versions.get(est_id)
+        if known is not None and known != version:
+            # peut avoir été régénéré par un autre worker : on relit le fichier
+            known = None
+        try:
+            with open(self.establishment_path(est_id), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if known is None:
+            try:
+                known = json.loads(data).get("version")
+            except ValueError:
+                return None
+            with self._lock:
+                self._versions[est_id] = known
+        return data if known == version else None
+
+    # ---------------- écriture ----------------
+    def mark_dirty(self, est_id: int):
+        with self._lock:
+            self._dirty.add(est_id)
+        self._wake.set()
+
+    def write_establishments(self, est_ids: Iterable[int], db: Session) -> list:
+        written = []
+        for est_id in est_ids:
+            est = db.query(Establishment).get(est_id)
+            if est is None:
+                try:
+                    os.unlink(self.establishment_path(est_id))
+                except FileNotFoundError:
+                    pass
+                continue
+            bundle = self.build(est_id, db)
+            atomic_write(self.establishment_path(est_id), bundle.model_dump_json().encode("utf-8"))
+            with self._lock:
+                self._versions[est_id] = bundle.version
+            written.append(est)
+        return written
+
+    def write_indexes(self, db: Session, types: Optional[Set[str]] = None, cities: Optional[Set[str]] = None):
+        """
+        Réécrit les index par type / ville (tous si types et cities sont None).
+        Sinon seuls les établissements candidats sont lus : par establishment_types
+        pour les types, par LIKE sur l'adresse pour les villes (confirmé ensuite).
+        """
+        q = db.query(*_INDEX_COLUMNS).order_by(Establishment.id)
+        full = types is None and cities is None
+        if not full:
+            types, cities = types or set(), cities or set()
+            if not types and not cities:
+                return
+            q = q.filter(or_(
+                Establishment.id.in_(
+                    select(EstablishmentType.establishment_id).where(EstablishmentType.type.in_({t[:64] for t in types}))
+                ),
+                *[Establishment.address.like(f"%{city}%") for city in cities],
+            ))
+        # index incrémental vidé de son dernier établissement : réécrit vide
+        by_type: Dict[str, list] = {} if full else {t: [] for t in types}
+        by_city: Dict[str, list] = {} if full else {c: [] for c in cities}
+        for row in q.yield_per(1000):
+            est_types = parse_types(row.types_json)
+            city = city_from_address(row.address)
+            entry = {
+                "id": row.id,
+                "google_place_id": row.google_place_id,
+                "name": row.name,
+                "address": row.address,
+                "google_rating": row.google_rating,
+                "types": est_types,
+                "thena_avg": row.thena_avg,
+                "thena_count_total": row.thena_count_total,
+            }
+            for t in est_types:
+                if full or t in types:
+                    by_type.setdefault(t, []).append(entry)
+            if city and (full or city in cities):
+                by_city.setdefault(city, []).append(entry)
+
+        for t, entries in by_type.items():
+            atomic_write(self.type_path(t), json.dumps({"type": t, "establishments": entries}).encode("utf-8"))
+        for city, entries in by_city.items():
+            atomic_write(self.city_path(city), json.dumps({"city": city, "establishments": entries}).encode("utf-8"))
+
+    def rebuild_all(self):
+        db = self.session_factory()
+        try:
+            ids = [est_id for (est_id,) in db.query(Establishment.id)]
+            self.write_establishments(ids, db)
+            self.write_indexes(db)
+        finally:
+            db.close()
+
+    def flush_dirty(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return
+        db = self.session_factory()
+        try:
+            written = self.write_establishments(sorted(dirty), db)
+            types = {t for est in written for t in parse_types(est.types_json)}
+            cities = {c for c in (city_from_address(est.address) for est in written) if c}
+            if types or cities:
+                self.write_indexes(db, types=types, cities=cities)
+        except Exception:
+            # on réessaiera au prochain réveil
+            with self._lock:
+                self._dirty |= dirty
+            raise
+        finally:
+            db.close()
+
+    # ---------------- job de fond ----------------
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="thena-snapshots", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait()
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            # regroupe les écritures rapprochées
+            self._stop.wait(self.debounce_seconds)
+            try:
+                self.flush_dirty()
+            except Exception as e:
+                print("SNAPSHOTS: regeneration failed:", repr(e))
+                self._stop.wait(5)
+                self._wake.set()
+
+
+if __name__ == "__main__":
+    from main import snapshots
+
+    snapshots.rebuild_all()
+    print("snapshots written to", os.path.abspath(snapshots.directory))
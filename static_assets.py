@@ -0,0 +1,185 @@
+# static_assets.py
+"""
+Livraison de l'UI (dossier ui/) depuis la mémoire.
+
+Au démarrage :
+- chaque .js / .css reçoit un nom empreinte (app.3f9c1b2a7e.js) ;
+- les variantes gzip (et brotli si le module est installé) sont pré-calculées ;
+- les références dans les .html sont réécrites vers les noms empreinte ;
+- le service worker (sw.js, nom fixe) reçoit la liste de la coquille à
+  pré-cacher et une version dérivée des empreintes : chaque déploiement qui
+  change un .js / .css installe un nouveau worker et purge les anciens caches.
+
+À la requête : aucun accès disque, aucune compression. Les fichiers empreinte
+partent en `Cache-Control: immutable` ; les pages HTML en `no-cache` + ETag
+(revalidation -> 304).
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+from typing import Dict, Optional
+
+from fastapi import Request, Response
+
+try:
+    import brotli  # optionnel (pip install Brotli)
+except ImportError:  # pragma: no cover
+    brotli = None
+
+FINGERPRINT_EXTS = (".js", ".css")
+SERVICE_WORKER = "sw.js"  # URL stable obligatoire : jamais renommé par empreinte
+SHELL_PAGES = ("/", "/ui/")  # servent index.html
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# href="/ui/styles.css" / src="/ui/app.js?v=8"
+_REF_RE = re.compile(r'(src|href)="/ui/([^"?#]+)(\?[^"#]*)?"')
+
+
+class Asset:
+    __slots__ = ("body", "gzip", "br", "media_type", "etag", "cache_control")
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str):
+        self.body = body
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+
+        gz = gzip.compress(body, compresslevel=9, mtime=0)
+        self.gzip = gz if len(gz) < len(body) else None
+
+        br = brotli.compress(body, quality=11) if brotli is not None else None
+        self.br = br if br is not None and len(br) < len(body) else None
+
+
+def _fingerprint(name: str, body: bytes) -> str:
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(body).hexdigest()[:10]}{ext}"
+
+
+def accepted_encodings(header: str) -> set:
+    """Codages acceptés (q > 0) d'un en-tête Accept-Encoding."""
+    out = set()
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding and q > 0:
+            out.add(coding.strip().lower())
+    return out
+
+
+def _media_type(name: str) -> str:
+    media_type, _ = mimetypes.guess_type(name)
+    if media_type is None:
+        return "application/octet-stream"
+    if media_type.startswith("text/") or media_type in ("application/javascript", "application/json"):
+        return f"{media_type}; charset=utf-8"
+    return media_type
+
+
+class StaticAssets:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.assets: Dict[str, Asset] = {}
+        # nom logique -> nom empreinte (ex: "app.js" -> "app.3f9c1b2a7e.js")
+        self.manifest: Dict[str, str] = {}
+        self.version = ""
+        self.build()
+
+    def build(self):
+        assets: Dict[str, Asset] = {}
+        manifest: Dict[str, str] = {}
+        pages = {}
+        worker = None
+
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb") as f:
+                body = f.read()
+
+            if name.endswith(".html"):
+                pages[name] = body
+                continue
+            if name == SERVICE_WORKER:
+                worker = body
+                continue
+
+            media_type = _media_type(name)
+            if name.endswith(FINGERPRINT_EXTS):
+                hashed = _fingerprint(name, body)
+                manifest[name] = hashed
+                assets[hashed] = Asset(body, media_type, IMMUTABLE)
+            # nom d'origine toujours servi (anciens clients), mais revalidé
+            assets[name] = Asset(body, media_type, REVALIDATE)
+
+        def rewrite(m: re.Match) -> str:
+            attr, name = m.group(1), m.group(2)
+            if name not in manifest:
+                return m.group(0)
+            return f'{attr}="/ui/{manifest[name]}"'
+
+        for name, body in pages.items():
+            html = _REF_RE.sub(rewrite, body.decode("utf-8")).encode("utf-8")
+            assets[name] = Asset(html, _media_type(name), REVALIDATE)
+
+        version = hashlib.sha256(
+            json.dumps(sorted(manifest.values())).encode("utf-8") + (worker or b"")
+        ).hexdigest()[:10]
+        if worker is not None:
+            precache = list(SHELL_PAGES) + [f"/ui/{hashed}" for hashed in sorted(manifest.values())]
+            body = (
+                worker.decode("utf-8")
+                .replace("__THENA_UI_VERSION__", version)
+                .replace("__THENA_PRECACHE__", json.dumps(precache))
+                .encode("utf-8")
+            )
+            assets[SERVICE_WORKER] = Asset(body, _media_type(SERVICE_WORKER), REVALIDATE)
+
+        self.assets = assets
+        self.manifest = manifest
+        self.version = version
+
+    def get(self, name: str) -> Optional[Asset]:
+        return self.assets.get(name or "index.html")
+
+    def response(self, name: str, request: Request) -> Response:
+        asset = self.get(name)
+        if asset is None:
+            return Response(status_code=404, content="Not Found", media_type="text/plain")
+
+        accept = accepted_encodings(request.headers.get("accept-encoding", ""))
+        if asset.br is not None and "br" in accept:
+            body, encoding = asset.br, "br"
+        elif asset.gzip is not None and "gzip" in accept:
+            body, encoding = asset.gzip, "gzip"
+        else:
+            body, encoding = asset.body, None
+
+        etag = f'"{asset.etag}-{encoding}"' if encoding else f'"{asset.etag}"'
+        headers = {
+            "Cache-Control": asset.cache_control,
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding:
+            headers["Content-Encoding"] = encoding
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            return Response(status_code=200, headers=headers, media_type=asset.media_type)
+        return Response(content=body, headers=headers, media_type=asset.media_type)
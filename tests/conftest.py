@@ -0,0 +1,25 @@
+# tests/conftest.py
+"""
+Environnement de test : base SQLite temporaire et jobs de fond coupés, fixés
+AVANT l'import de main (la configuration est lue à l'import des modules).
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_TMP = tempfile.mkdtemp(prefix="thena-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(_TMP, 'thena.db')}",
+    "THENA_RATELIMIT": "0",
+    "THENA_EVENTLOG": "0",
+    "THENA_EVENTLOG_DIR": os.path.join(_TMP, "logs"),
+    "THENA_SNAPSHOTS": "0",
+    "THENA_PIPELINE_PROCESSES": "0",
+    "THENA_PIPELINE_LOCK": os.path.join(_TMP, "pipeline.lock"),
+    "THENA_BACKUP_DIR": os.path.join(_TMP, "backups"),
+    "THENA_LIVE_BACKEND": "local",
+    "THENA_RATELIMIT_BACKEND": "local",
+})
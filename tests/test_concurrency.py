@@ -0,0 +1,84 @@
+# tests/test_concurrency.py
+"""
+Soumissions en double concurrentes (user-037) : upserts natifs ON CONFLICT,
+jamais d'IntegrityError remontée en 500, une seule ligne à l'arrivée.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from database import SessionLocal
+from models import Establishment, Review, Session as DbSession, User
+from security import hash_token
+
+PARALLEL = 16
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(main.app) as c:
+        yield c
+
+
+def login(email: str) -> dict:
+    db = SessionLocal()
+    try:
+        user = User(email=email, pseudo=email.split("@")[0])
+        db.add(user)
+        db.commit()
+        db.add(DbSession(user_id=user.id, session_hash=hash_token(email),
+                         expires_at=datetime.utcnow() + timedelta(days=1)))
+        db.commit()
+        return {main.COOKIE_NAME: email}
+    finally:
+        db.close()
+
+
+def fire(client, path: str, payloads: list, cookies: dict = None) -> list:
+    def post(payload):
+        return client.post(path, json=payload, cookies=cookies).status_code
+    with ThreadPoolExecutor(PARALLEL) as pool:
+        return list(pool.map(post, payloads))
+
+
+def count(model, *criteria) -> int:
+    db = SessionLocal()
+    try:
+        return db.query(model).filter(*criteria).count()
+    finally:
+        db.close()
+
+
+def establishment_id(client, place_id: str) -> int:
+    r = client.post("/establishments", json={"google_place_id": place_id, "name": place_id})
+    assert r.status_code == 200
+    return r.json()["id"]
+
+
+def test_parallel_establishment_upserts(client):
+    payload = {"google_place_id": "race-est", "name": "Chez Race", "types": ["bar"]}
+    statuses = fire(client, "/establishments", [payload] * PARALLEL)
+    assert statuses == [200] * PARALLEL
+    assert count(Establishment, Establishment.google_place_id == "race-est") == 1
+
+
+def test_parallel_review_upserts(client):
+    est_id = establishment_id(client, "race-review")
+    cookies = login("race-review@thena.test")
+    payload = {"establishment_id": est_id, "score": 4, "comment": "Même avis envoyé en rafale"}
+    statuses = fire(client, "/reviews", [payload] * PARALLEL, cookies)
+    assert statuses == [200] * PARALLEL
+    assert count(Review, Review.establishment_id == est_id) == 1
+
+
+def test_parallel_review_batches(client):
+    est_ids = [establishment_id(client, f"race-batch-{i}") for i in range(3)]
+    cookies = login("race-batch@thena.test")
+    batch = {"reviews": [{"establishment_id": e, "score": 3, "comment": "Lot rejoué hors ligne"} for e in est_ids]}
+    statuses = fire(client, "/reviews/batch", [batch] * PARALLEL, cookies)
+    assert statuses == [200] * PARALLEL
+    for est_id in est_ids:
+        assert count(Review, Review.establishment_id == est_id) == 1
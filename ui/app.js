@@ -40,9 +40,17 @@ const LS = {
   currentPlaceId: "thena:currentPlaceId",
   currentEstId: "thena:currentEstId",
   draft: (placeIdOrEstId) => `thena:draft:${placeIdOrEstId}`,
+  bundle: (estId) => `thena:bundle:${estId}`,
+  estByPlace: (googlePlaceId) => `thena:estByPlace:${googlePlaceId}`,
 };
 
 let debounceTimer = null;
+let autocompleteCtl = null; // AbortController de la requête autocomplete en cours
+// identifiant d'onglet : "dernière saisie gagne" côté serveur par onglet, jamais par IP partagée
+const TAB_ID = newIdempotencyKey();
+
+let liveSource = null; // EventSource sur /establishments/{id}/live
+let liveEstId = null;
 
 let current = {
   place: null,          // Google place details normalized
@@ -82,6 +90,7 @@ function showPanel() {
 }
 
 function hidePanel() {
+  closeLive();
   panel.classList.add("hidden");
   panel.innerHTML = "";
 }
@@ -139,6 +148,8 @@ function normalizePlace(p) {
     address: p?.formatted_address ?? p?.address ?? "",
     rating: rating == null ? null : Number(rating),
     types: Array.isArray(types) ? types : [],
+    lat: safeNumber(p?.lat ?? p?.geometry?.location?.lat),
+    lng: safeNumber(p?.lng ?? p?.geometry?.location?.lng),
   };
 }
 
@@ -147,9 +158,9 @@ function normalizePlace(p) {
 ========================= */
 async function apiFetch(path, opts = {}) {
   const res = await fetch(API + path, {
-    headers: { "Content-Type": "application/json" },
     credentials: "include", // IMPORTANT: cookies session
     ...opts,
+    headers: { "Content-Type": "application/json", ...(opts.headers || {}) },
   });
 
   const text = await res.text();
@@ -170,8 +181,8 @@ async function apiFetch(path, opts = {}) {
   return data;
 }
 
-const apiGET = (p) => apiFetch(p);
-const apiPOST = (p, body) => apiFetch(p, { method: "POST", body: JSON.stringify(body) });
+const apiGET = (p, opts) => apiFetch(p, opts);
+const apiPOST = (p, body, headers) => apiFetch(p, { method: "POST", body: JSON.stringify(body), headers });
 const apiDELETE = (p) => apiFetch(p, { method: "DELETE" });
 
 async function tryManyGet(paths) {
@@ -218,6 +229,73 @@ function clearDraft() {
   localStorage.removeItem(key);
 }
 
+/* =========================
+   Local review cache (delta-sync)
+========================= */
+function loadCachedBundle(estId) {
+  const b = safeJson(localStorage.getItem(LS.bundle(estId)), null);
+  return b?.establishment && Array.isArray(b.reviews) && Number.isFinite(b.version) ? b : null;
+}
+
+function saveCachedBundle(bundle) {
+  const est = bundle?.establishment;
+  if (!est?.id) return;
+  try {
+    localStorage.setItem(LS.bundle(est.id), JSON.stringify(bundle));
+    if (est.google_place_id) localStorage.setItem(LS.estByPlace(est.google_place_id), est.id);
+  } catch {
+    // quota plein : le cache est optionnel
+  }
+}
+
+function dropCachedBundle(estId, googlePlaceId) {
+  localStorage.removeItem(LS.bundle(estId));
+  if (googlePlaceId) localStorage.removeItem(LS.estByPlace(googlePlaceId));
+}
+
+// n'avance la version que si aucun delta n'a été manqué ; sinon le prochain
+// /changes repartira de l'ancienne version (merge idempotent)
+function advanceVersion(bundle, version) {
+  if (Number.isFinite(version) && version === (bundle.version ?? 0) + 1) bundle.version = version;
+}
+
+function mergeChanges(bundle, changes) {
+  const deleted = new Set(changes.deleted || []);
+  const byId = new Map();
+  for (const r of bundle.reviews || []) if (!deleted.has(r.id)) byId.set(r.id, r);
+  for (const r of changes.reviews || []) byId.set(r.id, r);
+
+  bundle.reviews = [...byId.values()].sort((a, b) => new Date(b.created_at) - new Date(a.created_at));
+  bundle.version = changes.version;
+  bundle.thena_avg = changes.thena_avg;
+  bundle.thena_count_scored = changes.thena_count_scored;
+  bundle.thena_count_total = changes.thena_count_total;
+  return bundle;
+}
+
+// fetch() rejeté sans réponse HTTP = réseau coupé
+const isNetworkError = (e) => e instanceof TypeError && e.status === undefined;
+
+async function fetchBundle(estId) {
+  const cached = loadCachedBundle(estId);
+  if (cached) {
+    let changes;
+    try {
+      changes = await apiGET(`/establishments/${estId}/changes?since=${cached.version}`);
+    } catch (e) {
+      if (isNetworkError(e)) return cached; // hors ligne : dernière copie locale
+      throw e;
+    }
+    const merged = mergeChanges(cached, changes);
+    saveCachedBundle(merged);
+    return merged;
+  }
+
+  const fresh = await apiGET(`/establishments/${estId}`);
+  saveCachedBundle(fresh);
+  return fresh;
+}
+
 /* =========================
    Auth UI
 ========================= */
@@ -340,11 +418,8 @@ function renderSuggestions(items) {
 /* =========================
    Render Panel
 ========================= */
-function renderPanel(estBundle, isNewFlow) {
-  showPanel();
-
+function renderTopHtml(reviews) {
   const place = current.place;
-  const reviews = estBundle?.reviews ?? [];
   const reviewsCount = reviews.length;
 
   const avg = computeAverageScore(reviews);
@@ -356,7 +431,7 @@ function renderPanel(estBundle, isNewFlow) {
     .map((t) => `<span class="badge badge-na">${escapeHtml(t)}</span>`)
     .join("");
 
-  const topHtml = `
+  return `
     <div class="panelTop">
       <div>
         <div class="title">${escapeHtml(place.name || "Établissement")}</div>
@@ -374,48 +449,57 @@ function renderPanel(estBundle, isNewFlow) {
     </div>
     <div class="sep"></div>
   `;
+}
+
+function renderReviewsHtml(reviews) {
+  if (reviews.length === 0) return `<div class="small">Aucun avis THENA pour le moment.</div>`;
+
+  return reviews.map((r) => {
+    const score = safeNumber(r.score);
+    const pillText = score == null ? "Sans note" : `${score}/10`;
+    const pillCls = scorePillClass(score);
+
+    const author = r.user_pseudo ? `@${escapeHtml(r.user_pseudo)}` : "Utilisateur";
+    const metaBits = [
+      r.role ? `Rôle: ${escapeHtml(r.role)}` : null,
+      r.contract ? `Contrat: ${escapeHtml(r.contract)}` : null,
+      r.housing ? `Logement: ${escapeHtml(housingLabel(r.housing))}` : null,
+      r.housing_quality ? `Qualité: ${escapeHtml(housingLabel(r.housing_quality))}` : null,
+    ].filter(Boolean);
+
+    const canDelete = auth.user && r.user_id === auth.user.id;
+
+    return `
+      <div class="review">
+        <div class="reviewHead">
+          <div>
+            <span class="${pillCls}">${escapeHtml(pillText)}</span>
+            <span class="small muted" style="margin-left:10px">${author}</span>
+            ${metaBits.length ? `<span class="small"> • ${metaBits.join(" • ")}</span>` : ""}
+          </div>
+          <div class="small">${escapeHtml(formatDate(r.created_at || r.createdAt || r.date))}</div>
+        </div>
+
+        <div style="margin-top:8px">${escapeHtml(r.comment || "")}</div>
+
+        ${
+          canDelete
+            ? `<div class="btnRow">
+                <button class="btnDanger" onclick="deleteReview('${r.id}')">Supprimer</button>
+              </div>`
+            : ""
+        }
+      </div>
+    `;
+  }).join("");
+}
+
+function renderPanel(estBundle, isNewFlow) {
+  showPanel();
 
-  const listHtml =
-    reviewsCount === 0
-      ? `<div class="small">Aucun avis THENA pour le moment.</div>`
-      : reviews.map((r) => {
-          const score = safeNumber(r.score);
-          const pillText = score == null ? "Sans note" : `${score}/10`;
-          const pillCls = scorePillClass(score);
-
-          const author = r.user_pseudo ? `@${escapeHtml(r.user_pseudo)}` : "Utilisateur";
-          const metaBits = [
-            r.role ? `Rôle: ${escapeHtml(r.role)}` : null,
-            r.contract ? `Contrat: ${escapeHtml(r.contract)}` : null,
-            r.housing ? `Logement: ${escapeHtml(housingLabel(r.housing))}` : null,
-            r.housing_quality ? `Qualité: ${escapeHtml(housingLabel(r.housing_quality))}` : null,
-          ].filter(Boolean);
-
-          const canDelete = auth.user && r.user_id === auth.user.id;
-
-          return `
-            <div class="review">
-              <div class="reviewHead">
-                <div>
-                  <span class="${pillCls}">${escapeHtml(pillText)}</span>
-                  <span class="small muted" style="margin-left:10px">${author}</span>
-                  ${metaBits.length ? `<span class="small"> • ${metaBits.join(" • ")}</span>` : ""}
-                </div>
-                <div class="small">${escapeHtml(formatDate(r.created_at || r.createdAt || r.date))}</div>
-              </div>
-
-              <div style="margin-top:8px">${escapeHtml(r.comment || "")}</div>
-
-              ${
-                canDelete
-                  ? `<div class="btnRow">
-                      <button class="btnDanger" onclick="deleteReview('${r.id}')">Supprimer</button>
-                    </div>`
-                  : ""
-              }
-            </div>
-          `;
-        }).join("");
+  const reviews = estBundle?.reviews ?? [];
+  const topHtml = renderTopHtml(reviews);
+  const listHtml = renderReviewsHtml(reviews);
 
   const draft = loadDraft();
   const defaultScore = draft.score ?? "";
@@ -444,11 +528,11 @@ function renderPanel(estBundle, isNewFlow) {
 
   panel.innerHTML = `
     <section class="card">
-      ${topHtml}
+      <div id="panelTop">${topHtml}</div>
 
       <div>
         <h3 style="margin:0 0 10px 0">Reviews THENA</h3>
-        ${listHtml}
+        <div id="reviewsList">${listHtml}</div>
       </div>
 
       <div class="sep"></div>
@@ -565,6 +649,77 @@ function renderPanel(estBundle, isNewFlow) {
   }
 
   refreshBtn.onclick = async () => refreshCurrent();
+
+  if (estBundle?.establishment?.id) openLive(estBundle.establishment.id);
+  else closeLive();
+}
+
+/* =========================
+   Live updates (SSE deltas)
+========================= */
+function closeLive() {
+  if (liveSource) liveSource.close();
+  liveSource = null;
+  liveEstId = null;
+}
+
+function openLive(estId) {
+  if (!window.EventSource) return;
+  if (liveSource && liveEstId === estId) return;
+  closeLive();
+
+  liveEstId = estId;
+  liveSource = new EventSource(`${API}/establishments/${estId}/live`, { withCredentials: true });
+  liveSource.addEventListener("delta", (ev) => applyDelta(safeJson(ev.data, null)));
+  // serveur : abonné trop lent décroché -> on recharge la fiche complète
+  liveSource.addEventListener("resync", () => {
+    closeLive();
+    refreshCurrent().catch((e) => console.error(e));
+  });
+}
+
+function upsertReviewLocal(review) {
+  const bundle = current.establishment;
+  if (!bundle || !review) return;
+  const reviews = bundle.reviews || [];
+  const idx = reviews.findIndex((r) => r.id === review.id);
+  if (idx >= 0) reviews[idx] = review;
+  else reviews.unshift(review);
+  bundle.reviews = reviews;
+}
+
+function removeReviewLocal(reviewId) {
+  const bundle = current.establishment;
+  if (!bundle) return;
+  bundle.reviews = (bundle.reviews || []).filter((r) => r.id !== reviewId);
+}
+
+function patchPanel() {
+  // met à jour l'en-tête + la liste sans toucher au formulaire (focus / saisie conservés)
+  const bundle = current.establishment;
+  const top = $("#panelTop");
+  const list = $("#reviewsList");
+  if (!bundle || !top || !list) return;
+  const reviews = bundle.reviews ?? [];
+  top.innerHTML = renderTopHtml(reviews);
+  list.innerHTML = renderReviewsHtml(reviews);
+}
+
+function applyDelta(delta) {
+  const bundle = current.establishment;
+  if (!delta || !bundle || bundle.establishment?.id !== liveEstId) return;
+
+  if (delta.type === "review_upserted") upsertReviewLocal(delta.review);
+  else if (delta.type === "review_deleted") removeReviewLocal(delta.review_id);
+  else if (delta.type === "reviews_purged") delta.review_ids.forEach(removeReviewLocal);
+  else return;
+
+  advanceVersion(bundle, delta.version);
+  bundle.thena_avg = delta.thena_avg;
+  bundle.thena_count_scored = delta.thena_count_scored;
+  bundle.thena_count_total = delta.thena_count_total;
+  saveCachedBundle(bundle);
+  patchPanel();
 }
 
 /* =========================
@@ -572,6 +727,7 @@ function renderPanel(estBundle, isNewFlow) {
 ========================= */
 async function onSelectSuggestion(placeId) {
   try {
+    abortAutocomplete();
     setHint("Chargement...");
     clearSuggestions();
     localStorage.setItem(LS.currentPlaceId, placeId);
@@ -603,13 +759,27 @@ async function onSelectSuggestion(placeId) {
 
 async function lookupEstablishmentByGoogleId(googlePlaceId) {
   if (!googlePlaceId) return null;
+
+  const knownId = localStorage.getItem(LS.estByPlace(googlePlaceId));
+  if (knownId) {
+    try {
+      return await fetchBundle(knownId);
+    } catch (e) {
+      if (e.status !== 404) throw e;
+      dropCachedBundle(knownId, googlePlaceId);
+    }
+  }
+
   try {
     const data = await tryManyGet([
       `/establishments/by_google/${encodeURIComponent(googlePlaceId)}`,
       `/establishments/lookup?google_place_id=${encodeURIComponent(googlePlaceId)}`,
       `/establishments/find?google_place_id=${encodeURIComponent(googlePlaceId)}`,
     ]);
-    if (data?.establishment && Array.isArray(data?.reviews)) return data;
+    if (data?.establishment && Array.isArray(data?.reviews)) {
+      saveCachedBundle(data);
+      return data;
+    }
     return null;
   } catch (e) {
     if ([404, 422].includes(e.status)) return null;
@@ -620,7 +790,7 @@ async function lookupEstablishmentByGoogleId(googlePlaceId) {
 async function refreshCurrent() {
   if (current?.establishment?.establishment?.id) {
     const id = current.establishment.establishment.id;
-    const fresh = await apiGET(`/establishments/${id}`);
+    const fresh = await fetchBundle(id);
     current.establishment = fresh?.establishment ? fresh : current.establishment;
     renderPanel(current.establishment, false);
     return;
@@ -643,10 +813,12 @@ async function ensureEstablishmentExists() {
     address: place.address,
     google_rating: place.rating,
     types: place.types || [],
+    lat: place.lat,
+    lng: place.lng,
   };
 
   const created = await apiPOST("/establishments", payload);
-  estBundle = { establishment: created, reviews: [] };
+  estBundle = { establishment: created, reviews: [], version: 0 };
   current.establishment = estBundle;
   localStorage.setItem(LS.currentEstId, created.id);
   return estBundle;
@@ -703,10 +875,17 @@ async function submitReviewFlow() {
       recommend: !!flags.recommend,
     };
 
-    await apiPOST("/reviews", payload);
-
-    const fresh = await apiGET(`/establishments/${estId}`);
-    current.establishment = fresh;
+    // même clé si le service worker renvoie l'avis plus tard (file hors ligne)
+    const saved = await apiPOST("/reviews", payload, { "Idempotency-Key": newIdempotencyKey() });
+    if (saved?.queued) {
+      clearDraft();
+      setHint("Hors ligne : avis en attente d'envoi.");
+      setFormMsg("Hors ligne : avis enregistré, envoi automatique au retour du réseau ⏳", "ok");
+      return;
+    }
+    upsertReviewLocal(saved);
+    advanceVersion(current.establishment, saved.version);
+    saveCachedBundle(current.establishment);
 
     clearDraft();
     setHint("Ajout terminé ✅");
@@ -733,14 +912,14 @@ window.deleteReview = async (id) => {
   if (!confirm("Supprimer cet avis ?")) return;
 
   try {
-    await apiDELETE(`/reviews/${encodeURIComponent(id)}`);
+    const out = await apiDELETE(`/reviews/${encodeURIComponent(id)}`);
 
-    if (current?.establishment?.establishment?.id) {
-      const estId = current.establishment.establishment.id;
-      const fresh = await apiGET(`/establishments/${estId}`);
-      current.establishment = fresh;
-      renderPanel(current.establishment, false);
+    removeReviewLocal(Number(id));
+    if (current.establishment) {
+      advanceVersion(current.establishment, out?.version);
+      saveCachedBundle(current.establishment);
     }
+    patchPanel();
   } catch (e) {
     alert(`Erreur suppression: ${e.message}`);
   }
@@ -749,6 +928,13 @@ window.deleteReview = async (id) => {
 /* =========================
    Search input -> autocomplete
 ========================= */
+// la requête précédente est abandonnée : le serveur voit la déconnexion et
+// n'envoie pas l'appel Google s'il n'est pas encore parti
+function abortAutocomplete() {
+  if (autocompleteCtl) autocompleteCtl.abort();
+  autocompleteCtl = null;
+}
+
 search.addEventListener("input", () => {
   const q = search.value.trim();
   localStorage.setItem(LS.lastQuery, q);
@@ -758,12 +944,18 @@ search.addEventListener("input", () => {
   hidePanel();
 
   if (debounceTimer) clearTimeout(debounceTimer);
+  abortAutocomplete();
   if (!q) return;
 
   debounceTimer = setTimeout(async () => {
+    const ctl = new AbortController();
+    autocompleteCtl = ctl;
     try {
       setHint("Chargement...");
-      const items = await apiGET(`/api/google/autocomplete?q=${encodeURIComponent(q)}`);
+      const items = await apiGET(`/api/google/autocomplete?q=${encodeURIComponent(q)}`, {
+        signal: ctl.signal,
+        headers: { "X-Thena-Tab": TAB_ID },
+      });
       if (!items || items.length === 0) {
         setHint("Aucun résultat.");
         return;
@@ -771,8 +963,17 @@ search.addEventListener("input", () => {
       setHint("Clique un résultat.");
       renderSuggestions(items);
     } catch (e) {
+      // abandonnée (nouvelle saisie) ou remplacée côté serveur par une saisie plus récente
+      if (ctl.signal.aborted) return;
+      if (e.status === 409) {
+        // une saisie plus récente a pris le relais : son propre hint suivra
+        if (autocompleteCtl === ctl) setHint("");
+        return;
+      }
       console.error(e);
       setHint("Erreur autocomplete (clé Google ?).");
+    } finally {
+      if (autocompleteCtl === ctl) autocompleteCtl = null;
     }
   }, 250);
 });
@@ -837,6 +1038,43 @@ btnLogout.onclick = async () => {
   setAuthUI();
 };
 
+/* =========================
+   Service worker (hors ligne)
+========================= */
+function newIdempotencyKey() {
+  if (window.crypto?.randomUUID) return crypto.randomUUID();
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+function onOutboxMessage(msg) {
+  if (msg.review) {
+    const bundle = current.establishment;
+    if (bundle?.establishment?.id === msg.review.establishment_id) {
+      upsertReviewLocal(msg.review);
+      advanceVersion(bundle, msg.review.version);
+      saveCachedBundle(bundle);
+      patchPanel();
+    }
+    setHint(msg.pending ? `Avis envoyé ✅ (${msg.pending} en attente)` : "Avis en attente envoyé ✅");
+  } else if (msg.status === 401) {
+    setHint("Avis en attente : reconnecte-toi pour l'envoyer.");
+  } else if (msg.status >= 400 && msg.status < 500 && msg.status !== 409 && msg.status !== 429) {
+    setHint(`Avis en attente refusé : ${msg.detail || msg.status}`);
+  }
+}
+
+function registerServiceWorker() {
+  if (!("serviceWorker" in navigator)) return;
+  navigator.serviceWorker.register("/sw.js").catch((e) => console.error(e));
+  navigator.serviceWorker.addEventListener("message", (ev) => {
+    if (ev.data?.type === "thena:outbox") onOutboxMessage(ev.data);
+  });
+  // navigateurs sans Background Sync : vidage de la file au retour du réseau
+  window.addEventListener("online", () => {
+    navigator.serviceWorker.controller?.postMessage({ type: "thena:flush-outbox" });
+  });
+}
+
 /* =========================
    Boot
 ========================= */
@@ -844,6 +1082,7 @@ btnLogout.onclick = async () => {
   const q = localStorage.getItem(LS.lastQuery);
   if (q) search.value = q;
 
+  registerServiceWorker();
   await refreshAuth();
 })();
 
@@ -0,0 +1,240 @@
+/* ui/sw.js
+   THENA — service worker (hors ligne / réseau faible)
+
+   Servi tel quel sur /sw.js (portée "/"), après substitution par
+   static_assets.py :
+   - __THENA_UI_VERSION__ : empreinte du manifeste (app.<sha>.js, styles.<sha>.css)
+     -> nouveau déploiement = nouveau worker = nouveaux caches ;
+   - __THENA_PRECACHE__   : coquille (pages + fichiers empreinte).
+
+   Stratégies :
+   - coquille : pré-cachée à l'installation ; pages en réseau d'abord
+     (no-cache + ETag côté serveur), cache si hors ligne ; fichiers empreinte
+     en cache d'abord (immutables) ;
+   - fiches établissement + Google (autocomplete / place) : stale-while-revalidate,
+     avec une fenêtre de fraîcheur pour ne pas brûler le quota Google ;
+   - POST /reviews hors ligne : mis en file (IndexedDB), renvoyé par Background
+     Sync (ou au retour du réseau si le navigateur ne l'a pas) avec le même
+     Idempotency-Key -> pas de doublon si la première tentative était passée.
+*/
+
+"use strict";
+
+const VERSION = "__THENA_UI_VERSION__";
+const PRECACHE = __THENA_PRECACHE__;
+
+const SHELL_CACHE = `thena-shell-${VERSION}`;
+const DATA_CACHE = `thena-data-${VERSION}`;
+const DATA_MAX_ENTRIES = 300;
+
+const CACHED_AT = "x-thena-cached-at";
+const SYNC_TAG = "thena-outbox";
+const OUTBOX_DB = "thena-sw";
+const OUTBOX_STORE = "outbox";
+
+// chemin -> fraîcheur (ms) : en deçà, la copie en cache est servie sans revalider
+const SWR_ROUTES = [
+  { re: /^\/api\/google\/autocomplete$/, freshMs: 5 * 60 * 1000 },
+  { re: /^\/api\/google\/place$/, freshMs: 60 * 60 * 1000 },
+  { re: /^\/establishments\/by_google\/[^/]+$/, freshMs: 0 },
+  { re: /^\/establishments\/\d+$/, freshMs: 0 },
+];
+const FINGERPRINTED = /^\/ui\/[^/]+\.[0-9a-f]{10}\.(js|css)$/;
+
+/* =========================
+   Cycle de vie
+========================= */
+self.addEventListener("install", (event) => {
+  event.waitUntil(
+    caches.open(SHELL_CACHE)
+      .then((cache) => cache.addAll(PRECACHE))
+      .then(() => self.skipWaiting())
+  );
+});
+
+self.addEventListener("activate", (event) => {
+  event.waitUntil((async () => {
+    const keep = new Set([SHELL_CACHE, DATA_CACHE]);
+    for (const name of await caches.keys()) {
+      if (name.startsWith("thena-") && !keep.has(name)) await caches.delete(name);
+    }
+    await self.clients.claim();
+    await flushOutbox();
+  })());
+});
+
+self.addEventListener("fetch", (event) => {
+  const request = event.request;
+  const url = new URL(request.url);
+  if (url.origin !== self.location.origin) return;
+
+  if (request.method === "POST" && url.pathname === "/reviews") {
+    event.respondWith(postReview(request));
+    return;
+  }
+  if (request.method !== "GET") return;
+
+  if (request.mode === "navigate" && (url.pathname === "/" || url.pathname.startsWith("/ui/"))) {
+    event.respondWith(networkFirst(request, SHELL_CACHE));
+    return;
+  }
+  if (FINGERPRINTED.test(url.pathname)) {
+    event.respondWith(cacheFirst(request, SHELL_CACHE));
+    return;
+  }
+  if (url.pathname.startsWith("/ui/")) {
+    event.respondWith(networkFirst(request, SHELL_CACHE));
+    return;
+  }
+  const route = SWR_ROUTES.find((r) => r.re.test(url.pathname));
+  if (route) event.respondWith(staleWhileRevalidate(event, route.freshMs));
+});
+
+self.addEventListener("sync", (event) => {
+  if (event.tag === SYNC_TAG) event.waitUntil(flushOutbox(true));
+});
+
+self.addEventListener("message", (event) => {
+  // repli sans Background Sync : la page signale le retour du réseau
+  if (event.data?.type === "thena:flush-outbox") event.waitUntil(flushOutbox());
+});
+
+/* =========================
+   Stratégies de cache
+========================= */
+async function cacheFirst(request, cacheName) {
+  const cache = await caches.open(cacheName);
+  const cached = await cache.match(request);
+  if (cached) return cached;
+  const res = await fetch(request);
+  if (res.ok) await cache.put(request, res.clone());
+  return res;
+}
+
+async function networkFirst(request, cacheName) {
+  const cache = await caches.open(cacheName);
+  try {
+    const res = await fetch(request);
+    if (res.ok) await cache.put(request, res.clone());
+    return res;
+  } catch (e) {
+    // "/" et "/ui/" servent la même page
+    const cached = await cache.match(request, { ignoreSearch: true })
+      || (request.mode === "navigate" ? await cache.match("/ui/") : null);
+    if (cached) return cached;
+    throw e;
+  }
+}
+
+async function stamp(res) {
+  const headers = new Headers(res.headers);
+  headers.set(CACHED_AT, String(Date.now()));
+  return new Response(await res.blob(), { status: res.status, statusText: res.statusText, headers });
+}
+
+async function trim(cache) {
+  // put() remplace l'entrée en fin de liste : keys() est dans l'ordre d'écriture
+  const keys = await cache.keys();
+  for (const key of keys.slice(0, Math.max(0, keys.length - DATA_MAX_ENTRIES))) await cache.delete(key);
+}
+
+async function staleWhileRevalidate(event, freshMs) {
+  const request = event.request;
+  const cache = await caches.open(DATA_CACHE);
+  const cached = await cache.match(request);
+  const age = cached ? Date.now() - Number(cached.headers.get(CACHED_AT) || 0) : Infinity;
+  if (cached && age < freshMs) return cached;
+
+  const network = fetch(request).then(async (res) => {
+    // réponse de repli serveur (Google indisponible) : servie mais pas mise en cache
+    if (res.ok && !res.headers.has("x-thena-fallback")) {
+      await cache.put(request, await stamp(res.clone()));
+      await trim(cache);
+    }
+    return res;
+  });
+
+  if (cached) {
+    event.waitUntil(network.catch(() => {}));
+    return cached;
+  }
+  return network;
+}
+
+/* =========================
+   File d'envoi hors ligne (IndexedDB)
+========================= */
+function openOutbox() {
+  return new Promise((resolve, reject) => {
+    const req = indexedDB.open(OUTBOX_DB, 1);
+    req.onupgradeneeded = () => req.result.createObjectStore(OUTBOX_STORE, { keyPath: "id", autoIncrement: true });
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+async function outbox(mode, fn) {
+  const db = await openOutbox();
+  try {
+    return await new Promise((resolve, reject) => {
+      const tx = db.transaction(OUTBOX_STORE, mode);
+      const req = fn(tx.objectStore(OUTBOX_STORE));
+      tx.oncomplete = () => resolve(req?.result);
+      tx.onerror = () => reject(tx.error);
+    });
+  } finally {
+    db.close();
+  }
+}
+
+const outboxAdd = (item) => outbox("readwrite", (store) => store.add(item));
+const outboxAll = () => outbox("readonly", (store) => store.getAll());
+const outboxDelete = (id) => outbox("readwrite", (store) => store.delete(id));
+
+function jsonResponse(status, data) {
+  return new Response(JSON.stringify(data), { status, headers: { "Content-Type": "application/json" } });
+}
+
+async function postReview(request) {
+  const body = await request.clone().text();
+  const headers = {
+    "Content-Type": request.headers.get("Content-Type") || "application/json",
+    // clé fixée maintenant : le renvoi est rejoué à l'identique par le serveur
+    "Idempotency-Key": request.headers.get("Idempotency-Key") || self.crypto.randomUUID(),
+  };
+  try {
+    return await fetch(request.url, { method: "POST", headers, body, credentials: "include" });
+  } catch {
+    const id = await outboxAdd({ url: request.url, headers, body, queued_at: Date.now() });
+    try { await self.registration.sync.register(SYNC_TAG); } catch {}
+    return jsonResponse(202, { queued: true, outbox_id: id });
+  }
+}
+
+async function notify(message) {
+  for (const client of await self.clients.matchAll({ type: "window" })) client.postMessage(message);
+}
+
+let flushing = null;
+
+function flushOutbox(fromSync = false) {
+  // un seul vidage à la fois (sync + message + activate peuvent se croiser)
+  if (!flushing) flushing = drainOutbox().finally(() => { flushing = null; });
+  // sync : un rejet demande au navigateur de réessayer plus tard
+  return fromSync ? flushing : flushing.catch(() => {});
+}
+
+async function drainOutbox() {
+  for (const item of await outboxAll()) {
+    const res = await fetch(item.url, { method: "POST", headers: item.headers, body: item.body, credentials: "include" });
+    // session expirée / requête en cours / limite / panne serveur : on garde l'avis et on réessaiera
+    if ([401, 409, 429].includes(res.status) || res.status >= 500) {
+      await notify({ type: "thena:outbox", status: res.status, pending: (await outboxAll()).length });
+      throw new Error(`outbox: ${res.status}`);
+    }
+    await outboxDelete(item.id);
+    const data = await res.json().catch(() => null);
+    await notify({ type: "thena:outbox", status: res.status, review: res.ok ? data : null,
+                   detail: res.ok ? null : data?.detail, pending: (await outboxAll()).length });
+  }
+}